@@ -0,0 +1,197 @@
+"""
+Compares synchronous and asynchronous analyses of large documents.
+
+Analyzes large documents with ``lambda_function_4`` against the stand-ins
+in ``stubs`` in two modes,
+
+* "sync": ``lambda_handler`` splits each document into chunks and
+  analyzes them with BatchDetect* APIs.
+* "async": ``lambda_handler`` hands each document to asynchronous jobs of
+  Amazon Comprehend, and ``async_jobs_handler`` is invoked every
+  ``--poll-seconds`` until the analysis results are saved.
+
+Each mode runs in a fresh Python process because settings are read when
+the Lambda function is imported.
+The time spent in the handlers, the time until the results are saved and
+the number of requests to each Amazon Comprehend API are reported in JSON.
+
+Usage (in the ``sam`` directory)::
+
+    python benchmarks/async_jobs.py [--document-bytes N ...]
+        [--records N] [--s3-latency SPEC] [--comprehend-latency SPEC]
+        [--job-seconds S] [--poll-seconds S] [--output FILE]
+
+A latency ``SPEC`` is "none", "fixed:MS", "uniform:MIN_MS:MAX_MS" or
+"lognormal:MEDIAN_MS:SIGMA".
+"""
+from __future__ import print_function
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SAM_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+# bucket of input and output objects
+BUCKET = 'learn-aws-lambda-comprehend-s3-bucket'
+
+# settings of the Lambda function in each mode
+MODE_ENV = {
+    'sync': {
+        'COMPREHEND_S3_ASYNC_THRESHOLD_BYTES': '0'
+    },
+    'async': {
+        'COMPREHEND_S3_ASYNC_THRESHOLD_BYTES': '1',
+        'COMPREHEND_S3_ASYNC_ROLE_ARN':
+            'arn:aws:iam::000000000000:role/stub-comprehend-data-access',
+        'COMPREHEND_S3_ASYNC_LOCATION': 's3://%s/comprehend/async' % BUCKET
+    }
+}
+
+# settings of the Lambda function common to the modes
+DEFAULT_ENV = {
+    'COMPREHEND_S3_LOGGING_LEVEL': 'WARNING',
+    'COMPREHEND_S3_METRICS': 'false',
+    'COMPREHEND_S3_RETURN_MODE': 'summary'
+}
+
+# maximum number of polls until the results are saved
+MAX_POLLS = 1000
+
+
+def run_mode(config):
+    """
+    Runs a mode in this process.
+
+    :type config: dict
+    :param config: mode and model given by :py:func:`main`.
+    :rtype: dict
+    :return: measured result.
+    """
+    sys.path.insert(0, BENCHMARKS_DIR)
+    sys.path.insert(0, os.path.join(SAM_DIR, 'src'))
+    os.environ.update(DEFAULT_ENV)
+    os.environ.update(MODE_ENV[config['Mode']])
+    import stubs
+    stubs.install()
+    stubs.configure(
+        s3_latency=config['S3Latency'],
+        comprehend_latency=config['ComprehendLatency'],
+        document_bytes=config['DocumentBytes'],
+        job_seconds=config['JobSeconds'])
+    import lambda_function_4
+    context = stubs.StubContext()
+    keys = ['inbox/large-%d.txt' % i for i in range(config['Records'])]
+    logs = io.StringIO()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(logs):
+        summary = lambda_function_4.lambda_handler(
+            stubs.make_event(keys, bucket=BUCKET), context)
+    handler_seconds = time.perf_counter() - started
+    polls = 0
+    poll_seconds = 0.0
+    completed = 0
+    if config['Mode'] == 'async':
+        while completed < summary['Succeeded'] and polls < MAX_POLLS:
+            time.sleep(config['PollSeconds'])
+            poll_started = time.perf_counter()
+            with contextlib.redirect_stdout(logs):
+                counts = lambda_function_4.async_jobs_handler({}, context)
+            poll_seconds += time.perf_counter() - poll_started
+            polls += 1
+            completed += counts['Completed']
+    saved_seconds = time.perf_counter() - started
+    saved = len([
+        record for record in summary['Records']
+        if record['Status'] == 'Succeeded' and
+        (BUCKET, record['Output'][len('s3://%s/' % BUCKET):]) in stubs.OBJECTS
+    ])
+    return {
+        'Mode': config['Mode'],
+        'DocumentBytes': config['DocumentBytes'],
+        'Records': config['Records'],
+        'Saved': saved,
+        'HandlerMs': handler_seconds * 1000.0,
+        'Polls': polls,
+        'PollMs': poll_seconds * 1000.0,
+        'SavedAfterMs': saved_seconds * 1000.0,
+        'ComprehendRequests': dict(
+            (operation_name, count)
+            for (operation_name, count) in stubs.REQUEST_COUNTS.items()
+            if 'Detect' in operation_name)
+    }
+
+
+def measure(config):
+    """
+    Runs a mode in a fresh process.
+
+    :rtype: dict
+    :return: measured result.
+    """
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--child', json.dumps(config)],
+        stderr=subprocess.DEVNULL)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument(
+        '--document-bytes', type=int, nargs='+', default=[1000000],
+        help='approximate sizes of documents (default: 1000000)')
+    parser.add_argument(
+        '--records', type=int, default=1,
+        help='number of documents in an event (default: 1)')
+    parser.add_argument(
+        '--s3-latency', default='lognormal:15:0.5',
+        help='latency of Amazon S3 requests (default: lognormal:15:0.5)')
+    parser.add_argument(
+        '--comprehend-latency', default='lognormal:50:0.5',
+        help='latency of Amazon Comprehend requests '
+             '(default: lognormal:50:0.5)')
+    parser.add_argument(
+        '--job-seconds', type=float, default=2.0,
+        help='seconds until an asynchronous job completes (default: 2)')
+    parser.add_argument(
+        '--poll-seconds', type=float, default=0.5,
+        help='interval of checking asynchronous jobs (default: 0.5)')
+    parser.add_argument('--output', help='saves results in a JSON file')
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(run_mode(json.loads(args.child))))
+        return 0
+    model = {
+        'Records': args.records,
+        'S3Latency': args.s3_latency,
+        'ComprehendLatency': args.comprehend_latency,
+        'JobSeconds': args.job_seconds,
+        'PollSeconds': args.poll_seconds
+    }
+    results = []
+    for (document_bytes, mode) in itertools.product(
+            args.document_bytes, ('sync', 'async')):
+        config = dict(model)
+        config.update({'Mode': mode, 'DocumentBytes': document_bytes})
+        print(
+            'measuring mode=%s, documents=%d bytes' % (mode, document_bytes),
+            file=sys.stderr)
+        results.append(measure(config))
+    report = {'Model': model, 'Results': results}
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
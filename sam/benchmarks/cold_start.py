@@ -0,0 +1,181 @@
+"""
+Measures cold starts of the Lambda functions with local stubs.
+
+Each measurement runs in a fresh Python process, which imports a Lambda
+function and invokes it once with an S3 PUT event.
+Medians of the import time and the first invocation latency are reported.
+A function in ``WARM_UP_TARGETS`` is also measured in processes that
+handle a warm-up event before the S3 PUT event, and medians of the
+warm-up latency and the invocation latency after it are reported.
+
+Usage (in the ``sam`` directory)::
+
+    python benchmarks/cold_start.py [--runs N] [--save-baseline FILE]
+    python benchmarks/cold_start.py --baseline FILE [--tolerance 0.2]
+
+With ``--baseline``, exits with status 1 if any median is slower than the
+baseline by more than the tolerance.
+"""
+from __future__ import print_function
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SAM_DIR = os.path.dirname(BENCHMARKS_DIR)
+REPOSITORY_DIR = os.path.dirname(SAM_DIR)
+
+# Lambda functions to be measured
+TARGETS = {
+    'lambda_function_1': os.path.join(
+        REPOSITORY_DIR, 'scripts', 'lambda_function_1.py'),
+    'lambda_function_2': os.path.join(
+        REPOSITORY_DIR, 'scripts', 'lambda_function_2.py'),
+    'lambda_function_4': os.path.join(SAM_DIR, 'src', 'lambda_function_4.py')
+}
+
+# Lambda functions that handle warm-up events
+WARM_UP_TARGETS = ('lambda_function_4',)
+
+# warm-up event sent to WARM_UP_TARGETS
+WARM_UP_EVENT = {
+    'WarmUp': True,
+    'Bucket': 'learn-aws-lambda-comprehend-s3-bucket'
+}
+
+# slack in milliseconds added to a baseline
+# so that tiny timings do not fail by noise
+ABSOLUTE_SLACK_MS = 5.0
+
+
+def measure_once(name, path, warm_up=False):
+    """
+    Imports and invokes a Lambda function in this process.
+
+    :type warm_up: bool
+    :param warm_up: whether a warm-up event is handled before the S3 PUT
+        event.
+    :rtype: dict
+    :return: import time and first invocation latency in milliseconds.
+        Warm-up latency and invocation latency after it instead of the
+        first invocation latency if ``warm_up`` is ``True``.
+    """
+    sys.path.insert(0, BENCHMARKS_DIR)
+    # lambda_function_4 prewarms clients only in the Lambda runtime
+    os.environ.setdefault('AWS_LAMBDA_FUNCTION_NAME', 'stub-function')
+    import stubs
+    stubs.install()
+    sys.path.insert(0, os.path.dirname(path))
+    start = time.perf_counter()
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    imported = time.perf_counter()
+    if warm_up:
+        module.lambda_handler(WARM_UP_EVENT, stubs.StubContext())
+    warmed_up = time.perf_counter()
+    module.lambda_handler(
+        stubs.make_event(['inbox/test.txt']), stubs.StubContext())
+    invoked = time.perf_counter()
+    if warm_up:
+        return {
+            'warm_up_ms': (warmed_up - imported) * 1000.0,
+            'warmed_invocation_ms': (invoked - warmed_up) * 1000.0
+        }
+    return {
+        'import_ms': (imported - start) * 1000.0,
+        'first_invocation_ms': (invoked - imported) * 1000.0
+    }
+
+
+def measure(name, path, runs):
+    """
+    Measures a Lambda function in fresh processes.
+
+    :rtype: dict
+    :return: medians of metrics of :py:func:`measure_once` in
+        milliseconds.
+    """
+    commands = [[sys.executable, os.path.abspath(__file__), '--child', name]]
+    if name in WARM_UP_TARGETS:
+        commands.append(commands[0] + ['--warm-up'])
+    samples = {}
+    for command in commands:
+        for _ in range(runs):
+            output = subprocess.check_output(
+                command, stderr=subprocess.DEVNULL)
+            sample = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+            for (metric, value) in sample.items():
+                samples.setdefault(metric, []).append(value)
+    return dict(
+        (metric, statistics.median(values))
+        for (metric, values) in samples.items())
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compares results with a baseline.
+
+    :rtype: list
+    :return: messages describing regressions.
+    """
+    regressions = []
+    for (name, metrics) in results.items():
+        for (metric, value) in metrics.items():
+            base = baseline.get(name, {}).get(metric)
+            if base is None:
+                continue
+            limit = base * (1.0 + tolerance) + ABSOLUTE_SLACK_MS
+            if value > limit:
+                regressions.append('%s %s: %.1f ms > %.1f ms' % (
+                    name, metric, value, limit))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument(
+        '--warm-up', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument(
+        '--runs', type=int, default=5,
+        help='number of processes per function (default: 5)')
+    parser.add_argument(
+        '--targets', nargs='+', choices=sorted(TARGETS),
+        default=sorted(TARGETS), help='functions to be measured')
+    parser.add_argument('--baseline', help='baseline JSON to compare with')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help='allowed slowdown relative to the baseline (default: 0.2)')
+    parser.add_argument('--save-baseline', help='saves results as a baseline')
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(
+            measure_once(args.child, TARGETS[args.child], args.warm_up)))
+        return 0
+    results = {}
+    for name in args.targets:
+        results[name] = measure(name, TARGETS[name], args.runs)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('regression: %s' % regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
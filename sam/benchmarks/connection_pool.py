@@ -0,0 +1,129 @@
+"""
+Compares throughput of a default boto3 client and a client created by
+``lambda_function_4.create_client`` against a local HTTP stand-in of
+Amazon Comprehend.
+
+The stand-in answers every DetectSentiment request after a fixed latency
+and counts TCP connections, so that connection reuse is visible.
+Requires boto3.
+
+Usage (in the ``sam`` directory)::
+
+    python benchmarks/connection_pool.py [--concurrency N] [--requests N]
+        [--latency-ms MS]
+"""
+from __future__ import print_function
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+SAM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SAM_DIR, 'src'))
+
+RESPONSE = json.dumps({
+    'Sentiment': 'NEUTRAL',
+    'SentimentScore': {
+        'Positive': 0.1,
+        'Negative': 0.1,
+        'Neutral': 0.7,
+        'Mixed': 0.1
+    }
+}).encode('utf-8')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers any POST request with :py:data:`RESPONSE`.
+    """
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with StandInHandler.lock:
+            StandInHandler.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-amz-json-1.1')
+        self.send_header('Content-Length', str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(client, concurrency, requests):
+    """
+    Calls DetectSentiment concurrently.
+
+    :rtype: dict
+    :return: throughput and number of new connections.
+    """
+    connections = StandInHandler.connections
+    def call(_):
+        client.detect_sentiment(Text='hello', LanguageCode='en')
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(call, range(requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        'requests_per_second': requests / elapsed,
+        'connections': StandInHandler.connections - connections
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--concurrency', type=int, default=32,
+        help='number of concurrent requests (default: 32)')
+    parser.add_argument(
+        '--requests', type=int, default=2000,
+        help='number of requests per client (default: 2000)')
+    parser.add_argument(
+        '--latency-ms', type=float, default=5.0,
+        help='latency of the stand-in in milliseconds (default: 5)')
+    args = parser.parse_args()
+    # sizes the pool of lambda_function_4 for the concurrency
+    os.environ['COMPREHEND_S3_MAX_WORKERS'] = str(
+        max(args.concurrency // 4, 1))
+    os.environ['COMPREHEND_S3_PREWARM'] = 'false'
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'stand-in')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'stand-in')
+    import boto3
+    import lambda_function_4
+    StandInHandler.latency = args.latency_ms / 1000.0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint_url = 'http://127.0.0.1:%d' % server.server_address[1]
+    clients = [
+        ('default', boto3.client(
+            'comprehend', region_name='us-east-2', endpoint_url=endpoint_url)),
+        ('tuned', lambda_function_4.create_client(
+            'comprehend', region_name='us-east-2', endpoint_url=endpoint_url))
+    ]
+    results = {}
+    for (name, client) in clients:
+        # warms up the pool as a warm invocation would
+        run(client, args.concurrency, args.concurrency)
+        results[name] = run(client, args.concurrency, args.requests)
+    server.shutdown()
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+Measures how ``lambda_function_4`` meets the deadline of invocations.
+
+Invokes ``lambda_handler`` against the stand-ins in ``stubs`` with an event
+of more records than can be processed in the timeout, in two modes,
+
+* "unlimited": ``main`` is called without a Lambda context, so every record
+  is started regardless of the deadline, as before the scheduler.
+* "deadline": ``lambda_handler`` is given a context whose remaining time
+  starts at ``--timeout-ms``. Records that cannot finish are handed to a
+  self-invocation, which the stand-in of AWS Lambda keeps and this script
+  delivers to ``lambda_handler`` with a fresh context until no records are
+  left.
+
+Each mode runs in a fresh Python process because settings are read when
+the Lambda function is imported.
+The number of invocations, the longest invocation, how many invocations
+exceeded the timeout and how many records were saved are reported in JSON.
+
+Usage (in the ``sam`` directory)::
+
+    python benchmarks/deadline.py [--records N] [--document-bytes N]
+        [--timeout-ms MS] [--margin-ms MS] [--s3-latency SPEC]
+        [--comprehend-latency SPEC] [--output FILE]
+
+A latency ``SPEC`` is "none", "fixed:MS", "uniform:MIN_MS:MAX_MS" or
+"lognormal:MEDIAN_MS:SIGMA".
+"""
+from __future__ import print_function
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SAM_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+# bucket of input and output objects
+BUCKET = 'learn-aws-lambda-comprehend-s3-bucket'
+
+# settings of the Lambda function
+DEFAULT_ENV = {
+    'COMPREHEND_S3_LOGGING_LEVEL': 'WARNING',
+    'COMPREHEND_S3_METRICS': 'false',
+    'COMPREHEND_S3_RETURN_MODE': 'summary',
+    'COMPREHEND_S3_CONTINUATION': 'invoke',
+    # every record is analyzed for real
+    'COMPREHEND_S3_DETECTOR_CACHE_BYTES': '0',
+    'COMPREHEND_S3_CACHE_SIZE': '0'
+}
+
+# maximum number of invocations in a mode
+MAX_INVOCATIONS = 1000
+
+
+def run_mode(config):
+    """
+    Runs a mode in this process.
+
+    :type config: dict
+    :param config: mode and model given by :py:func:`main`.
+    :rtype: dict
+    :return: measured result.
+    """
+    sys.path.insert(0, BENCHMARKS_DIR)
+    sys.path.insert(0, os.path.join(SAM_DIR, 'src'))
+    os.environ.update(DEFAULT_ENV)
+    os.environ['COMPREHEND_S3_DEADLINE_MARGIN_MS'] = str(config['MarginMs'])
+    import stubs
+    stubs.install()
+    stubs.configure(
+        s3_latency=config['S3Latency'],
+        comprehend_latency=config['ComprehendLatency'],
+        document_bytes=config['DocumentBytes'])
+    import lambda_function_4
+    keys = ['inbox/deadline-%d.txt' % i for i in range(config['Records'])]
+    stubs.INVOCATIONS.append(stubs.make_event(keys, bucket=BUCKET))
+    durations = []
+    outputs = set()
+    logs = io.StringIO()
+    while stubs.INVOCATIONS and len(durations) < MAX_INVOCATIONS:
+        event = stubs.INVOCATIONS.pop(0)
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(logs):
+            if config['Mode'] == 'unlimited':
+                summary = lambda_function_4.main(event)
+            else:
+                summary = lambda_function_4.lambda_handler(
+                    event, stubs.StubContext(config['TimeoutMs']))
+        durations.append((time.perf_counter() - started) * 1000.0)
+        outputs.update(
+            record['Output'] for record in summary['Records']
+            if record['Status'] == 'Succeeded')
+    return {
+        'Mode': config['Mode'],
+        'Records': config['Records'],
+        'Saved': len(outputs),
+        'Invocations': len(durations),
+        'MaxInvocationMs': max(durations),
+        'TimedOut': len([
+            duration for duration in durations
+            if duration > config['TimeoutMs']
+        ]),
+        'TotalMs': sum(durations)
+    }
+
+
+def measure(config):
+    """
+    Runs a mode in a fresh process.
+
+    :rtype: dict
+    :return: measured result.
+    """
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--child', json.dumps(config)],
+        stderr=subprocess.DEVNULL)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument(
+        '--records', type=int, default=100,
+        help='number of records in the first event (default: 100)')
+    parser.add_argument(
+        '--document-bytes', type=int, default=20000,
+        help='approximate size of a document (default: 20000)')
+    parser.add_argument(
+        '--timeout-ms', type=int, default=3000,
+        help='timeout of an invocation in milliseconds (default: 3000)')
+    parser.add_argument(
+        '--margin-ms', type=int, default=500,
+        help='COMPREHEND_S3_DEADLINE_MARGIN_MS (default: 500)')
+    parser.add_argument(
+        '--s3-latency', default='lognormal:15:0.5',
+        help='latency of Amazon S3 requests (default: lognormal:15:0.5)')
+    parser.add_argument(
+        '--comprehend-latency', default='lognormal:50:0.5',
+        help='latency of Amazon Comprehend requests '
+             '(default: lognormal:50:0.5)')
+    parser.add_argument('--output', help='saves results in a JSON file')
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(run_mode(json.loads(args.child))))
+        return 0
+    model = {
+        'Records': args.records,
+        'DocumentBytes': args.document_bytes,
+        'TimeoutMs': args.timeout_ms,
+        'MarginMs': args.margin_ms,
+        'S3Latency': args.s3_latency,
+        'ComprehendLatency': args.comprehend_latency
+    }
+    results = []
+    for mode in ('unlimited', 'deadline'):
+        config = dict(model)
+        config['Mode'] = mode
+        print('measuring mode=%s' % mode, file=sys.stderr)
+        results.append(measure(config))
+    report = {'Model': model, 'Results': results}
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
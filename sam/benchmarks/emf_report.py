@@ -0,0 +1,150 @@
+"""
+Summarizes metrics of stages emitted by ``lambda_function_4``.
+
+Reads log lines in CloudWatch Embedded Metric Format (EMF) and reports the
+count, p50, p99 and maximum of every metric of each stage.
+Lines that are not EMF documents are ignored, so a whole log exported from
+CloudWatch Logs or captured from ``sam local invoke`` can be given.
+
+Usage (in the ``sam`` directory)::
+
+    python benchmarks/emf_report.py [--json] [LOG_FILE ...]
+
+Reads the standard input if no ``LOG_FILE`` is given.
+"""
+from __future__ import print_function
+import argparse
+import json
+import sys
+from collections import OrderedDict
+
+
+def parse_emf_line(line):
+    """
+    Parses a given log line as an EMF document.
+
+    The document may follow a prefix like a timestamp and a request ID.
+
+    :type line: string
+    :param line: log line.
+    :rtype: dict
+    :return: EMF document. ``None`` if ``line`` is not an EMF document.
+    """
+    start = line.find('{')
+    if start < 0:
+        return None
+    try:
+        document = json.loads(line[start:])
+    except ValueError:
+        return None
+    if not isinstance(document, dict) or '_aws' not in document:
+        return None
+    return document
+
+
+def collect_values(lines):
+    """
+    Collects values of metrics in given log lines.
+
+    :type lines: iterable
+    :param lines: log lines.
+    :rtype: OrderedDict
+    :return: maps ``(stage, metric name, unit)`` to a list of values.
+        ``stage`` is "Record" for metrics without the ``Stage`` dimension.
+    """
+    values = OrderedDict()
+    for line in lines:
+        document = parse_emf_line(line)
+        if document is None:
+            continue
+        stage = document.get('Stage', 'Record')
+        for directive in document['_aws'].get('CloudWatchMetrics', []):
+            for metric in directive.get('Metrics', []):
+                name = metric['Name']
+                value = document.get(name)
+                if value is None:
+                    continue
+                if not isinstance(value, list):
+                    value = [value]
+                values.setdefault(
+                    (stage, name, metric.get('Unit', 'None')), []
+                ).extend(value)
+    return values
+
+
+def percentile(sorted_values, ratio):
+    """
+    Returns a percentile of given sorted values by the nearest-rank method.
+
+    :type sorted_values: list
+    :param sorted_values: values in ascending order.
+    :type ratio: float
+    :param ratio: ratio of the percentile; e.g., 0.99 for p99.
+    :rtype: float
+    :return: percentile of ``sorted_values``.
+    """
+    rank = int(ratio * len(sorted_values) + 0.5)
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def summarize(values):
+    """
+    Summarizes collected values.
+
+    :type values: OrderedDict
+    :param values: result of :py:func:`collect_values`.
+    :rtype: list
+    :return: list of dicts each of which has ``Stage``, ``Metric``,
+        ``Unit``, ``Count``, ``P50``, ``P99`` and ``Max``.
+    """
+    summaries = []
+    for ((stage, name, unit), metric_values) in values.items():
+        metric_values = sorted(metric_values)
+        summaries.append({
+            'Stage': stage,
+            'Metric': name,
+            'Unit': unit,
+            'Count': len(metric_values),
+            'P50': percentile(metric_values, 0.5),
+            'P99': percentile(metric_values, 0.99),
+            'Max': metric_values[-1]
+        })
+    return summaries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        'logs', metavar='LOG_FILE', nargs='*',
+        help='log files (default: standard input)')
+    parser.add_argument(
+        '--json', action='store_true',
+        help='prints the summary in JSON')
+    args = parser.parse_args()
+    values = OrderedDict()
+    if args.logs:
+        for path in args.logs:
+            with open(path) as f:
+                for (key, metric_values) in collect_values(f).items():
+                    values.setdefault(key, []).extend(metric_values)
+    else:
+        values = collect_values(sys.stdin)
+    summaries = summarize(values)
+    if args.json:
+        print(json.dumps(summaries, indent=2))
+        return
+    print('%-24s %-10s %-12s %6s %12s %12s %12s' % (
+        'stage', 'metric', 'unit', 'count', 'p50', 'p99', 'max'))
+    for summary in summaries:
+        print('%-24s %-10s %-12s %6d %12.3f %12.3f %12.3f' % (
+            summary['Stage'],
+            summary['Metric'],
+            summary['Unit'],
+            summary['Count'],
+            summary['P50'],
+            summary['P99'],
+            summary['Max']))
+
+
+if __name__ == '__main__':
+    main()
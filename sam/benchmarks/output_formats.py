@@ -0,0 +1,77 @@
+"""
+Compares sizes and encoding times of the output formats of
+``lambda_function_4``.
+
+Encodes ``test/test-ref.json`` in every output format available in the
+current environment.
+
+Usage (in the ``sam`` directory)::
+
+    python benchmarks/output_formats.py [--repeat N]
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+import timeit
+
+
+SAM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SAM_DIR, 'src'))
+REFERENCE_PATH = os.path.join(
+    os.path.dirname(SAM_DIR), 'test', 'test-ref.json')
+
+import lambda_function_4  # noqa: E402
+
+
+def benchmark_output_formats(analysis, repeat):
+    """
+    Measures every available output format.
+
+    :type analysis: dict
+    :param analysis: analysis result to be encoded.
+    :type repeat: int
+    :param repeat: number of encodings per format.
+    :rtype: list
+    :return: list of dicts, each of which has the name, extension, size in
+        bytes and mean encoding time in microseconds of a format.
+    """
+    results = []
+    for (name, (extension, _, _, encode)) in sorted(
+            lambda_function_4.OUTPUT_FORMATS.items()):
+        try:
+            size = len(encode(analysis))
+        except ImportError as e:
+            print('skipping %s: %s' % (name, e), file=sys.stderr)
+            continue
+        seconds = timeit.timeit(lambda: encode(analysis), number=repeat)
+        results.append({
+            'format': name,
+            'extension': extension,
+            'bytes': size,
+            'encode_us': seconds * 1000000.0 / repeat
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--repeat', type=int, default=1000,
+        help='number of encodings per format (default: 1000)')
+    args = parser.parse_args()
+    with open(REFERENCE_PATH) as f:
+        analysis = json.load(f)
+    results = benchmark_output_formats(analysis, args.repeat)
+    print('%-14s %-10s %10s %12s' % ('format', 'extension', 'bytes', 'encode us'))
+    for result in results:
+        print('%-14s %-10s %10d %12.1f' % (
+            result['format'],
+            result['extension'],
+            result['bytes'],
+            result['encode_us']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+"""
+Measures throughput of ``lambda_function_4`` with local stand-ins.
+
+Invokes ``lambda_handler`` against the stand-ins of Amazon S3 and Amazon
+Comprehend in ``stubs`` with modeled latencies, throttling and response
+sizes, for every combination of triggers, document sizes, numbers of
+records per event and numbers of workers.
+With the "sqs" trigger, each object is notified in its own message to a
+stand-in queue and the messages are delivered to ``sqs_handler`` together.
+Each combination runs in a fresh Python process because settings are read
+when the Lambda function is imported.
+Invocations per second, records per second, latencies of invocations,
+per-stage latencies taken from the embedded metrics and peak RSS are
+reported in JSON.
+
+Usage (in the ``sam`` directory)::
+
+    python benchmarks/pipeline.py [--triggers {s3,sqs} ...]
+        [--document-bytes N ...] [--records N ...]
+        [--max-workers N ...] [--invocations N]
+        [--s3-latency SPEC] [--comprehend-latency SPEC]
+        [--throttle-rate P] [--response-scale N] [--env NAME=VALUE ...]
+        [--output FILE] [--baseline FILE] [--tolerance 0.2]
+
+A latency ``SPEC`` is "none", "fixed:MS", "uniform:MIN_MS:MAX_MS" or
+"lognormal:MEDIAN_MS:SIGMA".
+With ``--baseline``, exits with status 1 if the invocations per second of
+any combination drops below the baseline by more than the tolerance.
+"""
+from __future__ import print_function
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SAM_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+# settings of the Lambda function unless overridden by --env
+DEFAULT_ENV = {
+    'COMPREHEND_S3_LOGGING_LEVEL': 'WARNING',
+    'COMPREHEND_S3_METRICS': 'true'
+}
+
+# keys that identify a combination in results
+COMBINATION_KEYS = ('Trigger', 'DocumentBytes', 'Records', 'MaxWorkers')
+
+
+def percentile(sorted_values, ratio):
+    """
+    Returns a percentile of given sorted values by the nearest-rank method.
+    """
+    rank = int(ratio * len(sorted_values) + 0.5)
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def get_peak_rss_kib():
+    """
+    Returns the peak resident set size of this process in KiB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # in bytes on macOS
+        peak //= 1024
+    return peak
+
+
+def run_combination(config):
+    """
+    Runs a combination in this process.
+
+    :type config: dict
+    :param config: combination and model given by :py:func:`main`.
+    :rtype: dict
+    :return: measured result.
+    """
+    sys.path.insert(0, BENCHMARKS_DIR)
+    sys.path.insert(0, os.path.join(SAM_DIR, 'src'))
+    os.environ.update(DEFAULT_ENV)
+    os.environ.update(config['Env'])
+    os.environ['COMPREHEND_S3_MAX_WORKERS'] = str(config['MaxWorkers'])
+    import stubs
+    import emf_report
+    stubs.install()
+    stubs.configure(
+        s3_latency=config['S3Latency'],
+        comprehend_latency=config['ComprehendLatency'],
+        throttle_rate=config['ThrottleRate'],
+        document_bytes=config['DocumentBytes'],
+        response_scale=config['ResponseScale'])
+    import lambda_function_4
+    context = stubs.StubContext()
+    def invoke(name):
+        keys = [
+            'inbox/%s-%d.txt' % (name, i) for i in range(config['Records'])
+        ]
+        metrics = io.StringIO()
+        with contextlib.redirect_stdout(metrics):
+            try:
+                if config['Trigger'] == 'sqs':
+                    queue = stubs.StubQueue(batch_size=len(keys))
+                    for key in keys:
+                        queue.send(stubs.make_event([key]))
+                    response = lambda_function_4.sqs_handler(
+                        queue.receive(), context)
+                    failed = len(response['batchItemFailures']) > 0
+                else:
+                    lambda_function_4.lambda_handler(
+                        stubs.make_event(keys), context)
+                    failed = False
+            except Exception:
+                failed = True
+        return (metrics.getvalue(), failed)
+    # the first invocation pays for creating clients and thread pools
+    invoke('warm-up')
+    latencies = []
+    failures = 0
+    metric_lines = []
+    started = time.perf_counter()
+    for i in range(config['Invocations']):
+        invocation_started = time.perf_counter()
+        lines, failed = invoke(str(i))
+        latencies.append((time.perf_counter() - invocation_started) * 1000.0)
+        failures += failed and 1 or 0
+        metric_lines.extend(lines.splitlines())
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    result = dict((key, config[key]) for key in COMBINATION_KEYS)
+    result.update({
+        'Invocations': config['Invocations'],
+        'Failures': failures,
+        'InvocationsPerSecond': config['Invocations'] / elapsed,
+        'RecordsPerSecond': config['Invocations'] * config['Records'] / elapsed,
+        'LatencyMs': {
+            'P50': percentile(latencies, 0.5),
+            'P99': percentile(latencies, 0.99),
+            'Max': latencies[-1]
+        },
+        'Stages': emf_report.summarize(
+            emf_report.collect_values(metric_lines)),
+        'PeakRssKiB': get_peak_rss_kib()
+    })
+    return result
+
+
+def measure(config):
+    """
+    Runs a combination in a fresh process.
+
+    :rtype: dict
+    :return: measured result.
+    """
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--child', json.dumps(config)],
+        stderr=subprocess.DEVNULL)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compares results with a baseline.
+
+    :rtype: list
+    :return: messages describing regressions.
+    """
+    def key(result):
+        return tuple(result[name] for name in COMBINATION_KEYS)
+    base_results = dict(
+        (key(result), result) for result in baseline.get('Results', []))
+    regressions = []
+    for result in results:
+        base = base_results.get(key(result))
+        if base is None:
+            continue
+        limit = base['InvocationsPerSecond'] * (1.0 - tolerance)
+        if result['InvocationsPerSecond'] < limit:
+            regressions.append(
+                'trigger=%s, documents=%d bytes, records=%d, workers=%d: '
+                '%.2f invocations/s < %.2f' % (
+                    result['Trigger'],
+                    result['DocumentBytes'],
+                    result['Records'],
+                    result['MaxWorkers'],
+                    result['InvocationsPerSecond'],
+                    limit))
+    return regressions
+
+
+def parse_env(assignments):
+    """
+    Parses given "NAME=VALUE" assignments into a dict.
+    """
+    env = {}
+    for assignment in assignments:
+        name, _, value = assignment.partition('=')
+        env[name] = value
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument(
+        '--triggers', nargs='+', choices=('s3', 'sqs'), default=['s3'],
+        help='how the function is triggered (default: s3)')
+    parser.add_argument(
+        '--document-bytes', type=int, nargs='+', default=[1000, 20000],
+        help='approximate sizes of documents (default: 1000 20000)')
+    parser.add_argument(
+        '--records', type=int, nargs='+', default=[1, 10],
+        help='numbers of records per event (default: 1 10)')
+    parser.add_argument(
+        '--max-workers', type=int, nargs='+', default=[1, 4],
+        help='numbers of records analyzed concurrently (default: 1 4)')
+    parser.add_argument(
+        '--invocations', type=int, default=10,
+        help='number of invocations per combination (default: 10)')
+    parser.add_argument(
+        '--s3-latency', default='lognormal:15:0.5',
+        help='latency of Amazon S3 requests (default: lognormal:15:0.5)')
+    parser.add_argument(
+        '--comprehend-latency', default='lognormal:50:0.5',
+        help='latency of Amazon Comprehend requests '
+             '(default: lognormal:50:0.5)')
+    parser.add_argument(
+        '--throttle-rate', type=float, default=0.0,
+        help='probability that an Amazon Comprehend request is throttled '
+             '(default: 0)')
+    parser.add_argument(
+        '--response-scale', type=int, default=1,
+        help='number of times items in responses are repeated (default: 1)')
+    parser.add_argument(
+        '--env', nargs='*', default=[], metavar='NAME=VALUE',
+        help='environment variables of the Lambda function; '
+             'e.g., COMPREHEND_S3_RATE_LIMITS=default=1000')
+    parser.add_argument('--output', help='saves results in a JSON file')
+    parser.add_argument('--baseline', help='baseline JSON to compare with')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help='allowed slowdown relative to the baseline (default: 0.2)')
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(run_combination(json.loads(args.child))))
+        return 0
+    model = {
+        'Invocations': args.invocations,
+        'S3Latency': args.s3_latency,
+        'ComprehendLatency': args.comprehend_latency,
+        'ThrottleRate': args.throttle_rate,
+        'ResponseScale': args.response_scale,
+        'Env': parse_env(args.env)
+    }
+    results = []
+    for (trigger, document_bytes, records, max_workers) in itertools.product(
+            args.triggers, args.document_bytes, args.records, args.max_workers):
+        config = dict(model)
+        config.update({
+            'Trigger': trigger,
+            'DocumentBytes': document_bytes,
+            'Records': records,
+            'MaxWorkers': max_workers
+        })
+        print(
+            'measuring trigger=%s, documents=%d bytes, records=%d, '
+            'workers=%d' % (trigger, document_bytes, records, max_workers),
+            file=sys.stderr)
+        results.append(measure(config))
+    report = {'Model': model, 'Results': results}
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('regression: %s' % regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
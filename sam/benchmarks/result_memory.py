@@ -0,0 +1,74 @@
+"""
+Compares heap usage of analysis results held as nested dicts and as
+slotted result objects of ``lambda_function_4``.
+
+Builds copies of ``test/test-ref.json`` in both forms and measures the
+allocated memory with ``tracemalloc``.
+
+Usage (in the ``sam`` directory)::
+
+    python benchmarks/result_memory.py [--documents N]
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+
+
+SAM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SAM_DIR, 'src'))
+REFERENCE_PATH = os.path.join(
+    os.path.dirname(SAM_DIR), 'test', 'test-ref.json')
+
+import lambda_function_4  # noqa: E402
+
+
+def measure(build, documents):
+    """
+    Measures memory allocated by results built by a given function.
+
+    :type build: function
+    :param build: function that returns a new analysis result.
+    :type documents: int
+    :param documents: number of results to be built.
+    :rtype: int
+    :return: allocated memory in bytes.
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        results = [build() for _ in range(documents)]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del results
+    return after - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--documents', type=int, default=1000,
+        help='number of analysis results to be held (default: 1000)')
+    args = parser.parse_args()
+    with open(REFERENCE_PATH) as f:
+        # the source of the results is a JSON text
+        # so that strings are not shared among copies
+        reference = f.read()
+    builders = [
+        ('dict', lambda: json.loads(reference)),
+        ('Analysis', lambda: lambda_function_4.Analysis.from_dict(
+            json.loads(reference))),
+        ('columnar', lambda: lambda_function_4.encode_columnar(
+            json.loads(reference)))
+    ]
+    print('%-10s %14s %14s' % ('form', 'total bytes', 'bytes/doc'))
+    for (name, build) in builders:
+        size = measure(build, args.documents)
+        print('%-10s %14d %14.1f' % (name, size, float(size) / args.documents))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,717 @@
+"""
+Local stand-ins of Amazon S3 and Amazon Comprehend for benchmarks.
+
+Responses are made from ``test/test.txt`` and ``test/test-ref.json``.
+:py:func:`install` makes boto3 clients answer with them instead of
+calling AWS.
+If boto3 is installed, real clients are created and only their API calls
+are replaced, so that the costs of importing boto3 and creating clients
+are still measured.
+Otherwise minimal ``boto3`` and ``botocore.config`` modules are installed.
+
+:py:func:`configure` models latencies of requests, throttling of Amazon
+Comprehend, sizes of documents, sizes of responses and durations of
+asynchronous jobs.
+By default responses are immediate and documents are ``test/test.txt``.
+
+Objects under ``DOCUMENT_PREFIX`` ("inbox/") are documents made from
+``test/test.txt``.
+Objects written to the S3 stand-in are kept in ``OBJECTS`` and can be read
+back, listed and deleted; reading any other key fails with ``NoSuchKey``.
+So asynchronous jobs of Amazon Comprehend run end to end: a job reads its
+input file from ``OBJECTS`` and writes its output archive there when it is
+described ``JobSeconds`` after it was submitted.
+Requests are counted by operation in ``REQUEST_COUNTS``.
+Asynchronous invocations of Lambda functions are kept in ``INVOCATIONS``
+instead of being run, so that a benchmark can deliver them.
+"""
+import collections
+import copy
+import functools
+import importlib
+import importlib.abc
+import importlib.util
+import io
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import tarfile
+import threading
+import time
+import types
+
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+TEXT_PATH = os.path.join(REPOSITORY_DIR, 'test', 'test.txt')
+REFERENCE_PATH = os.path.join(REPOSITORY_DIR, 'test', 'test-ref.json')
+
+with open(TEXT_PATH, 'rb') as f:
+    TEXT = f.read()
+with open(REFERENCE_PATH) as f:
+    REFERENCE = json.load(f)
+
+
+def parse_latency(spec):
+    """
+    Parses a given latency distribution.
+
+    ``spec`` is one of the following,
+
+    * "none" or "0": no latency
+    * "fixed:MS": always ``MS`` milliseconds
+    * "uniform:MIN_MS:MAX_MS": uniformly distributed
+    * "lognormal:MEDIAN_MS:SIGMA": log-normally distributed, which has a
+      long tail like latencies of web services
+
+    :type spec: string
+    :param spec: latency distribution.
+    :rtype: function
+    :return: function that takes a ``random.Random`` and returns a latency
+        in seconds. ``None`` if there is no latency.
+    :raises ValueError: if ``spec`` is invalid.
+    """
+    if spec in (None, '', 'none', '0'):
+        return None
+    kind, _, args = spec.partition(':')
+    args = [float(arg) for arg in args.split(':') if arg]
+    if kind == 'fixed' and len(args) == 1:
+        return lambda rng: args[0] / 1000.0
+    if kind == 'uniform' and len(args) == 2:
+        return lambda rng: rng.uniform(args[0], args[1]) / 1000.0
+    if kind == 'lognormal' and len(args) == 2:
+        mu = math.log(args[0])
+        return lambda rng: rng.lognormvariate(mu, args[1]) / 1000.0
+    raise ValueError('invalid latency: %s' % spec)
+
+
+# model of the stand-ins updated by configure
+MODEL = {
+    # latency of a request to Amazon S3
+    'S3Latency': None,
+    # latency of a request to Amazon Comprehend
+    'ComprehendLatency': None,
+    # probability that a request to Amazon Comprehend is throttled
+    'ThrottleRate': 0.0,
+    # approximate size of a document in bytes; size of TEXT if None
+    'DocumentBytes': None,
+    # number of times items in a response are repeated
+    'ResponseScale': 1,
+    # seconds until an asynchronous job completes
+    'JobSeconds': 0.0
+}
+rng = random.Random(0)
+rng_lock = threading.Lock()
+
+# objects written to the S3 stand-in keyed by (bucket, key)
+OBJECTS = {}
+# asynchronous jobs keyed by job IDs
+JOBS = {}
+# pending multipart uploads keyed by upload IDs
+UPLOADS = {}
+# numbers of requests keyed by operation names
+REQUEST_COUNTS = collections.Counter()
+# events of asynchronous invocations of Lambda functions in order
+INVOCATIONS = []
+state_lock = threading.Lock()
+
+
+def configure(
+        s3_latency=None,
+        comprehend_latency=None,
+        throttle_rate=0.0,
+        document_bytes=None,
+        response_scale=1,
+        job_seconds=0.0,
+        seed=0):
+    """
+    Configures the model of the stand-ins.
+
+    :type s3_latency: string
+    :param s3_latency: latency distribution of Amazon S3 requests.
+        See :py:func:`parse_latency`.
+    :type comprehend_latency: string
+    :param comprehend_latency: latency distribution of Amazon Comprehend
+        requests.
+    :type throttle_rate: float
+    :param throttle_rate: probability that an Amazon Comprehend request
+        fails with ``ThrottlingException``.
+    :type document_bytes: int
+    :param document_bytes: approximate size of a document in bytes.
+        ``test/test.txt`` is repeated up to this size.
+    :type response_scale: int
+    :param response_scale: number of times items in an Amazon Comprehend
+        response are repeated.
+    :type job_seconds: float
+    :param job_seconds: seconds until an asynchronous job of Amazon
+        Comprehend completes.
+    :type seed: int
+    :param seed: seed of random numbers.
+    """
+    MODEL['S3Latency'] = parse_latency(s3_latency)
+    MODEL['ComprehendLatency'] = parse_latency(comprehend_latency)
+    MODEL['ThrottleRate'] = throttle_rate
+    MODEL['DocumentBytes'] = document_bytes
+    MODEL['ResponseScale'] = max(response_scale, 1)
+    MODEL['JobSeconds'] = job_seconds
+    rng.seed(seed)
+    make_document.cache_clear()
+
+
+def random_value():
+    with rng_lock:
+        return rng.random()
+
+
+def wait(latency):
+    """
+    Sleeps for a latency sampled from a given distribution.
+    """
+    if latency is not None:
+        with rng_lock:
+            seconds = latency(rng)
+        time.sleep(seconds)
+
+
+class StubClientError(Exception):
+    """
+    Stand-in of ``botocore.exceptions.ClientError`` used if boto3 is not
+    installed.
+    """
+    def __init__(self, error_response, operation_name):
+        super(StubClientError, self).__init__(
+            '%s: %s' % (operation_name, error_response['Error']['Code']))
+        self.response = error_response
+        self.operation_name = operation_name
+
+
+def raise_client_error(operation_name, code, message):
+    """
+    Raises a client error of a given operation.
+    """
+    try:
+        from botocore.exceptions import ClientError
+    except ImportError:
+        ClientError = StubClientError
+    raise ClientError(
+        {'Error': {'Code': code, 'Message': message}}, operation_name)
+
+
+def throttle(operation_name):
+    """
+    Raises ``ThrottlingException`` of a given operation.
+    """
+    raise_client_error(operation_name, 'ThrottlingException', 'Rate exceeded')
+
+
+@functools.lru_cache(maxsize=64)
+def make_document(key):
+    """
+    Makes the document of a given key.
+
+    The document begins with ``key`` so that documents of different keys
+    are not deduplicated by the cache of analysis results.
+    ``TEXT`` follows and is repeated up to ``MODEL['DocumentBytes']``.
+
+    :type key: string
+    :param key: key of the S3 object.
+    :rtype: bytes
+    :return: document.
+    """
+    document_bytes = MODEL['DocumentBytes']
+    if document_bytes is None:
+        return TEXT
+    header = (key + '\n').encode('utf-8')
+    repeats = int(math.ceil(float(document_bytes - len(header)) / len(TEXT)))
+    return header + TEXT * max(repeats, 1)
+
+
+class StubBody(object):
+    """
+    Stand-in of ``botocore.response.StreamingBody``.
+    """
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, amt=None):
+        return self.stream.read(amt)
+
+    def close(self):
+        self.stream.close()
+
+
+# prefix of keys of documents made by make_document unless written
+DOCUMENT_PREFIX = 'inbox/'
+
+
+def get_object(params):
+    with state_lock:
+        data = OBJECTS.get((params['Bucket'], params['Key']))
+    if data is None:
+        if not params['Key'].startswith(DOCUMENT_PREFIX):
+            raise_client_error('GetObject', 'NoSuchKey', params['Key'])
+        data = make_document(params['Key'])
+    response = {'ETag': '"stub"'}
+    if 'Range' in params:
+        start, end = params['Range'][len('bytes='):].split('-')
+        start, end = int(start), min(int(end), len(data) - 1)
+        response['ContentRange'] = 'bytes %d-%d/%d' % (start, end, len(data))
+        data = data[start:end + 1]
+    response['Body'] = StubBody(data)
+    response['ContentLength'] = len(data)
+    return response
+
+
+def detect_sentiment_result():
+    return {
+        'Sentiment': REFERENCE['Sentiment']['Sentiment'],
+        'SentimentScore': copy.deepcopy(REFERENCE['Sentiment']['SentimentScore'])
+    }
+
+
+def scale(items):
+    """
+    Repeats given items ``MODEL['ResponseScale']`` times.
+    """
+    return [copy.deepcopy(item) for item in items * MODEL['ResponseScale']]
+
+
+# makes the result of a single document for each detection
+DETECTIONS = {
+    'DominantLanguage': lambda: {
+        'Languages': [copy.deepcopy(REFERENCE['DominantLanguage'])]
+    },
+    'Entities': lambda: {
+        'Entities': scale(REFERENCE['Entities'])
+    },
+    'KeyPhrases': lambda: {
+        'KeyPhrases': scale(REFERENCE['KeyPhrases'])
+    },
+    'Sentiment': detect_sentiment_result,
+    'Syntax': lambda: {
+        'SyntaxTokens': scale(REFERENCE['SyntaxTokens'])
+    }
+}
+
+
+def read_body(params):
+    body = params['Body']
+    if not isinstance(body, bytes):
+        body = body.read()
+    return body
+
+
+def put_object(params):
+    with state_lock:
+        OBJECTS[(params['Bucket'], params['Key'])] = read_body(params)
+    return {'ETag': '"stub"'}
+
+
+upload_ids = itertools.count(1)
+
+
+def create_multipart_upload(params):
+    upload_id = 'stub-upload-%d' % next(upload_ids)
+    with state_lock:
+        UPLOADS[upload_id] = {}
+    return {'UploadId': upload_id}
+
+
+def upload_part(params):
+    with state_lock:
+        UPLOADS[params['UploadId']][params['PartNumber']] = read_body(params)
+    return {'ETag': '"stub-part-%d"' % params['PartNumber']}
+
+
+def complete_multipart_upload(params):
+    with state_lock:
+        parts = UPLOADS.pop(params['UploadId'])
+        OBJECTS[(params['Bucket'], params['Key'])] = b''.join(
+            parts[part['PartNumber']]
+            for part in params['MultipartUpload']['Parts'])
+    return {}
+
+
+def abort_multipart_upload(params):
+    with state_lock:
+        UPLOADS.pop(params['UploadId'], None)
+    return {}
+
+
+def list_objects_v2(params):
+    prefix = params.get('Prefix', '')
+    with state_lock:
+        contents = [
+            {'Key': key, 'Size': len(data)}
+            for ((bucket, key), data) in sorted(OBJECTS.items())
+            if bucket == params['Bucket'] and key.startswith(prefix)
+        ]
+    return {
+        'Contents': contents,
+        'KeyCount': len(contents),
+        'IsTruncated': False
+    }
+
+
+def delete_object(params):
+    with state_lock:
+        OBJECTS.pop((params['Bucket'], params['Key']), None)
+    return {}
+
+
+def split_s3_uri(uri):
+    """
+    Splits a given S3 URI into a bucket and a key.
+    """
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return (bucket, key)
+
+
+job_ids = itertools.count(1)
+
+
+def start_job(field, params):
+    """
+    Submits an asynchronous job of a given field; e.g., "Entities".
+    """
+    job_id = 'stub-job-%d' % next(job_ids)
+    with state_lock:
+        JOBS[job_id] = {
+            'Field': field,
+            'Status': 'IN_PROGRESS',
+            'SubmittedAt': time.time(),
+            'InputDataConfig': params['InputDataConfig'],
+            'OutputDataConfig': params['OutputDataConfig']
+        }
+    return {'JobId': job_id, 'JobStatus': 'SUBMITTED'}
+
+
+def write_job_output(job_id, job):
+    """
+    Writes the output archive of a completed job.
+
+    The archive has a result for each line of the input file, in the same
+    format as Amazon Comprehend.
+
+    :rtype: string
+    :return: S3 URI of the archive.
+    """
+    input_bucket, input_key = split_s3_uri(job['InputDataConfig']['S3Uri'])
+    with state_lock:
+        data = OBJECTS.get((input_bucket, input_key), b'')
+    file_name = os.path.basename(input_key)
+    results = []
+    for (i, line) in enumerate(data.decode('utf-8').split('\n')):
+        if not line:
+            continue
+        result = DETECTIONS[job['Field']]()
+        result.update({'File': file_name, 'Line': i})
+        results.append(json.dumps(result) + '\n')
+    body = ''.join(results).encode('utf-8')
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+        info = tarfile.TarInfo('output')
+        info.size = len(body)
+        tar.addfile(info, io.BytesIO(body))
+    bucket, prefix = split_s3_uri(job['OutputDataConfig']['S3Uri'])
+    key = '%s/000000000000-%s-%s/output/output.tar.gz' % (
+        prefix.rstrip('/'), job['Field'].upper(), job_id)
+    with state_lock:
+        OBJECTS[(bucket, key)] = archive.getvalue()
+    return 's3://%s/%s' % (bucket, key)
+
+
+def describe_job(field, params):
+    """
+    Describes an asynchronous job of a given field.
+
+    The job completes when it is described ``MODEL['JobSeconds']`` after
+    it was submitted.
+    """
+    operation_name = 'Describe%sDetectionJob' % field
+    with state_lock:
+        job = JOBS.get(params['JobId'])
+    if job is None or job['Field'] != field:
+        raise_client_error(
+            operation_name, 'JobNotFoundException', params['JobId'])
+    if (job['Status'] == 'IN_PROGRESS' and
+            time.time() - job['SubmittedAt'] >= MODEL['JobSeconds']):
+        job['OutputUri'] = write_job_output(params['JobId'], job)
+        job['Status'] = 'COMPLETED'
+    output_config = dict(job['OutputDataConfig'])
+    if job['Status'] == 'COMPLETED':
+        output_config['S3Uri'] = job['OutputUri']
+    return {
+        '%sDetectionJobProperties' % field: {
+            'JobId': params['JobId'],
+            'JobStatus': job['Status'],
+            'InputDataConfig': job['InputDataConfig'],
+            'OutputDataConfig': output_config
+        }
+    }
+
+
+# operations of the S3 stand-in that keep objects
+S3_OPERATIONS = {
+    'PutObject': put_object,
+    'CreateMultipartUpload': create_multipart_upload,
+    'UploadPart': upload_part,
+    'CompleteMultipartUpload': complete_multipart_upload,
+    'AbortMultipartUpload': abort_multipart_upload,
+    'ListObjectsV2': list_objects_v2,
+    'DeleteObject': delete_object
+}
+
+
+def respond(operation_name, params):
+    """
+    Returns the stub response of a given operation.
+
+    :type operation_name: string
+    :param operation_name: name of the operation; e.g., "GetObject".
+    :type params: dict
+    :param params: parameters of the operation.
+    :rtype: dict
+    :return: response of the operation.
+    """
+    with state_lock:
+        REQUEST_COUNTS[operation_name] += 1
+    if operation_name in ('GetObject', 'HeadObject', 'HeadBucket') or (
+            operation_name in S3_OPERATIONS):
+        wait(MODEL['S3Latency'])
+    elif 'Detect' in operation_name:
+        wait(MODEL['ComprehendLatency'])
+        if random_value() < MODEL['ThrottleRate']:
+            throttle(operation_name)
+    elif operation_name == 'ListEntityRecognizers':
+        wait(MODEL['ComprehendLatency'])
+    if operation_name == 'GetObject':
+        return get_object(params)
+    if operation_name == 'HeadObject':
+        return {
+            'ContentLength': len(make_document(params['Key'])),
+            'ETag': '"stub"',
+            'Metadata': {}
+        }
+    if operation_name in S3_OPERATIONS:
+        return S3_OPERATIONS[operation_name](params)
+    if operation_name == 'Invoke':
+        with state_lock:
+            INVOCATIONS.append(json.loads(params['Payload']))
+        return {'StatusCode': 202}
+    if operation_name.endswith('DetectionJob'):
+        if operation_name.startswith('Start'):
+            field = operation_name[len('Start'):-len('DetectionJob')]
+            return start_job(field, params)
+        if operation_name.startswith('Describe'):
+            field = operation_name[len('Describe'):-len('DetectionJob')]
+            return describe_job(field, params)
+    if operation_name.startswith('BatchDetect'):
+        detect = DETECTIONS[operation_name[len('BatchDetect'):]]
+        results = []
+        for i in range(len(params['TextList'])):
+            result = detect()
+            result['Index'] = i
+            results.append(result)
+        return {'ResultList': results, 'ErrorList': []}
+    if operation_name.startswith('Detect'):
+        return DETECTIONS[operation_name[len('Detect'):]]()
+    return {}
+
+
+def to_operation_name(method_name):
+    """
+    Converts a method name of a client into an operation name;
+    e.g., "get_object" into "GetObject".
+    """
+    return ''.join(word.capitalize() for word in method_name.split('_'))
+
+
+class StubConfig(object):
+    """
+    Stand-in of ``botocore.config.Config`` used if boto3 is not installed.
+    """
+    def __init__(self, **kwargs):
+        self.options = kwargs
+
+
+class StubClient(object):
+    """
+    Stand-in of a boto3 client used if boto3 is not installed.
+    """
+    def __init__(self, service_name):
+        self.service_name = service_name
+
+    def __getattr__(self, name):
+        operation_name = to_operation_name(name)
+        return lambda **params: respond(operation_name, params)
+
+
+def patch_botocore_client(module):
+    """
+    Replaces API calls of all the botocore clients with :py:func:`respond`.
+    """
+    module.BaseClient._make_api_call = (
+        lambda self, operation_name, params: respond(operation_name, params))
+
+
+class BotocoreClientFinder(importlib.abc.MetaPathFinder):
+    """
+    Patches ``botocore.client`` when it is imported.
+    """
+    def find_spec(self, fullname, path, target=None):
+        if fullname != 'botocore.client':
+            return None
+        sys.meta_path.remove(self)
+        spec = importlib.util.find_spec(fullname)
+        exec_module = spec.loader.exec_module
+        def exec_and_patch(module):
+            exec_module(module)
+            patch_botocore_client(module)
+        spec.loader.exec_module = exec_and_patch
+        return spec
+
+
+def install():
+    """
+    Makes boto3 clients answer with stub responses.
+
+    Must be called before boto3 is imported.
+    """
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-2')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'stub')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'stub')
+    if importlib.util.find_spec('boto3') is not None:
+        sys.meta_path.insert(0, BotocoreClientFinder())
+    else:
+        boto3 = types.ModuleType('boto3')
+        boto3.client = lambda service_name, **kwargs: StubClient(service_name)
+        sys.modules['boto3'] = boto3
+        botocore = types.ModuleType('botocore')
+        botocore.config = types.ModuleType('botocore.config')
+        botocore.config.Config = StubConfig
+        sys.modules['botocore'] = botocore
+        sys.modules['botocore.config'] = botocore.config
+
+
+def make_event(keys, bucket='learn-aws-lambda-comprehend-s3-bucket'):
+    """
+    Makes an S3 PUT event of given keys.
+
+    The size of each object is that of ``test/test.txt`` unless
+    ``MODEL['DocumentBytes']`` is configured.
+    """
+    return {
+        'Records': [
+            {
+                'eventSource': 'aws:s3',
+                'eventName': 'ObjectCreated:Put',
+                's3': {
+                    'bucket': {'name': bucket},
+                    'object': {'key': key, 'size': len(make_document(key))}
+                }
+            } for key in keys
+        ]
+    }
+
+
+class StubQueue(object):
+    """
+    Stand-in of an SQS queue and its event source mapping.
+
+    S3 event notifications sent to the queue are delivered as an SQS event
+    when ``batch_size`` messages are gathered or ``window_seconds`` has
+    passed since the first message was sent, whichever comes first.
+
+    :type batch_size: int
+    :param batch_size: maximum number of messages in an SQS event.
+    :type window_seconds: float
+    :param window_seconds: maximum time to gather messages.
+    """
+    def __init__(self, batch_size=10, window_seconds=0.0):
+        self.batch_size = batch_size
+        self.window_seconds = window_seconds
+        self.messages = []
+        self.first_sent = None
+        self.sent_count = 0
+
+    def send(self, notification):
+        """
+        Sends an S3 event notification to the queue.
+
+        :type notification: dict
+        :param notification: S3 event notification; e.g., a result of
+            :py:func:`make_event`.
+        """
+        if not self.messages:
+            self.first_sent = time.time()
+        self.sent_count += 1
+        self.messages.append({
+            'messageId': 'stub-message-%d' % self.sent_count,
+            'receiptHandle': 'stub-receipt-%d' % self.sent_count,
+            'body': json.dumps(notification),
+            'eventSource': 'aws:sqs'
+        })
+
+    def receive(self, force=False):
+        """
+        Returns an SQS event if messages are ready to be delivered.
+
+        :type force: bool
+        :param force: whether messages are delivered regardless of the
+            batch size and window.
+        :rtype: dict
+        :return: SQS event. ``None`` if no messages are ready.
+        """
+        ready = self.messages and (
+            force or
+            len(self.messages) >= self.batch_size or
+            time.time() - self.first_sent >= self.window_seconds)
+        if not ready:
+            return None
+        messages = self.messages[:self.batch_size]
+        self.messages = self.messages[self.batch_size:]
+        self.first_sent = self.messages and time.time() or None
+        return {'Records': messages}
+
+    def return_failures(self, event, response):
+        """
+        Puts messages reported in ``batchItemFailures`` back to the queue.
+
+        :type event: dict
+        :param event: delivered SQS event.
+        :type response: dict
+        :param response: partial batch response of the handler.
+        :rtype: int
+        :return: number of messages put back.
+        """
+        failed_ids = set(
+            failure['itemIdentifier']
+            for failure in response.get('batchItemFailures', []))
+        failed = [
+            message for message in event['Records']
+            if message['messageId'] in failed_ids
+        ]
+        if failed and not self.messages:
+            self.first_sent = time.time()
+        self.messages.extend(failed)
+        return len(failed)
+
+
+class StubContext(object):
+    """
+    Stand-in of a Lambda context.
+    """
+    def __init__(self, timeout_millis=300000):
+        import time
+        self.aws_request_id = 'stub-request-id'
+        self.invoked_function_arn = (
+            'arn:aws:lambda:us-east-2:000000000000:function:stub-function')
+        self.deadline = time.time() + timeout_millis / 1000.0
+
+    def get_remaining_time_in_millis(self):
+        import time
+        return max(int((self.deadline - time.time()) * 1000), 0)
@@ -1,8 +1,19 @@
 from __future__ import print_function
-import boto3
+import codecs
+import gzip
+import importlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
 import json
 import logging
 import os
+import random
+import re
+import sys
+import tarfile
+import threading
+import time
 import traceback
 
 
@@ -40,8 +51,1491 @@ OUTPUT_FOLDER = os.getenv(OUTPUT_FOLDER_ENV_NAME, DEFAULT_OUTPUT_FOLDER)
 OUTPUT_FOLDER = OUTPUT_FOLDER.rstrip('/')
 LOGGER.info('output bucket=%s, folder=%s', OUTPUT_BUCKET, OUTPUT_FOLDER)
 
-s3 = boto3.client('s3')
-comprehend = boto3.client('comprehend', region_name=COMPREHEND_REGION)
+# layout of output keys in the output folder
+# may be specified in the environment variable COMPREHEND_S3_OUTPUT_LAYOUT
+# "flat" by default
+# - "flat": name of the input object; e.g., "comprehend/report.json"
+#   inputs of the same name in different folders share an output
+# - "relative": path of the input object relative to the input folder;
+#   e.g., "comprehend/a/report.json" for "inbox/a/report.txt"
+# - "sharded": "relative" under a prefix of hex digits of the hash of the
+#   input key; e.g., "comprehend/3f/a/report.json"
+#   which spreads request load over prefixes
+# - "date": "relative" under date partitions of the event time;
+#   e.g., "comprehend/year=2019/month=01/day=04/a/report.json"
+OUTPUT_LAYOUT_ENV_NAME = 'COMPREHEND_S3_OUTPUT_LAYOUT'
+OUTPUT_LAYOUTS = ('flat', 'relative', 'sharded', 'date')
+DEFAULT_OUTPUT_LAYOUT = 'flat'
+OUTPUT_LAYOUT = os.getenv(OUTPUT_LAYOUT_ENV_NAME, DEFAULT_OUTPUT_LAYOUT)
+OUTPUT_LAYOUT = OUTPUT_LAYOUT in OUTPUT_LAYOUTS and OUTPUT_LAYOUT or DEFAULT_OUTPUT_LAYOUT
+
+# folder of input objects where relative paths of output keys begin
+# may be specified in the environment variable COMPREHEND_S3_INPUT_FOLDER
+# "inbox" by default
+# the whole key of an input object outside the folder is the relative path
+INPUT_FOLDER_ENV_NAME = 'COMPREHEND_S3_INPUT_FOLDER'
+DEFAULT_INPUT_FOLDER = 'inbox'
+INPUT_FOLDER = os.getenv(INPUT_FOLDER_ENV_NAME, DEFAULT_INPUT_FOLDER).strip('/')
+LOGGER.info('output layout=%s, input folder=%s', OUTPUT_LAYOUT, INPUT_FOLDER)
+
+# number of hex digits of a shard prefix in the "sharded" layout
+OUTPUT_SHARD_DIGITS = 2
+
+# format of the output
+# may be specified in the environment variable COMPREHEND_S3_OUTPUT_FORMAT
+# "json" by default
+# - "json": indented JSON (.json)
+# - "compact-json": JSON without whitespaces (.json)
+# - "json-gzip": compact JSON compressed with gzip (.json.gz)
+# - "columnar-json": compact JSON of the columnar representation
+#   (.columnar.json)
+# - "json-zstd": compact JSON compressed with Zstandard (.json.zst)
+#   requires the zstandard package
+# - "msgpack": MessagePack (.msgpack), requires the msgpack package
+# - "cbor": CBOR (.cbor), requires the cbor2 package
+OUTPUT_FORMAT_ENV_NAME = 'COMPREHEND_S3_OUTPUT_FORMAT'
+DEFAULT_OUTPUT_FORMAT = 'json'
+OUTPUT_FORMAT_MODULES = {
+    'json': None,
+    'compact-json': None,
+    'json-gzip': None,
+    'columnar-json': None,
+    'json-zstd': 'zstandard',
+    'msgpack': 'msgpack',
+    'cbor': 'cbor2'
+}
+OUTPUT_FORMAT = os.getenv(OUTPUT_FORMAT_ENV_NAME, DEFAULT_OUTPUT_FORMAT)
+OUTPUT_FORMAT = OUTPUT_FORMAT in OUTPUT_FORMAT_MODULES and OUTPUT_FORMAT or DEFAULT_OUTPUT_FORMAT
+if OUTPUT_FORMAT_MODULES[OUTPUT_FORMAT] is not None:
+    try:
+        importlib.import_module(OUTPUT_FORMAT_MODULES[OUTPUT_FORMAT])
+    except ImportError:
+        LOGGER.warning(
+            '%s requires %s, falling back to %s',
+            OUTPUT_FORMAT,
+            OUTPUT_FORMAT_MODULES[OUTPUT_FORMAT],
+            DEFAULT_OUTPUT_FORMAT)
+        OUTPUT_FORMAT = DEFAULT_OUTPUT_FORMAT
+LOGGER.info('output format=%s', OUTPUT_FORMAT)
+
+# maximum number of records analyzed concurrently
+# may be specified in the environment variable COMPREHEND_S3_MAX_WORKERS
+# 4 by default
+# records are processed one after another if 1 or less is given
+MAX_WORKERS_ENV_NAME = 'COMPREHEND_S3_MAX_WORKERS'
+DEFAULT_MAX_WORKERS = 4
+try:
+    MAX_WORKERS = int(os.getenv(MAX_WORKERS_ENV_NAME, DEFAULT_MAX_WORKERS))
+except ValueError:
+    MAX_WORKERS = DEFAULT_MAX_WORKERS
+MAX_WORKERS = max(MAX_WORKERS, 1)
+LOGGER.info('max workers=%d', MAX_WORKERS)
+
+# how records in an event are analyzed
+# may be specified in the environment variable COMPREHEND_S3_ANALYSIS_MODE
+# "single" by default
+# - "single": each record is analyzed with single-document detect_* APIs
+# - "batch": all the records are analyzed with BatchDetect* APIs
+ANALYSIS_MODE_ENV_NAME = 'COMPREHEND_S3_ANALYSIS_MODE'
+ANALYSIS_MODES = ('single', 'batch')
+DEFAULT_ANALYSIS_MODE = 'single'
+ANALYSIS_MODE = os.getenv(ANALYSIS_MODE_ENV_NAME, DEFAULT_ANALYSIS_MODE)
+ANALYSIS_MODE = ANALYSIS_MODE in ANALYSIS_MODES and ANALYSIS_MODE or DEFAULT_ANALYSIS_MODE
+LOGGER.info('analysis mode=%s', ANALYSIS_MODE)
+
+# maximum number of documents in a single BatchDetect* request
+BATCH_SIZE = 25
+
+# maximum number of records analyzed together by sqs_handler
+# may be specified in the environment variable COMPREHEND_S3_MICRO_BATCH_SIZE
+# 100 by default
+# records gathered from SQS messages are processed in micro-batches of this
+# size so that the texts in memory are bounded
+MICRO_BATCH_SIZE_ENV_NAME = 'COMPREHEND_S3_MICRO_BATCH_SIZE'
+DEFAULT_MICRO_BATCH_SIZE = 100
+try:
+    MICRO_BATCH_SIZE = int(
+        os.getenv(MICRO_BATCH_SIZE_ENV_NAME, DEFAULT_MICRO_BATCH_SIZE))
+except ValueError:
+    MICRO_BATCH_SIZE = DEFAULT_MICRO_BATCH_SIZE
+MICRO_BATCH_SIZE = max(MICRO_BATCH_SIZE, 1)
+LOGGER.info('micro-batch size=%d', MICRO_BATCH_SIZE)
+
+# extensions of input objects in which each line is a document
+# (JSON Lines)
+JSONL_EXTENSIONS = ('.jsonl', '.ndjson')
+
+# field of a JSON object line that has the text of a document
+# may be specified in the environment variable COMPREHEND_S3_JSONL_TEXT_FIELD
+# "text" by default
+# a line may also be a JSON string
+JSONL_TEXT_FIELD_ENV_NAME = 'COMPREHEND_S3_JSONL_TEXT_FIELD'
+DEFAULT_JSONL_TEXT_FIELD = 'text'
+JSONL_TEXT_FIELD = os.getenv(
+    JSONL_TEXT_FIELD_ENV_NAME, DEFAULT_JSONL_TEXT_FIELD)
+LOGGER.info('JSON Lines text field=%s', JSONL_TEXT_FIELD)
+
+# size in bytes of a part in which a JSON Lines output is uploaded
+# must be 5 MiB or more because of the limit of multipart uploads
+JSONL_PART_BYTES = 8 * 1024 * 1024
+
+# size in bytes of an input object above which it is analyzed by
+# asynchronous jobs of Amazon Comprehend instead of synchronous detections
+# may be specified in the environment variable
+# COMPREHEND_S3_ASYNC_THRESHOLD_BYTES
+# 0 by default, which disables asynchronous jobs
+ASYNC_THRESHOLD_BYTES_ENV_NAME = 'COMPREHEND_S3_ASYNC_THRESHOLD_BYTES'
+DEFAULT_ASYNC_THRESHOLD_BYTES = 0
+try:
+    ASYNC_THRESHOLD_BYTES = int(
+        os.getenv(ASYNC_THRESHOLD_BYTES_ENV_NAME, DEFAULT_ASYNC_THRESHOLD_BYTES))
+except ValueError:
+    ASYNC_THRESHOLD_BYTES = DEFAULT_ASYNC_THRESHOLD_BYTES
+
+# ARN of the IAM role that Amazon Comprehend assumes to read inputs and to
+# write outputs of asynchronous jobs
+# may be specified in the environment variable COMPREHEND_S3_ASYNC_ROLE_ARN
+# asynchronous jobs are disabled if omitted = None
+ASYNC_ROLE_ARN_ENV_NAME = 'COMPREHEND_S3_ASYNC_ROLE_ARN'
+ASYNC_ROLE_ARN = os.getenv(ASYNC_ROLE_ARN_ENV_NAME)
+
+# S3 prefix where inputs, outputs and pending jobs of asynchronous jobs are
+# saved
+# may be specified in the environment variable COMPREHEND_S3_ASYNC_LOCATION
+# like "s3://my-bucket/comprehend-async"
+# asynchronous jobs are disabled if omitted = None
+ASYNC_LOCATION_ENV_NAME = 'COMPREHEND_S3_ASYNC_LOCATION'
+ASYNC_LOCATION = os.getenv(ASYNC_LOCATION_ENV_NAME)
+ASYNC_LOCATION = ASYNC_LOCATION and ASYNC_LOCATION.startswith('s3://') and ASYNC_LOCATION.rstrip('/') or None
+LOGGER.info(
+    'async threshold bytes=%d, role=%s, location=%s',
+    ASYNC_THRESHOLD_BYTES,
+    ASYNC_ROLE_ARN,
+    ASYNC_LOCATION)
+
+# what the function returns
+# may be specified in the environment variable COMPREHEND_S3_RETURN_MODE
+# "analyses" by default
+# - "analyses": analysis results of all the records
+# - "summary": output locations of the records
+#   analysis results are released as soon as they are saved
+RETURN_MODE_ENV_NAME = 'COMPREHEND_S3_RETURN_MODE'
+RETURN_MODES = ('analyses', 'summary')
+DEFAULT_RETURN_MODE = 'analyses'
+RETURN_MODE = os.getenv(RETURN_MODE_ENV_NAME, DEFAULT_RETURN_MODE)
+RETURN_MODE = RETURN_MODE in RETURN_MODES and RETURN_MODE or DEFAULT_RETURN_MODE
+LOGGER.info('return mode=%s', RETURN_MODE)
+
+# maximum size of a text in bytes sent to a single detection
+# may be specified in the environment variable COMPREHEND_S3_MAX_CHUNK_BYTES
+# 5000 by default, which is the limit of DetectSentiment and DetectSyntax
+# a larger text is split into chunks at paragraph or sentence boundaries
+# at least MIN_CHUNK_BYTES so that any character fits in a chunk
+MAX_CHUNK_BYTES_ENV_NAME = 'COMPREHEND_S3_MAX_CHUNK_BYTES'
+DEFAULT_MAX_CHUNK_BYTES = 5000
+MIN_CHUNK_BYTES = 4
+try:
+    MAX_CHUNK_BYTES = int(
+        os.getenv(MAX_CHUNK_BYTES_ENV_NAME, DEFAULT_MAX_CHUNK_BYTES))
+except ValueError:
+    MAX_CHUNK_BYTES = DEFAULT_MAX_CHUNK_BYTES
+MAX_CHUNK_BYTES = max(MAX_CHUNK_BYTES, MIN_CHUNK_BYTES)
+LOGGER.info('max chunk bytes=%d', MAX_CHUNK_BYTES)
+
+# size of a part in bytes in which an S3 object is read
+# may be specified in the environment variable COMPREHEND_S3_READ_PART_BYTES
+# 8 MiB by default
+# parts of an object larger than this are read in parallel with ranged GETs
+READ_PART_BYTES_ENV_NAME = 'COMPREHEND_S3_READ_PART_BYTES'
+DEFAULT_READ_PART_BYTES = 8 * 1024 * 1024
+try:
+    READ_PART_BYTES = int(
+        os.getenv(READ_PART_BYTES_ENV_NAME, DEFAULT_READ_PART_BYTES))
+except ValueError:
+    READ_PART_BYTES = DEFAULT_READ_PART_BYTES
+READ_PART_BYTES = max(READ_PART_BYTES, 1)
+
+# maximum number of parts of an S3 object read concurrently
+# may be specified in the environment variable COMPREHEND_S3_READ_WORKERS
+# 4 by default
+READ_WORKERS_ENV_NAME = 'COMPREHEND_S3_READ_WORKERS'
+DEFAULT_READ_WORKERS = 4
+try:
+    READ_WORKERS = int(os.getenv(READ_WORKERS_ENV_NAME, DEFAULT_READ_WORKERS))
+except ValueError:
+    READ_WORKERS = DEFAULT_READ_WORKERS
+READ_WORKERS = max(READ_WORKERS, 1)
+LOGGER.info(
+    'read part bytes=%d, read workers=%d', READ_PART_BYTES, READ_WORKERS)
+
+# size of a piece in bytes read from a body stream at once
+READ_PIECE_BYTES = 64 * 1024
+
+# maximum number of analysis results cached in memory
+# may be specified in the environment variable COMPREHEND_S3_CACHE_SIZE
+# 128 by default
+# the cache is kept during warm invocations
+# in-memory caching is disabled if 0 or less is given
+CACHE_SIZE_ENV_NAME = 'COMPREHEND_S3_CACHE_SIZE'
+DEFAULT_CACHE_SIZE = 128
+try:
+    CACHE_SIZE = int(os.getenv(CACHE_SIZE_ENV_NAME, DEFAULT_CACHE_SIZE))
+except ValueError:
+    CACHE_SIZE = DEFAULT_CACHE_SIZE
+
+# memory allocated to the function in MB
+try:
+    FUNCTION_MEMORY_MB = int(os.getenv('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 128))
+except ValueError:
+    FUNCTION_MEMORY_MB = 128
+
+# maximum total size in bytes of analysis results cached in memory
+# may be specified in the environment variable COMPREHEND_S3_CACHE_BYTES
+# 1/16 of the memory allocated to the function by default
+# results are counted as compact JSON of the columnar representation
+# in-memory caching is disabled if 0 or less is given
+CACHE_BYTES_ENV_NAME = 'COMPREHEND_S3_CACHE_BYTES'
+DEFAULT_CACHE_BYTES = FUNCTION_MEMORY_MB * 1024 * 1024 // 16
+try:
+    CACHE_BYTES = int(os.getenv(CACHE_BYTES_ENV_NAME, DEFAULT_CACHE_BYTES))
+except ValueError:
+    CACHE_BYTES = DEFAULT_CACHE_BYTES
+
+# location where analysis results are persistently cached
+# may be specified in the environment variable COMPREHEND_S3_CACHE_LOCATION
+# either an S3 prefix like "s3://my-bucket/cache" or a local directory
+# like "/tmp/comprehend-cache"
+# no persistent cache if omitted = None
+CACHE_LOCATION_ENV_NAME = 'COMPREHEND_S3_CACHE_LOCATION'
+CACHE_LOCATION = os.getenv(CACHE_LOCATION_ENV_NAME)
+LOGGER.info(
+    'cache size=%d, bytes=%d, location=%s',
+    CACHE_SIZE,
+    CACHE_BYTES,
+    CACHE_LOCATION)
+
+# maximum total size in bytes of responses of detectors cached in memory
+# may be specified in the environment variable
+# COMPREHEND_S3_DETECTOR_CACHE_BYTES
+# 1/16 of the memory allocated to the function by default
+# the cache is kept during warm invocations
+# caching of responses is disabled if 0 or less is given
+DETECTOR_CACHE_BYTES_ENV_NAME = 'COMPREHEND_S3_DETECTOR_CACHE_BYTES'
+DEFAULT_DETECTOR_CACHE_BYTES = FUNCTION_MEMORY_MB * 1024 * 1024 // 16
+try:
+    DETECTOR_CACHE_BYTES = int(
+        os.getenv(DETECTOR_CACHE_BYTES_ENV_NAME, DEFAULT_DETECTOR_CACHE_BYTES))
+except ValueError:
+    DETECTOR_CACHE_BYTES = DEFAULT_DETECTOR_CACHE_BYTES
+
+# seconds for which a cached response of a detector is valid
+# may be specified in the environment variable
+# COMPREHEND_S3_DETECTOR_CACHE_TTL
+# 3600 seconds by default
+DETECTOR_CACHE_TTL_ENV_NAME = 'COMPREHEND_S3_DETECTOR_CACHE_TTL'
+DEFAULT_DETECTOR_CACHE_TTL = 3600.0
+try:
+    DETECTOR_CACHE_TTL = float(
+        os.getenv(DETECTOR_CACHE_TTL_ENV_NAME, DEFAULT_DETECTOR_CACHE_TTL))
+except ValueError:
+    DETECTOR_CACHE_TTL = DEFAULT_DETECTOR_CACHE_TTL
+LOGGER.info(
+    'detector cache bytes=%d, TTL=%.1fs',
+    DETECTOR_CACHE_BYTES,
+    DETECTOR_CACHE_TTL)
+
+# whether records whose analysis results are up to date are skipped
+# may be specified in the environment variable COMPREHEND_S3_SKIP_UP_TO_DATE
+# "true" by default
+# an output object is up to date if its metadata has the ETag (and version)
+# of the input object
+SKIP_UP_TO_DATE_ENV_NAME = 'COMPREHEND_S3_SKIP_UP_TO_DATE'
+DEFAULT_SKIP_UP_TO_DATE = 'true'
+SKIP_UP_TO_DATE = os.getenv(
+    SKIP_UP_TO_DATE_ENV_NAME, DEFAULT_SKIP_UP_TO_DATE).lower() != 'false'
+LOGGER.info('skip up-to-date=%s', SKIP_UP_TO_DATE)
+
+# location where outcomes of records are checkpointed
+# may be specified in the environment variable
+# COMPREHEND_S3_CHECKPOINT_LOCATION
+# either an S3 prefix like "s3://my-bucket/checkpoint" or a local directory
+# like "/tmp/comprehend-checkpoint"
+# records are not checkpointed if omitted = None
+CHECKPOINT_LOCATION_ENV_NAME = 'COMPREHEND_S3_CHECKPOINT_LOCATION'
+CHECKPOINT_LOCATION = os.getenv(CHECKPOINT_LOCATION_ENV_NAME)
+LOGGER.info('checkpoint location=%s', CHECKPOINT_LOCATION)
+
+# milliseconds kept before the deadline of an invocation
+# may be specified in the environment variable
+# COMPREHEND_S3_DEADLINE_MARGIN_MS
+# 10000 by default
+# a record is not started unless its estimated cost fits in the remaining
+# time of the invocation minus this margin
+DEADLINE_MARGIN_MS_ENV_NAME = 'COMPREHEND_S3_DEADLINE_MARGIN_MS'
+DEFAULT_DEADLINE_MARGIN_MS = 10000
+try:
+    DEADLINE_MARGIN_MS = int(
+        os.getenv(DEADLINE_MARGIN_MS_ENV_NAME, DEFAULT_DEADLINE_MARGIN_MS))
+except ValueError:
+    DEADLINE_MARGIN_MS = DEFAULT_DEADLINE_MARGIN_MS
+DEADLINE_MARGIN_MS = max(DEADLINE_MARGIN_MS, 0)
+
+# how lambda_handler continues records that were not started before the
+# deadline
+# may be specified in the environment variable COMPREHEND_S3_CONTINUATION
+# "invoke" by default
+# - "invoke": the function invokes itself asynchronously with the records
+# - "retry": the invocation fails so that Lambda retries the event
+# sqs_handler always reports the records as batch item failures
+CONTINUATION_ENV_NAME = 'COMPREHEND_S3_CONTINUATION'
+CONTINUATIONS = ('invoke', 'retry')
+DEFAULT_CONTINUATION = 'invoke'
+CONTINUATION = os.getenv(CONTINUATION_ENV_NAME, DEFAULT_CONTINUATION)
+CONTINUATION = CONTINUATION in CONTINUATIONS and CONTINUATION or DEFAULT_CONTINUATION
+LOGGER.info(
+    'deadline margin=%dms, continuation=%s',
+    DEADLINE_MARGIN_MS,
+    CONTINUATION)
+
+# timeouts in seconds of connections to AWS services
+# may be specified in the environment variables
+# COMPREHEND_S3_CONNECT_TIMEOUT and COMPREHEND_S3_READ_TIMEOUT
+# 5 and 60 seconds by default respectively
+CONNECT_TIMEOUT_ENV_NAME = 'COMPREHEND_S3_CONNECT_TIMEOUT'
+DEFAULT_CONNECT_TIMEOUT = 5.0
+try:
+    CONNECT_TIMEOUT = float(
+        os.getenv(CONNECT_TIMEOUT_ENV_NAME, DEFAULT_CONNECT_TIMEOUT))
+except ValueError:
+    CONNECT_TIMEOUT = DEFAULT_CONNECT_TIMEOUT
+READ_TIMEOUT_ENV_NAME = 'COMPREHEND_S3_READ_TIMEOUT'
+DEFAULT_READ_TIMEOUT = 60.0
+try:
+    READ_TIMEOUT = float(os.getenv(READ_TIMEOUT_ENV_NAME, DEFAULT_READ_TIMEOUT))
+except ValueError:
+    READ_TIMEOUT = DEFAULT_READ_TIMEOUT
+LOGGER.info(
+    'connect timeout=%.1f, read timeout=%.1f', CONNECT_TIMEOUT, READ_TIMEOUT)
+
+# maximum requests per second to each Amazon Comprehend API
+# may be specified in the environment variable COMPREHEND_S3_RATE_LIMITS
+# as comma separated "API=rate" pairs like
+# "DetectSentiment=10,BatchDetectSyntax=5"
+# an API not specified is limited to "default", which is 20 by default
+RATE_LIMITS_ENV_NAME = 'COMPREHEND_S3_RATE_LIMITS'
+DEFAULT_RATE_LIMIT = 20.0
+
+
+def parse_rate_limits(spec):
+    """
+    Parses comma separated "API=rate" pairs.
+
+    Malformed pairs and non-positive rates are ignored.
+
+    :rtype: dict
+    :return: maps an API name to its rate. Has "default".
+    """
+    rate_limits = {'default': DEFAULT_RATE_LIMIT}
+    for pair in spec.split(','):
+        api_name, _, rate = pair.partition('=')
+        try:
+            rate = float(rate)
+        except ValueError:
+            continue
+        if rate > 0:
+            rate_limits[api_name.strip()] = rate
+    return rate_limits
+
+
+RATE_LIMITS = parse_rate_limits(os.getenv(RATE_LIMITS_ENV_NAME, ''))
+LOGGER.info('rate limits=%s', RATE_LIMITS)
+
+# maximum number of attempts of an Amazon Comprehend request
+# may be specified in the environment variable COMPREHEND_S3_MAX_ATTEMPTS
+# 5 by default
+# a throttled or transiently failed request is retried with jittered
+# exponential backoff
+MAX_ATTEMPTS_ENV_NAME = 'COMPREHEND_S3_MAX_ATTEMPTS'
+DEFAULT_MAX_ATTEMPTS = 5
+try:
+    MAX_ATTEMPTS = int(os.getenv(MAX_ATTEMPTS_ENV_NAME, DEFAULT_MAX_ATTEMPTS))
+except ValueError:
+    MAX_ATTEMPTS = DEFAULT_MAX_ATTEMPTS
+MAX_ATTEMPTS = max(MAX_ATTEMPTS, 1)
+LOGGER.info('max attempts=%d', MAX_ATTEMPTS)
+
+# whether clients are created in background during the init phase
+# may be specified in the environment variable COMPREHEND_S3_PREWARM
+# "true" by default
+# clients are created at the first use if "false" is given
+# clients are never created in background outside the Lambda runtime,
+# which sets AWS_LAMBDA_FUNCTION_NAME, so that importing this module from
+# tools does not create clients
+PREWARM_ENV_NAME = 'COMPREHEND_S3_PREWARM'
+DEFAULT_PREWARM = 'true'
+PREWARM = os.getenv(PREWARM_ENV_NAME, DEFAULT_PREWARM).lower() != 'false'
+PREWARM = PREWARM and 'AWS_LAMBDA_FUNCTION_NAME' in os.environ
+LOGGER.info('prewarm=%s', PREWARM)
+
+# whether metrics of stages are emitted in CloudWatch Embedded Metric Format
+# may be specified in the environment variable COMPREHEND_S3_METRICS
+# "true" by default
+# no metric is measured if "false" is given
+METRICS_ENV_NAME = 'COMPREHEND_S3_METRICS'
+DEFAULT_METRICS = 'true'
+METRICS = os.getenv(METRICS_ENV_NAME, DEFAULT_METRICS).lower() != 'false'
+
+# namespace of metrics
+# may be specified in the environment variable COMPREHEND_S3_METRICS_NAMESPACE
+# "ComprehendS3" by default
+METRICS_NAMESPACE_ENV_NAME = 'COMPREHEND_S3_METRICS_NAMESPACE'
+DEFAULT_METRICS_NAMESPACE = 'ComprehendS3'
+METRICS_NAMESPACE = os.getenv(
+    METRICS_NAMESPACE_ENV_NAME, DEFAULT_METRICS_NAMESPACE)
+LOGGER.info('metrics=%s, namespace=%s', METRICS, METRICS_NAMESPACE)
+
+# fraction of invocations whose payloads and results are traced in full
+# may be specified in the environment variable COMPREHEND_S3_TRACE_SAMPLE_RATE
+# 1.0 if the logging level is DEBUG, otherwise 0.0 by default
+# traces are logged at INFO level
+TRACE_SAMPLE_RATE_ENV_NAME = 'COMPREHEND_S3_TRACE_SAMPLE_RATE'
+DEFAULT_TRACE_SAMPLE_RATE = LOGGING_LEVEL == 'DEBUG' and 1.0 or 0.0
+try:
+    TRACE_SAMPLE_RATE = float(
+        os.getenv(TRACE_SAMPLE_RATE_ENV_NAME, DEFAULT_TRACE_SAMPLE_RATE))
+except ValueError:
+    TRACE_SAMPLE_RATE = DEFAULT_TRACE_SAMPLE_RATE
+TRACE_SAMPLE_RATE = min(max(TRACE_SAMPLE_RATE, 0.0), 1.0)
+
+# maximum number of characters of a traced value
+# may be specified in the environment variable COMPREHEND_S3_TRACE_MAX_CHARS
+# 1000 by default
+TRACE_MAX_CHARS_ENV_NAME = 'COMPREHEND_S3_TRACE_MAX_CHARS'
+DEFAULT_TRACE_MAX_CHARS = 1000
+try:
+    TRACE_MAX_CHARS = int(
+        os.getenv(TRACE_MAX_CHARS_ENV_NAME, DEFAULT_TRACE_MAX_CHARS))
+except ValueError:
+    TRACE_MAX_CHARS = DEFAULT_TRACE_MAX_CHARS
+TRACE_MAX_CHARS = max(TRACE_MAX_CHARS, 0)
+
+# maximum number of items traced per list; e.g., entities
+# may be specified in the environment variable COMPREHEND_S3_TRACE_MAX_ITEMS
+# 20 by default
+TRACE_MAX_ITEMS_ENV_NAME = 'COMPREHEND_S3_TRACE_MAX_ITEMS'
+DEFAULT_TRACE_MAX_ITEMS = 20
+try:
+    TRACE_MAX_ITEMS = int(
+        os.getenv(TRACE_MAX_ITEMS_ENV_NAME, DEFAULT_TRACE_MAX_ITEMS))
+except ValueError:
+    TRACE_MAX_ITEMS = DEFAULT_TRACE_MAX_ITEMS
+TRACE_MAX_ITEMS = max(TRACE_MAX_ITEMS, 0)
+LOGGER.info(
+    'trace sample rate=%f, max chars=%d, max items=%d',
+    TRACE_SAMPLE_RATE,
+    TRACE_MAX_CHARS,
+    TRACE_MAX_ITEMS)
+
+# boto3 clients created at the first use
+# maps a service name to a client
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_max_pool_connections(service_name):
+    """
+    Returns the number of connections pooled for a given service.
+
+    The pool is large enough that no thread waits for a connection when
+    records are processed at the configured concurrency.
+
+    :type service_name: string
+    :param service_name: "s3" or "comprehend".
+    :rtype: int
+    :return: maximum number of pooled connections.
+    """
+    if service_name == 'comprehend':
+        # detections of all the records in flight
+        return DETECTIONS_PER_TEXT * MAX_WORKERS
+    # ranged reads and a put of all the records in flight
+    return (READ_WORKERS + 1) * MAX_WORKERS
+
+
+def create_client(service_name, **kwargs):
+    """
+    Creates a boto3 client of a given service with tuned connections.
+
+    The connection pool is sized by :py:func:`get_max_pool_connections`,
+    TCP keep-alive is enabled, and timeouts are taken from
+    ``COMPREHEND_S3_CONNECT_TIMEOUT`` and ``COMPREHEND_S3_READ_TIMEOUT``.
+    botocore makes only a single attempt of an Amazon Comprehend request
+    because :py:func:`call_comprehend` retries it.
+
+    :type service_name: string
+    :param service_name: name of the service; e.g., "s3".
+    :param kwargs: passed to ``boto3.client``.
+    :rtype: botocore.client.BaseClient
+    :return: client of ``service_name``.
+    """
+    import boto3
+    from botocore.config import Config
+    options = {
+        'max_pool_connections': get_max_pool_connections(service_name),
+        'connect_timeout': CONNECT_TIMEOUT,
+        'read_timeout': READ_TIMEOUT,
+        'tcp_keepalive': True
+    }
+    if service_name == 'comprehend':
+        # throttled and transiently failed requests are retried by
+        # call_comprehend() so that the rate limiter can see throttling
+        # max_attempts would count retries after the first attempt
+        options['retries'] = {'total_max_attempts': 1}
+    return boto3.client(service_name, config=Config(**options), **kwargs)
+
+
+def get_client(service_name, **kwargs):
+    """
+    Returns the boto3 client of a given service.
+
+    boto3 is imported and the client is created by
+    :py:func:`create_client` at the first call.
+    The client and its pooled connections are shared among all the threads
+    and warm invocations.
+
+    :type service_name: string
+    :param service_name: name of the service; e.g., "s3".
+    :param kwargs: passed to ``boto3.client`` at the first call.
+    :rtype: botocore.client.BaseClient
+    :return: client of ``service_name``.
+    """
+    with clients_lock:
+        client = clients.get(service_name)
+        if client is None:
+            client = create_client(service_name, **kwargs)
+            clients[service_name] = client
+        return client
+
+
+def get_s3():
+    """
+    Returns the S3 client.
+    """
+    return get_client('s3')
+
+
+def get_comprehend():
+    """
+    Returns the Amazon Comprehend client.
+    """
+    return get_client('comprehend', region_name=COMPREHEND_REGION)
+
+
+def prewarm_clients():
+    """
+    Creates the S3 and Amazon Comprehend clients.
+
+    Errors are logged and ignored because clients are created again at
+    the first use.
+    """
+    try:
+        get_s3()
+        get_comprehend()
+    except Exception as e:
+        LOGGER.warning('failed to prewarm clients: %s', e)
+
+
+# key of an event that asks the function to warm up
+WARM_UP_KEY = 'WarmUp'
+
+
+def is_warm_up_event(event):
+    """
+    Returns whether a given event is a keep-warm ping.
+
+    :type event: dict
+    :param event: event given to :py:func:`lambda_handler`.
+    :rtype: bool
+    :return: ``True`` if ``event`` has no ``Records`` and either has
+        ``WarmUp`` of JSON ``true`` or is a scheduled event of Amazon
+        EventBridge. Other values like ``"false"`` are not warm-ups.
+    """
+    if not isinstance(event, dict) or 'Records' in event:
+        return False
+    return event.get(WARM_UP_KEY) is True or (
+        event.get('source') == 'aws.events' and
+        event.get('detail-type') == 'Scheduled Event')
+
+
+def open_connections(request, count):
+    """
+    Opens pooled connections by concurrent requests.
+
+    An error response like ``AccessDenied`` is ignored because the
+    connection is open and kept in the pool once a response is received.
+
+    :type request: function
+    :param request: function that takes no arguments and sends a request.
+    :type count: int
+    :param count: number of concurrent requests.
+    :rtype: int
+    :return: number of requests that received responses.
+    """
+    def send(_):
+        try:
+            request()
+        except Exception as e:
+            if get_error_code(e) is None:
+                raise
+    outcomes = map_records(send, list(range(count)), max_workers=count)
+    for (_, error) in outcomes:
+        if error is not None:
+            LOGGER.warning('failed to open a connection: %s', error)
+    return len([error for (_, error) in outcomes if error is None])
+
+
+def warm_up(event):
+    """
+    Prepares the function for the next invocations.
+
+    The S3 and Amazon Comprehend clients are created, which imports boto3
+    and resolves the endpoints, and up to ``COMPREHEND_S3_MAX_WORKERS``
+    TLS connections to each service are opened and kept in the pools of
+    the clients.
+    Connections to S3 are opened by HeadBucket on ``Bucket`` in ``event``
+    or ``COMPREHEND_S3_OUTPUT_BUCKET``, because objects are requested at
+    the endpoint of their bucket; no connection is opened if neither is
+    given.
+    Connections to Amazon Comprehend are opened by ListEntityRecognizers,
+    which analyzes nothing.
+    The duration is measured as the stage "WarmUp".
+
+    :type event: dict
+    :param event: warm-up event.
+    :rtype: dict
+    :return: numbers of opened connections and the duration like the
+        following::
+
+            {
+                'WarmUp': True,
+                'Connections': {
+                    's3': 4,
+                    'comprehend': 4
+                },
+                'DurationMs': 123.4
+            }
+    """
+    started = time.time()
+    def prepare():
+        connections = OrderedDict()
+        s3 = get_s3()
+        bucket = event.get('Bucket') or OUTPUT_BUCKET
+        connections['s3'] = bucket and open_connections(
+            lambda: s3.head_bucket(Bucket=bucket), MAX_WORKERS) or 0
+        comprehend = get_comprehend()
+        connections['comprehend'] = open_connections(
+            lambda: comprehend.list_entity_recognizers(MaxResults=1),
+            MAX_WORKERS)
+        return connections
+    connections = stage_metrics.measure('WarmUp', prepare)
+    duration_ms = (time.time() - started) * 1000.0
+    LOGGER.info(
+        'warmed up in %.1fms: connections=%s',
+        duration_ms,
+        dict(connections))
+    stage_metrics.emit()
+    return {
+        'WarmUp': True,
+        'Connections': connections,
+        'DurationMs': duration_ms
+    }
+
+
+def get_error_code(error):
+    """
+    Returns the error code of a given botocore ``ClientError``.
+
+    :rtype: string
+    :return: error code of ``error``. ``None`` if ``error`` is not
+        a ``ClientError``.
+    """
+    return getattr(error, 'response', {}).get('Error', {}).get('Code')
+
+
+# maximum number of values of a metric in a single EMF document
+EMF_MAX_VALUES = 100
+
+
+class StageMetrics(object):
+    """
+    Metrics of stages in an invocation.
+
+    Durations and counts of stages and sizes of records are collected from
+    any thread and emitted by :py:meth:`emit` as log lines in CloudWatch
+    Embedded Metric Format (EMF).
+    Nothing is measured if ``enabled`` is ``False``.
+
+    :type namespace: string
+    :param namespace: CloudWatch namespace of the metrics.
+    :type enabled: bool
+    :param enabled: whether metrics are measured.
+    """
+    def __init__(self, namespace, enabled=True):
+        self.namespace = namespace
+        self.enabled = enabled
+        self.function_name = os.getenv('AWS_LAMBDA_FUNCTION_NAME', 'local')
+        # maps a stage to a list of durations in milliseconds
+        self.durations = OrderedDict()
+        # maps an input location to a dict of sizes in bytes
+        self.sizes = OrderedDict()
+        # maps a stage to a dict of counts
+        self.counts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add_duration(self, stage, seconds):
+        """
+        Adds a duration of a given stage.
+
+        :type stage: string
+        :param stage: name of the stage; e.g., "GetObject".
+        :type seconds: float
+        :param seconds: duration in seconds.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.durations.setdefault(stage, []).append(seconds * 1000.0)
+
+    def add_size(self, location, name, size):
+        """
+        Adds bytes to a size of a given record.
+
+        :type location: string
+        :param location: location of the input object of the record.
+        :type name: string
+        :param name: name of the size; "BytesIn" or "BytesOut".
+        :type size: int
+        :param size: bytes to be added.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            sizes = self.sizes.setdefault(location, {})
+            sizes[name] = sizes.get(name, 0) + size
+
+    def add_count(self, stage, name, count=1):
+        """
+        Adds to a count of a given stage.
+
+        :type stage: string
+        :param stage: name of the stage; e.g., "DetectEntities".
+        :type name: string
+        :param name: name of the count; e.g., "CacheHits".
+        :type count: int
+        :param count: number to be added.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            counts = self.counts.setdefault(stage, {})
+            counts[name] = counts.get(name, 0) + count
+
+    def measure(self, stage, func, *args, **kwargs):
+        """
+        Calls a given function and adds its duration to a given stage.
+
+        The duration is added even if ``func`` raises an exception.
+
+        :type stage: string
+        :param stage: name of the stage.
+        :type func: function
+        :param func: function to be called with ``args`` and ``kwargs``.
+        :return: return value of ``func``.
+        """
+        if not self.enabled:
+            return func(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.add_duration(stage, time.perf_counter() - started)
+
+    def measure_iter(self, stage, iterable):
+        """
+        Measures the time spent producing items of a given iterable.
+
+        The total time is added to ``stage`` as a single duration when the
+        iteration ends. Time spent by the consumer is not included.
+
+        :type stage: string
+        :param stage: name of the stage.
+        :type iterable: iterable
+        :param iterable: iterable to be measured.
+        :rtype: iterable
+        :return: iterable of the same items.
+            ``iterable`` itself if metrics are disabled.
+        """
+        if not self.enabled:
+            return iterable
+        def measured():
+            elapsed = 0.0
+            iterator = iter(iterable)
+            try:
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += time.perf_counter() - started
+                    yield item
+            finally:
+                self.add_duration(stage, elapsed)
+        return measured()
+
+    def count_iter(self, location, name, iterable):
+        """
+        Adds the total length of items of a given iterable to a size of
+        a given record.
+
+        :type location: string
+        :param location: location of the input object of the record.
+        :type name: string
+        :param name: name of the size.
+        :type iterable: iterable
+        :param iterable: iterable of ``bytes``.
+        :rtype: iterable
+        :return: iterable of the same items.
+            ``iterable`` itself if metrics are disabled.
+        """
+        if not self.enabled:
+            return iterable
+        def counted():
+            size = 0
+            try:
+                for item in iterable:
+                    size += len(item)
+                    yield item
+            finally:
+                self.add_size(location, name, size)
+        return counted()
+
+    def flush(self):
+        """
+        Builds EMF documents of the collected metrics and clears them.
+
+        A document is built for each stage, which has ``Duration`` with
+        dimensions ``FunctionName`` and ``Stage``.
+        Up to ``EMF_MAX_VALUES`` durations are put in a document.
+        A document is built for each stage that has counts, which has the
+        counts with dimensions ``FunctionName`` and ``Stage``.
+        A document is built for each record, which has ``BytesIn`` and
+        ``BytesOut`` with the dimension ``FunctionName``, and the location
+        of the input object in the property ``Input``.
+
+        :rtype: list
+        :return: list of EMF documents.
+        """
+        with self.lock:
+            durations, self.durations = self.durations, OrderedDict()
+            sizes, self.sizes = self.sizes, OrderedDict()
+            counts, self.counts = self.counts, OrderedDict()
+        timestamp = int(time.time() * 1000)
+        documents = []
+        for (stage, values) in durations.items():
+            for start in range(0, len(values), EMF_MAX_VALUES):
+                documents.append(self.build_document(
+                    timestamp,
+                    [['FunctionName', 'Stage']],
+                    [{'Name': 'Duration', 'Unit': 'Milliseconds'}],
+                    {
+                        'Stage': stage,
+                        'Duration': values[start:start + EMF_MAX_VALUES]
+                    }))
+        for (stage, stage_counts) in counts.items():
+            values = {'Stage': stage}
+            values.update(stage_counts)
+            documents.append(self.build_document(
+                timestamp,
+                [['FunctionName', 'Stage']],
+                [
+                    {'Name': name, 'Unit': 'Count'}
+                    for name in sorted(stage_counts)
+                ],
+                values))
+        for (location, record_sizes) in sizes.items():
+            values = {'Input': location}
+            values.update(record_sizes)
+            documents.append(self.build_document(
+                timestamp,
+                [['FunctionName']],
+                [
+                    {'Name': name, 'Unit': 'Bytes'}
+                    for name in sorted(record_sizes)
+                ],
+                values))
+        return documents
+
+    def build_document(self, timestamp, dimensions, metrics, values):
+        """
+        Builds an EMF document.
+
+        :type timestamp: int
+        :param timestamp: milliseconds since the epoch.
+        :type dimensions: list
+        :param dimensions: list of dimension sets.
+        :type metrics: list
+        :param metrics: list of metric definitions.
+        :type values: dict
+        :param values: values of the metrics and properties.
+        :rtype: dict
+        :return: EMF document.
+        """
+        document = {
+            '_aws': {
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [
+                    {
+                        'Namespace': self.namespace,
+                        'Dimensions': dimensions,
+                        'Metrics': metrics
+                    }
+                ]
+            },
+            'FunctionName': self.function_name
+        }
+        document.update(values)
+        return document
+
+    def emit(self):
+        """
+        Prints the collected metrics in EMF and clears them.
+
+        Each document is printed as a single line to the standard output,
+        from which CloudWatch Logs extracts metrics.
+        """
+        if not self.enabled:
+            return
+        for document in self.flush():
+            print(json.dumps(document, separators=(',', ':')))
+        sys.stdout.flush()
+
+
+# metrics of the current invocation
+stage_metrics = StageMetrics(METRICS_NAMESPACE, METRICS)
+
+
+class Tracer(object):
+    """
+    Traces payloads and results of sampled invocations.
+
+    :py:meth:`sample` decides whether the current invocation is traced.
+    Nothing is formatted nor iterated unless the invocation is traced,
+    so that tracing costs nothing otherwise.
+    Traced strings are truncated and traced lists are limited.
+
+    :type sample_rate: float
+    :param sample_rate: fraction of invocations to be traced.
+    :type max_chars: int
+    :param max_chars: maximum number of characters of a traced string.
+    :type max_items: int
+    :param max_items: maximum number of items traced per list.
+    """
+    def __init__(self, sample_rate, max_chars, max_items):
+        self.sample_rate = sample_rate
+        self.max_chars = max_chars
+        self.max_items = max_items
+        self.enabled = False
+
+    def sample(self):
+        """
+        Decides whether the current invocation is traced.
+
+        No invocation is traced if INFO logs are disabled.
+
+        :rtype: bool
+        :return: whether the current invocation is traced.
+        """
+        self.enabled = (
+            self.sample_rate > 0.0 and
+            LOGGER.isEnabledFor(logging.INFO) and
+            random.random() < self.sample_rate)
+        if self.enabled:
+            LOGGER.info('tracing this invocation')
+        return self.enabled
+
+    def truncate(self, value):
+        """
+        Truncates a given value if it is a long string.
+
+        :param value: value to be truncated.
+        :return: ``value`` truncated to ``max_chars`` characters followed by
+            the number of the omitted characters.
+            ``value`` itself if it is not a long string.
+        """
+        if isinstance(value, str) and len(value) > self.max_chars:
+            return '%s... (%d more characters)' % (
+                value[:self.max_chars], len(value) - self.max_chars)
+        return value
+
+    def trace(self, message, *args):
+        """
+        Logs a given message if the current invocation is traced.
+
+        String arguments are truncated.
+
+        :type message: string
+        :param message: format of the message.
+        :param args: arguments of ``message``.
+        """
+        if not self.enabled:
+            return
+        LOGGER.info(
+            'trace: ' + message, *[self.truncate(arg) for arg in args])
+
+    def trace_items(self, message, items, get_args):
+        """
+        Logs a message for each of given items if the current invocation is
+        traced.
+
+        At most ``max_items`` items are logged.
+
+        :type message: string
+        :param message: format of the message.
+        :type items: list
+        :param items: items to be traced.
+        :type get_args: function
+        :param get_args: function that takes an item and returns a tuple of
+            arguments of ``message``.
+        """
+        if not self.enabled:
+            return
+        for item in items[:self.max_items]:
+            self.trace(message, *get_args(item))
+        if len(items) > self.max_items:
+            self.trace('... (%d more items)', len(items) - self.max_items)
+
+
+# tracer of the current invocation
+tracer = Tracer(TRACE_SAMPLE_RATE, TRACE_MAX_CHARS, TRACE_MAX_ITEMS)
+
+
+# number of language dependent detections requested concurrently per text
+DETECTIONS_PER_TEXT = 4
+
+# thread pool that runs detections shared among all the records
+# created at the first use
+detector_executor = None
+detector_executor_lock = threading.Lock()
+
+
+def get_detector_executor():
+    """
+    Returns the thread pool that runs detections.
+
+    The pool is created at the first call and shared among all the records
+    and warm invocations.
+    It has enough threads to run all the detections of
+    ``COMPREHEND_S3_MAX_WORKERS`` records at once.
+
+    :rtype: concurrent.futures.ThreadPoolExecutor
+    :return: thread pool that runs detections.
+    """
+    global detector_executor
+    with detector_executor_lock:
+        if detector_executor is None:
+            detector_executor = ThreadPoolExecutor(
+                max_workers=DETECTIONS_PER_TEXT * MAX_WORKERS)
+        return detector_executor
+
+
+class RateLimiter(object):
+    """
+    Token bucket whose rate is adjusted by additive-increase /
+    multiplicative-decrease (AIMD).
+
+    The rate starts at ``max_rate``, is halved whenever a request is
+    throttled, and recovers by 5% of ``max_rate`` per successful request.
+    At most ``max_rate`` tokens are accumulated.
+
+    :type max_rate: float
+    :param max_rate: maximum requests per second.
+    """
+    # fraction of max_rate restored per success
+    INCREASE_RATIO = 0.05
+    # factor applied to the rate on throttling
+    DECREASE_FACTOR = 0.5
+    # lower bound of the rate relative to max_rate
+    MIN_RATE_RATIO = 0.05
+
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self.min_rate = max_rate * self.MIN_RATE_RATIO
+        self.rate = max_rate
+        self.tokens = max_rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttles = 0
+        self.wait_seconds = 0.0
+
+    def acquire(self):
+        """
+        Waits until a request is allowed.
+
+        :rtype: float
+        :return: seconds waited.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.max_rate,
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    self.requests += 1
+                    self.wait_seconds += waited
+                    return waited
+                delay = (1.0 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def on_success(self):
+        """
+        Increases the rate additively.
+        """
+        with self.lock:
+            self.rate = min(
+                self.max_rate, self.rate + self.max_rate * self.INCREASE_RATIO)
+
+    def on_throttle(self):
+        """
+        Decreases the rate multiplicatively and drops accumulated tokens.
+        """
+        with self.lock:
+            self.throttles += 1
+            self.rate = max(self.min_rate, self.rate * self.DECREASE_FACTOR)
+            self.tokens = min(self.tokens, 0.0)
+
+    def get_stats(self):
+        """
+        Returns statistics of this limiter.
+
+        :rtype: dict
+        :return: current rate, number of requests, number of throttles and
+            total seconds waited.
+        """
+        with self.lock:
+            return {
+                'Rate': self.rate,
+                'Requests': self.requests,
+                'Throttles': self.throttles,
+                'WaitSeconds': self.wait_seconds
+            }
+
+
+# rate limiters of Amazon Comprehend APIs
+# maps an API name to a RateLimiter
+# shared among all the threads and warm invocations
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+# error codes that mean a request is throttled
+THROTTLING_ERROR_CODES = (
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'Throttling',
+    'RequestLimitExceeded'
+)
+
+# error codes of Amazon Comprehend that may succeed on retry
+TRANSIENT_ERROR_CODES = (
+    'InternalServerException',
+    'InternalFailure',
+    'ServiceUnavailable',
+    'ServiceUnavailableException'
+)
+
+
+def is_transient_error(error):
+    """
+    Returns whether a given error of a request is worth retrying although
+    it is not throttling.
+
+    :type error: Exception
+    :param error: error raised from a request.
+    :rtype: bool
+    :return: ``True`` if ``error`` is an internal error or unavailability
+        of the service, or a failure of the connection.
+    """
+    if get_error_code(error) in TRANSIENT_ERROR_CODES:
+        return True
+    try:
+        from botocore.exceptions import ConnectionError, HTTPClientError
+    except ImportError:
+        return False
+    return isinstance(error, (ConnectionError, HTTPClientError))
+
+
+# base and maximum delays in seconds of exponential backoff
+BACKOFF_BASE_SECONDS = 0.1
+BACKOFF_MAX_SECONDS = 5.0
+
+
+def get_rate_limiter(api_name):
+    """
+    Returns the rate limiter of a given Amazon Comprehend API.
+
+    :type api_name: string
+    :param api_name: name of the API; e.g., "DetectSentiment".
+    :rtype: RateLimiter
+    :return: rate limiter limited by ``COMPREHEND_S3_RATE_LIMITS``.
+    """
+    with rate_limiters_lock:
+        limiter = rate_limiters.get(api_name)
+        if limiter is None:
+            limiter = RateLimiter(
+                RATE_LIMITS.get(api_name, RATE_LIMITS['default']))
+            rate_limiters[api_name] = limiter
+        return limiter
+
+
+def get_rate_limiter_stats():
+    """
+    Returns statistics of all the rate limiters.
+
+    :rtype: dict
+    :return: maps an API name to the result of
+        :py:meth:`RateLimiter.get_stats`.
+    """
+    with rate_limiters_lock:
+        limiters = list(rate_limiters.items())
+    return dict((name, limiter.get_stats()) for (name, limiter) in limiters)
+
+
+def call_comprehend(method_name, **params):
+    """
+    Calls an Amazon Comprehend API under its rate limiter.
+
+    A throttled request, or a request failed by
+    :py:func:`is_transient_error`, is retried up to
+    ``COMPREHEND_S3_MAX_ATTEMPTS`` attempts in total with exponential
+    backoff and full jitter.
+    Only throttling lowers the rate.
+    The duration including retries is measured as the stage named after
+    the API; e.g., "DetectSentiment".
+
+    :type method_name: string
+    :param method_name: name of the method of the client; e.g.,
+        "detect_sentiment".
+    :param params: parameters of the API.
+    :rtype: dict
+    :return: response of the API.
+    """
+    api_name = get_api_name(method_name)
+    return stage_metrics.measure(
+        api_name, call_rate_limited, api_name, method_name, params)
+
+
+def get_api_name(method_name):
+    """
+    Returns the name of the API of a given method of a client; e.g.,
+    "DetectSentiment" of "detect_sentiment".
+    """
+    return ''.join(word.capitalize() for word in method_name.split('_'))
+
+
+def call_rate_limited(api_name, method_name, params):
+    """
+    Calls an Amazon Comprehend API under its rate limiter.
+
+    :type api_name: string
+    :param api_name: name of the API; e.g., "DetectSentiment".
+    :type method_name: string
+    :param method_name: name of the method of the client.
+    :type params: dict
+    :param params: parameters of the API.
+    :rtype: dict
+    :return: response of the API.
+    :see also: :py:func:`call_comprehend`
+    """
+    limiter = get_rate_limiter(api_name)
+    method = getattr(get_comprehend(), method_name)
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            response = method(**params)
+        except Exception as e:
+            throttled = get_error_code(e) in THROTTLING_ERROR_CODES
+            if not throttled and not is_transient_error(e):
+                raise
+            reason = throttled and 'throttled' or 'failed transiently'
+            if throttled:
+                limiter.on_throttle()
+            attempt += 1
+            if attempt >= MAX_ATTEMPTS:
+                LOGGER.error('%s %s %d times', api_name, reason, attempt)
+                raise
+            delay = random.uniform(0, min(
+                BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+            LOGGER.warning(
+                '%s %s, retrying in %.3f seconds: %s',
+                api_name, reason, delay, e)
+            time.sleep(delay)
+            continue
+        limiter.on_success()
+        return response
+
+
+# bytes counted for an entry of the detector cache in addition to its
+# response, which approximate the key, the timestamp and the dict slot
+DETECTOR_CACHE_ENTRY_OVERHEAD = 256
+
+
+class DetectorCache(object):
+    """
+    In-memory cache of responses of Amazon Comprehend detectors.
+
+    A response is keyed by the name of the single-document API of the
+    detector, the language code and the SHA-256 digest of the text, and is
+    kept during warm invocations as compact JSON.
+    The total size of the entries, counting
+    :py:data:`DETECTOR_CACHE_ENTRY_OVERHEAD` per entry, never exceeds
+    ``budget_bytes``; the least recently used entries are evicted to make
+    room, and a response larger than the budget is not cached.
+    An entry expires ``ttl`` seconds after it is put.
+    Hits and misses are counted per API and added to the metrics of
+    stages as "CacheHits" and "CacheMisses".
+
+    :type budget_bytes: int
+    :param budget_bytes: maximum total size of entries in bytes.
+        Nothing is cached if 0 or less.
+    :type ttl: float
+    :param ttl: seconds for which an entry is valid.
+    """
+    def __init__(self, budget_bytes, ttl):
+        self.budget_bytes = budget_bytes
+        self.ttl = ttl
+        # maps a key to a tuple of the expiration time and JSON bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        # maps an API name to the number of hits or misses
+        self.hits = {}
+        self.misses = {}
+
+    def get_key(self, api_name, text, language_code):
+        digest = hashlib.sha256(text.encode(encoding='utf-8')).digest()
+        return (api_name, language_code or '', digest)
+
+    def get(self, api_name, text, language_code=None):
+        """
+        Returns the cached response of a detector.
+
+        :type api_name: string
+        :param api_name: name of the single-document API; e.g.,
+            "DetectEntities".
+        :type text: string
+        :param text: analyzed text.
+        :type language_code: string
+        :param language_code: language code given to the API. ``None`` for
+            "DetectDominantLanguage".
+        :return: cached response. ``None`` if it is not cached or expired.
+        """
+        if self.budget_bytes <= 0:
+            return None
+        key = self.get_key(api_name, text, language_code)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                self.remove(key)
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits[api_name] = self.hits.get(api_name, 0) + 1
+            else:
+                self.misses[api_name] = self.misses.get(api_name, 0) + 1
+        if entry is None:
+            stage_metrics.add_count(api_name, 'CacheMisses')
+            return None
+        stage_metrics.add_count(api_name, 'CacheHits')
+        return json.loads(entry[1].decode(encoding='utf-8'))
+
+    def put(self, api_name, text, language_code, response):
+        """
+        Caches a response of a detector.
+
+        :type api_name: string
+        :param api_name: name of the single-document API.
+        :type text: string
+        :param text: analyzed text.
+        :type language_code: string
+        :param language_code: language code given to the API.
+        :param response: response to be cached.
+        """
+        if self.budget_bytes <= 0:
+            return
+        data = json.dumps(response, separators=(',', ':')).encode('utf-8')
+        if len(data) + DETECTOR_CACHE_ENTRY_OVERHEAD > self.budget_bytes:
+            return
+        key = self.get_key(api_name, text, language_code)
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (time.time() + self.ttl, data)
+            self.size += len(data) + DETECTOR_CACHE_ENTRY_OVERHEAD
+            while self.size > self.budget_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        # the lock must be held
+        _, data = self.entries.pop(key)
+        self.size -= len(data) + DETECTOR_CACHE_ENTRY_OVERHEAD
+
+    def memoize(self, api_name, text, language_code, detect):
+        """
+        Returns the cached response of a detector, or calls a given
+        function and caches its response.
+
+        :type detect: function
+        :param detect: function that takes no arguments and returns the
+            response.
+        """
+        response = self.get(api_name, text, language_code)
+        if response is None:
+            response = detect()
+            self.put(api_name, text, language_code, response)
+        return response
+
+    def get_stats(self):
+        """
+        Returns the statistics of the cache.
+
+        :rtype: dict
+        :return: maps an API name to a dict of ``Hits``, ``Misses`` and
+            ``HitRate``, which are accumulated during warm invocations.
+        """
+        with self.lock:
+            hits = dict(self.hits)
+            misses = dict(self.misses)
+        stats = {}
+        for api_name in set(hits) | set(misses):
+            api_hits = hits.get(api_name, 0)
+            api_misses = misses.get(api_name, 0)
+            stats[api_name] = {
+                'Hits': api_hits,
+                'Misses': api_misses,
+                'HitRate': float(api_hits) / (api_hits + api_misses)
+            }
+        return stats
+
+
+# responses of detectors kept during warm invocations
+detector_cache = DetectorCache(DETECTOR_CACHE_BYTES, DETECTOR_CACHE_TTL)
 
 
 def detect_dominant_language(text):
@@ -61,12 +1555,13 @@ def detect_dominant_language(text):
 
     :see also: `Comprehend.Client.detect_dominant_language() <https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/comprehend.html#Comprehend.Client.detect_dominant_language>`_
     """
-    global comprehend
-    detection = comprehend.detect_dominant_language(Text=text)
-    languages = sorted(detection['Languages'], key=lambda x: -x['Score'])
-        # sorts languages in descending order of their Score
-        # because no ordering is documented
-    return languages[0]
+    def detect():
+        detection = call_comprehend('detect_dominant_language', Text=text)
+        languages = sorted(detection['Languages'], key=lambda x: -x['Score'])
+            # sorts languages in descending order of their Score
+            # because no ordering is documented
+        return languages[0]
+    return detector_cache.memoize('DetectDominantLanguage', text, None, detect)
 
 
 def detect_entities(text, language_code):
@@ -93,10 +1588,12 @@ def detect_entities(text, language_code):
 
     :see also: `Comprehend.Client.detect_entities() <https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/comprehend.html#Comprehend.Client.detect_entities>`_
     """
-    global comprehend
-    detection = comprehend.detect_entities(
-        Text=text, LanguageCode=language_code)
-    return detection['Entities']
+    def detect():
+        detection = call_comprehend(
+            'detect_entities', Text=text, LanguageCode=language_code)
+        return detection['Entities']
+    return detector_cache.memoize(
+        'DetectEntities', text, language_code, detect)
 
 
 def detect_key_phrases(text, language_code):
@@ -122,10 +1619,12 @@ def detect_key_phrases(text, language_code):
 
     :see also: `Comprehend.Client.detect_key_phrases() <https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/comprehend.html#Comprehend.Client.detect_key_phrases>`_
     """
-    global comprehend
-    detection = comprehend.detect_key_phrases(
-        Text=text, LanguageCode=language_code)
-    return detection['KeyPhrases']
+    def detect():
+        detection = call_comprehend(
+            'detect_key_phrases', Text=text, LanguageCode=language_code)
+        return detection['KeyPhrases']
+    return detector_cache.memoize(
+        'DetectKeyPhrases', text, language_code, detect)
 
 
 def detect_sentiment(text, language_code):
@@ -152,8 +1651,15 @@ def detect_sentiment(text, language_code):
 
     :see also: `Comprehend.Client.detect_sentiment() <https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/comprehend.html#Comprehend.Client.detect_sentiment>`_
     """
-    global comprehend
-    return comprehend.detect_sentiment(Text=text, LanguageCode=language_code)
+    def detect():
+        detection = call_comprehend(
+            'detect_sentiment', Text=text, LanguageCode=language_code)
+        return {
+            'Sentiment': detection['Sentiment'],
+            'SentimentScore': detection['SentimentScore']
+        }
+    return detector_cache.memoize(
+        'DetectSentiment', text, language_code, detect)
 
 
 def detect_syntax(text, language_code):
@@ -183,137 +1689,3779 @@ def detect_syntax(text, language_code):
 
     :see also: `Comprehend.Client.detect_syntax() <https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/comprehend.html#Comprehend.Client.detect_syntax>`_
     """
-    global comprehend
-    detection = comprehend.detect_syntax(Text=text, LanguageCode=language_code)
-    return detection['SyntaxTokens']
+    def detect():
+        detection = call_comprehend(
+            'detect_syntax', Text=text, LanguageCode=language_code)
+        return detection['SyntaxTokens']
+    return detector_cache.memoize('DetectSyntax', text, language_code, detect)
 
 
-def analyze_record(record):
+class BatchItemError(Exception):
     """
-    Analyzes Amazon Comprehend to a given S3 object.
+    Error reported for a single document in an ``ErrorList`` of
+    a BatchDetect* response.
 
-    :type record: dict
-    :param record: S3 object to be analyzed
-    :rtype: dict
-    :return: analysis results of ``record``,
-        which is similar to the following::
+    :type error_code: string
+    :param error_code: ``ErrorCode`` of the error.
+    :type error_message: string
+    :param error_message: ``ErrorMessage`` of the error.
+    """
+    def __init__(self, error_code, error_message):
+        super(BatchItemError, self).__init__(
+            '%s: %s' % (error_code, error_message))
+        self.error_code = error_code
+        self.error_message = error_message
+
+
+def split_batches(items, size=BATCH_SIZE):
+    """
+    Splits given items into chunks of at most a given size.
+
+    :type items: list
+    :param items: items to be split.
+    :type size: int
+    :param size: maximum number of items in a chunk.
+    :rtype: list
+    :return: list of chunks.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def collect_batch_results(response, count, extract):
+    """
+    Collects per-document results from a BatchDetect* response.
+
+    :type response: dict
+    :param response: response of a BatchDetect* API.
+    :type count: int
+    :param count: number of documents in the request.
+    :type extract: function
+    :param extract: function that takes an item in ``ResultList`` and
+        returns the result of the document.
+    :rtype: list
+    :return: list of ``(result, error)`` tuples in the same order as the
+        documents in the request, where ``error`` is a
+        :py:class:`BatchItemError` or ``None``.
+    """
+    outcomes = [
+        (None, BatchItemError('MissingResult', 'no result was returned'))
+        for _ in range(count)
+    ]
+    for item in response.get('ResultList', []):
+        outcomes[item['Index']] = (extract(item), None)
+    for item in response.get('ErrorList', []):
+        outcomes[item['Index']] = (
+            None, BatchItemError(item['ErrorCode'], item['ErrorMessage']))
+    return outcomes
+
+
+def batch_detect_dominant_language(texts):
+    """
+    Detects the dominant languages of given texts in batches.
+
+    :type texts: list
+    :param texts: texts to be analyzed.
+    :rtype: list
+    :return: list of ``(result, error)`` tuples in the same order as
+        ``texts``, where ``result`` is similar to the result of
+        :py:func:`detect_dominant_language`.
+
+    :see also: `Comprehend.Client.batch_detect_dominant_language() <https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/comprehend.html#Comprehend.Client.batch_detect_dominant_language>`_
+    """
+    def detect(batch):
+        response = call_comprehend(
+            'batch_detect_dominant_language', TextList=batch)
+        return collect_batch_results(
+            response,
+            len(batch),
+            lambda item: sorted(item['Languages'], key=lambda x: -x['Score'])[0])
+    outcomes = []
+    for batch in split_batches(texts):
+        outcomes.extend(batch_detect_cached(
+            'DetectDominantLanguage', batch, None, detect))
+    return outcomes
+
+
+# BatchDetect* APIs that depend on the language
+# each value is a tuple of the name of the API and a function that extracts
+# a result from an item in ResultList
+BATCH_DETECTORS = {
+    'Entities': (
+        'batch_detect_entities', lambda item: item['Entities']),
+    'KeyPhrases': (
+        'batch_detect_key_phrases', lambda item: item['KeyPhrases']),
+    'Sentiment': (
+        'batch_detect_sentiment',
+        lambda item: {
+            'Sentiment': item['Sentiment'],
+            'SentimentScore': item['SentimentScore']
+        }),
+    'SyntaxTokens': (
+        'batch_detect_syntax', lambda item: item['SyntaxTokens'])
+}
+
+
+def batch_detect(field, texts, language_code):
+    """
+    Runs a language dependent BatchDetect* API on given texts.
+
+    :type field: string
+    :param field: key of :py:data:`BATCH_DETECTORS` that chooses the API.
+    :type texts: list
+    :param texts: texts to be analyzed. Must be at most
+        :py:data:`BATCH_SIZE` texts.
+    :type language_code: string
+    :param language_code: language code common to ``texts``.
+    :rtype: list
+    :return: list of ``(result, error)`` tuples in the same order as
+        ``texts``.
+    """
+    method_name, extract = BATCH_DETECTORS[field]
+    def detect(batch):
+        response = call_comprehend(
+            method_name, TextList=batch, LanguageCode=language_code)
+        return collect_batch_results(response, len(batch), extract)
+    # shares cached responses with the single-document API
+    return batch_detect_cached(
+        get_api_name(method_name[len('batch_'):]),
+        texts,
+        language_code,
+        detect)
+
+
+def batch_detect_cached(api_name, texts, language_code, detect):
+    """
+    Runs a BatchDetect* API only on given texts whose responses are not
+    cached in :py:data:`detector_cache`.
+
+    :type api_name: string
+    :param api_name: name of the single-document API whose responses are
+        shared; e.g., "DetectEntities".
+    :type texts: list
+    :param texts: texts to be analyzed.
+    :type language_code: string
+    :param language_code: language code common to ``texts``.
+    :type detect: function
+    :param detect: function that takes a list of texts and returns a list of
+        ``(result, error)`` tuples in the same order.
+        Not called if all of ``texts`` are cached.
+        Called by :py:func:`detect_isolated`.
+    :rtype: list
+    :return: list of ``(result, error)`` tuples in the same order as
+        ``texts``.
+    """
+    outcomes = [
+        (detector_cache.get(api_name, text, language_code), None)
+        for text in texts
+    ]
+    misses = [i for (i, (result, _)) in enumerate(outcomes) if result is None]
+    if misses:
+        detected = detect_isolated(detect, [texts[i] for i in misses])
+        for (i, (result, error)) in zip(misses, detected):
+            if error is None:
+                detector_cache.put(api_name, texts[i], language_code, result)
+            outcomes[i] = (result, error)
+    return outcomes
+
+
+def detect_isolated(detect, texts):
+    """
+    Runs a BatchDetect* request and confines its failure to the texts that
+    cause it.
+
+    If the request fails as a whole, e.g., Amazon Comprehend rejects it
+    because of one invalid text, each text is requested alone so that only
+    the invalid ones fail.
+    A throttling or transient error that remains after retries is given to
+    all the texts instead, because requesting them one by one would fail in
+    the same way.
+
+    :type detect: function
+    :param detect: function that takes a list of texts and returns a list of
+        ``(result, error)`` tuples in the same order.
+    :type texts: list
+    :param texts: texts to be analyzed.
+    :rtype: list
+    :return: list of ``(result, error)`` tuples in the same order as
+        ``texts``, where ``error`` may be an exception of the request.
+    """
+    try:
+        return detect(texts)
+    except Exception as e:
+        throttled = get_error_code(e) in THROTTLING_ERROR_CODES
+        if len(texts) == 1 or throttled or is_transient_error(e):
+            return [(None, e) for _ in texts]
+        LOGGER.warning(
+            'batch of %d texts failed, requesting them one by one: %s',
+            len(texts),
+            e)
+    outcomes = []
+    for text in texts:
+        try:
+            outcomes.extend(detect([text]))
+        except Exception as e:
+            outcomes.append((None, e))
+    return outcomes
+
+
+# patterns of boundaries where a text is split into chunks
+# tried in order: paragraphs, sentences and words
+CHUNK_BOUNDARY_PATTERNS = (
+    re.compile(r'\n\s*\n'),
+    re.compile(u'(?<=[.!?\u3002\uff01\uff1f])\s+'),
+    re.compile(r'\s+')
+)
+
+
+def is_empty_text(text):
+    """
+    Returns whether a given text has nothing to be analyzed.
+
+    Amazon Comprehend rejects an empty or whitespace-only text.
+    """
+    return not text.strip()
+
+
+def get_byte_length(text):
+    """
+    Returns the length of a given text encoded in UTF-8.
+    """
+    return len(text.encode(encoding='utf-8'))
+
+
+def split_text(text, max_bytes=None, level=0):
+    """
+    Splits a given text into chunks that are at most a given size.
+
+    A text is split at paragraph boundaries first.
+    A paragraph larger than ``max_bytes`` is split at sentence boundaries,
+    a sentence larger than ``max_bytes`` is split at word boundaries,
+    and a word larger than ``max_bytes`` is split at character boundaries.
+    A character larger than ``max_bytes`` makes a chunk by itself.
+    Consecutive pieces are packed into a chunk as long as it fits in
+    ``max_bytes``.
+    Chunks consisting only of whitespaces are omitted.
+
+    :type text: string
+    :param text: text to be split.
+    :type max_bytes: int
+    :param max_bytes: maximum size of a chunk in bytes encoded in UTF-8.
+        ``COMPREHEND_S3_MAX_CHUNK_BYTES`` if omitted.
+    :type level: int
+    :param level: index of the first pattern in
+        :py:data:`CHUNK_BOUNDARY_PATTERNS` to try.
+    :rtype: list
+    :return: list of ``(offset, chunk)`` tuples, where ``offset`` is the
+        position of ``chunk`` in ``text`` in characters.
+    """
+    max_bytes = max_bytes or MAX_CHUNK_BYTES
+    if get_byte_length(text) <= max_bytes:
+        return text.strip() and [(0, text)] or []
+    if level < len(CHUNK_BOUNDARY_PATTERNS):
+        # each piece includes the following boundary
+        ends = [
+            match.end()
+            for match in CHUNK_BOUNDARY_PATTERNS[level].finditer(text)
+        ]
+        ends.append(len(text))
+        pieces = []
+        start = 0
+        for end in ends:
+            if end > start:
+                pieces.append((start, text[start:end]))
+                start = end
+    else:
+        pieces = [(i, c) for (i, c) in enumerate(text)]
+    chunks = []
+    def flush(start, end):
+        if text[start:end].strip():
+            chunks.append((start, text[start:end]))
+    chunk_start, chunk_end, chunk_bytes = 0, 0, 0
+    for (offset, piece) in pieces:
+        piece_bytes = get_byte_length(piece)
+        if chunk_bytes + piece_bytes > max_bytes:
+            flush(chunk_start, chunk_end)
+            chunk_start, chunk_bytes = offset, 0
+            if piece_bytes > max_bytes and (
+                    level >= len(CHUNK_BOUNDARY_PATTERNS)):
+                # a single character larger than max_bytes cannot be split
+                flush(offset, offset + len(piece))
+                chunk_start = chunk_end = offset + len(piece)
+                continue
+            if piece_bytes > max_bytes:
+                chunks.extend(
+                    (offset + o, c)
+                    for (o, c) in split_text(piece, max_bytes, level + 1))
+                chunk_start = chunk_end = offset + len(piece)
+                continue
+        chunk_end = offset + len(piece)
+        chunk_bytes += piece_bytes
+    flush(chunk_start, chunk_end)
+    return chunks
+
+
+def split_text_stream(pieces, max_bytes=None):
+    """
+    Splits a text given as a stream of pieces into chunks.
+
+    Works like :py:func:`split_text` but yields chunks as soon as enough
+    pieces arrive, so that a text can be split while it is being read.
+    Chunk boundaries may slightly differ from those of
+    :py:func:`split_text`.
+
+    :type pieces: iterable
+    :param pieces: pieces of a text.
+    :type max_bytes: int
+    :param max_bytes: maximum size of a chunk in bytes encoded in UTF-8.
+        ``COMPREHEND_S3_MAX_CHUNK_BYTES`` if omitted.
+    :rtype: generator
+    :return: generator of ``(offset, chunk)`` tuples, where ``offset`` is
+        the position of ``chunk`` in the entire text in characters.
+    """
+    max_bytes = max_bytes or MAX_CHUNK_BYTES
+    buffer = ''
+    base = 0
+    for piece in pieces:
+        buffer += piece
+        # a character takes at least 1 byte,
+        # so the buffer surely makes several chunks
+        if len(buffer) < 4 * max_bytes:
+            continue
+        chunks = split_text(buffer, max_bytes)
+        if not chunks:
+            base += len(buffer)
+            buffer = ''
+            continue
+        # the last chunk may continue to the next piece
+        for (offset, chunk) in chunks[:-1]:
+            yield (base + offset, chunk)
+        last_offset = chunks[-1][0]
+        base += last_offset
+        buffer = buffer[last_offset:]
+    for (offset, chunk) in split_text(buffer, max_bytes):
+        yield (base + offset, chunk)
+
+
+def shift_offsets(items, offset):
+    """
+    Shifts ``BeginOffset`` and ``EndOffset`` of given detection results.
+
+    :type items: list
+    :param items: entities, key phrases or syntax tokens detected in
+        a chunk.
+    :type offset: int
+    :param offset: position of the chunk in the document.
+    :rtype: list
+    :return: copies of ``items`` whose offsets are positions in the
+        document.
+    """
+    shifted = []
+    for item in items:
+        item = dict(item)
+        item['BeginOffset'] += offset
+        item['EndOffset'] += offset
+        shifted.append(item)
+    return shifted
+
+
+def merge_dominant_languages(languages, weights):
+    """
+    Merges dominant languages detected in chunks.
+
+    Scores are averaged with weights, and the language of the highest
+    averaged score is chosen.
+
+    :type languages: list
+    :param languages: results of :py:func:`detect_dominant_language` of
+        chunks.
+    :type weights: list
+    :param weights: lengths of chunks.
+    :rtype: dict
+    :return: dominant language of the document.
+    """
+    total_weight = float(sum(weights))
+    scores = {}
+    for (language, weight) in zip(languages, weights):
+        code = language['LanguageCode']
+        scores[code] = scores.get(code, 0.0) + language['Score'] * weight
+    code = max(scores, key=lambda c: scores[c])
+    return {
+        'LanguageCode': code,
+        'Score': scores[code] / total_weight
+    }
+
+
+def merge_sentiments(sentiments, weights):
+    """
+    Merges sentiments detected in chunks.
+
+    Sentiment scores are averaged with weights, and the sentiment of the
+    highest averaged score is chosen.
+
+    :type sentiments: list
+    :param sentiments: results of :py:func:`detect_sentiment` of chunks.
+    :type weights: list
+    :param weights: lengths of chunks.
+    :rtype: dict
+    :return: sentiment of the document.
+    """
+    total_weight = float(sum(weights))
+    scores = {}
+    for (sentiment, weight) in zip(sentiments, weights):
+        for (name, score) in sentiment['SentimentScore'].items():
+            scores[name] = scores.get(name, 0.0) + score * weight
+    scores = dict(
+        (name, score / total_weight) for (name, score) in scores.items())
+    return {
+        'Sentiment': max(scores, key=lambda n: scores[n]).upper(),
+        'SentimentScore': scores
+    }
+
+
+def merge_chunk_analyses(offsets, weights, analyses):
+    """
+    Merges analysis results of chunks into one of the document.
+
+    :type offsets: list
+    :param offsets: positions of chunks in the document.
+    :type weights: list
+    :param weights: lengths of chunks.
+    :type analyses: list
+    :param analyses: analysis results of chunks.
+    :rtype: dict
+    :return: analysis results of the document.
+        See :py:func:`analyze_text` for details.
+    """
+    entities = []
+    key_phrases = []
+    syntax_tokens = []
+    for (offset, analysis) in zip(offsets, analyses):
+        entities.extend(shift_offsets(analysis['Entities'], offset))
+        key_phrases.extend(shift_offsets(analysis['KeyPhrases'], offset))
+        syntax_tokens.extend(shift_offsets(analysis['SyntaxTokens'], offset))
+    for (i, token) in enumerate(syntax_tokens):
+        token['TokenId'] = i + 1
+    return {
+        'DominantLanguage': merge_dominant_languages(
+            [analysis['DominantLanguage'] for analysis in analyses], weights),
+        'Entities': entities,
+        'KeyPhrases': key_phrases,
+        'Sentiment': merge_sentiments(
+            [analysis['Sentiment'] for analysis in analyses], weights),
+        'SyntaxTokens': syntax_tokens
+    }
+
+
+def get_chunk_spans(chunks):
+    """
+    Converts given chunks into their spans.
+
+    :type chunks: iterable
+    :param chunks: ``(offset, chunk)`` tuples given by :py:func:`split_text`
+        or :py:func:`split_text_stream`.
+    :rtype: list
+    :return: list of ``(start, end)`` positions of the chunks in
+        characters. Each chunk is released as soon as its span is taken.
+    """
+    return [(offset, offset + len(chunk)) for (offset, chunk) in chunks]
+
+
+def analyze_long_text(text, spans=None):
+    """
+    Analyzes a text larger than ``COMPREHEND_S3_MAX_CHUNK_BYTES``.
+
+    ``text`` is split by :py:func:`split_text` unless ``spans`` is given.
+    The dominant language of the document is determined from those of the
+    chunks, and then all the chunks are analyzed in the language with
+    BatchDetect* APIs.
+    Results of the chunks are merged by :py:func:`merge_chunk_analyses`.
+    Chunks are sliced from ``text`` only for the batch being requested, so
+    that no copy of the whole text is made.
+
+    :type text: string
+    :param text: text to be analyzed.
+    :type spans: list
+    :param spans: ``(start, end)`` positions of the chunks of ``text``
+        already split; e.g., by :py:func:`get_chunk_spans`. Optional.
+    :rtype: dict
+    :return: analysis results of ``text``.
+        See :py:func:`analyze_text` for details.
+    :raises BatchItemError: if analysis of any chunk fails.
+    """
+    global LOGGER
+    if spans is None:
+        spans = get_chunk_spans(split_text(text))
+    if not spans:
+        raise BatchItemError('EmptyText', 'no text to be analyzed')
+    LOGGER.info('analyzing %d chunks', len(spans))
+    offsets = [start for (start, _) in spans]
+    weights = [end - start for (start, end) in spans]
+    batches = split_batches(list(range(len(spans))))
+    def slice_batch(indices):
+        return [text[spans[i][0]:spans[i][1]] for i in indices]
+    languages = []
+    for indices in batches:
+        for (language, error) in batch_detect_dominant_language(
+                slice_batch(indices)):
+            if error is not None:
+                raise error
+            languages.append(language)
+    language_code = merge_dominant_languages(
+        languages, weights)['LanguageCode']
+    analyses = [{'DominantLanguage': language} for language in languages]
+    executor = get_detector_executor()
+    futures = []
+    for indices in batches:
+        for field in BATCH_DETECTORS:
+            # slices the batch in the worker so that only batches in flight
+            # are copied
+            futures.append((field, indices, executor.submit(
+                lambda field, indices: batch_detect(
+                    field, slice_batch(indices), language_code),
+                field,
+                indices)))
+    for (field, indices, future) in futures:
+        for (i, (result, error)) in zip(indices, future.result()):
+            if error is not None:
+                raise error
+            analyses[i][field] = result
+    return merge_chunk_analyses(offsets, weights, analyses)
+
+
+def analyze_texts(texts):
+    """
+    Analyzes given texts with BatchDetect* APIs of Amazon Comprehend.
+
+    Dominant languages of all the texts are detected first.
+    Then the texts are grouped by their languages, and the other detections
+    are requested for each chunk of at most :py:data:`BATCH_SIZE` texts
+    concurrently.
+    Texts larger than ``COMPREHEND_S3_MAX_CHUNK_BYTES`` are analyzed by
+    :py:func:`analyze_long_text` instead.
+    Empty or whitespace-only texts fail with ``EmptyText`` without being
+    requested.
+    A failed request affects only the texts in it, see
+    :py:func:`detect_isolated`.
+
+    :type texts: list
+    :param texts: texts to be analyzed.
+    :rtype: list
+    :return: list of ``(analysis, error)`` tuples in the same order as
+        ``texts``, where ``analysis`` has the same form as the result of
+        :py:func:`analyze_text`, and ``error`` is a
+        :py:class:`BatchItemError`, an exception of the request or ``None``.
+    """
+    global LOGGER
+    empty_indices = [i for (i, text) in enumerate(texts) if is_empty_text(text)]
+    if empty_indices:
+        # Amazon Comprehend would reject the whole request of an empty text
+        outcomes = dict(
+            (i, (None, BatchItemError('EmptyText', 'no text to be analyzed')))
+            for i in empty_indices)
+        other_indices = [i for i in range(len(texts)) if i not in outcomes]
+        other_outcomes = other_indices and analyze_texts(
+            [texts[i] for i in other_indices]) or []
+        outcomes.update(zip(other_indices, other_outcomes))
+        return [outcomes[i] for i in range(len(texts))]
+    long_indices = [
+        i for (i, text) in enumerate(texts)
+        if get_byte_length(text) > MAX_CHUNK_BYTES
+    ]
+    if long_indices:
+        long_outcomes = {}
+        for i in long_indices:
+            try:
+                long_outcomes[i] = (analyze_long_text(texts[i]), None)
+            except Exception as e:
+                long_outcomes[i] = (None, e)
+        short_indices = [
+            i for i in range(len(texts)) if i not in long_outcomes
+        ]
+        short_outcomes = short_indices and analyze_texts(
+            [texts[i] for i in short_indices]) or []
+        outcomes = dict(zip(short_indices, short_outcomes))
+        outcomes.update(long_outcomes)
+        return [outcomes[i] for i in range(len(texts))]
+    LOGGER.info('detecting dominant languages of %d texts', len(texts))
+    tracer.trace_items('input: %s', texts, lambda text: (text,))
+    languages = batch_detect_dominant_language(texts)
+    analyses = [
+        error is None and {'DominantLanguage': language} or None
+        for (language, error) in languages
+    ]
+    errors = [error for (_, error) in languages]
+    # groups texts by their languages
+    groups = {}
+    for (i, (language, error)) in enumerate(languages):
+        if error is None:
+            groups.setdefault(language['LanguageCode'], []).append(i)
+    LOGGER.info(
+        'detecting entities, key phrases, sentiment and syntax in %d languages',
+        len(groups))
+    executor = get_detector_executor()
+    futures = []
+    for (language_code, indices) in groups.items():
+        for batch in split_batches(indices):
+            batch_texts = [texts[i] for i in batch]
+            for field in BATCH_DETECTORS:
+                futures.append((field, batch, executor.submit(
+                    batch_detect, field, batch_texts, language_code)))
+    for (field, batch, future) in futures:
+        for (i, (result, error)) in zip(batch, future.result()):
+            if errors[i] is not None:
+                continue
+            if error is not None:
+                analyses[i] = None
+                errors[i] = error
+            else:
+                analyses[i][field] = result
+    return list(zip(analyses, errors))
+
+
+def trace_analysis(entities, key_phrases, sentiment, syntax_tokens):
+    """
+    Traces given analysis results if the current invocation is traced.
+
+    :type entities: list
+    :param entities: result of :py:func:`detect_entities`.
+    :type key_phrases: list
+    :param key_phrases: result of :py:func:`detect_key_phrases`.
+    :type sentiment: dict
+    :param sentiment: result of :py:func:`detect_sentiment`.
+    :type syntax_tokens: list
+    :param syntax_tokens: result of :py:func:`detect_syntax`.
+    """
+    if not tracer.enabled:
+        return
+    tracer.trace_items(
+        '[%s] %s', entities, lambda entity: (entity['Type'], entity['Text']))
+    tracer.trace_items(
+        'Key Phrase=%s (Score=%f)',
+        key_phrases,
+        lambda phrase: (phrase['Text'], phrase['Score']))
+    tracer.trace(
+        'Sentiment=%s (Score=%f)',
+        sentiment['Sentiment'],
+        sentiment['SentimentScore'][sentiment['Sentiment'].capitalize()])
+    tracer.trace_items(
+        '[%s] %s (Score=%f)',
+        syntax_tokens,
+        lambda token: (
+            token['PartOfSpeech']['Tag'],
+            token['Text'],
+            token['PartOfSpeech']['Score']))
+
+
+def analyze_text(text, spans=None):
+    """
+    Analyzes a given text with Amazon Comprehend.
+
+    The dominant language of ``text`` is detected first, and then the other
+    detections that depend on the detected language are requested
+    concurrently.
+    A text larger than ``COMPREHEND_S3_MAX_CHUNK_BYTES`` is analyzed by
+    :py:func:`analyze_long_text` instead.
+
+    :type text: string
+    :param text: text to be analyzed
+    :type spans: list
+    :param spans: ``(start, end)`` positions of the chunks of ``text``
+        already split. Used only if ``text`` is larger than
+        ``COMPREHEND_S3_MAX_CHUNK_BYTES``. Optional.
+    :rtype: dict
+    :return: analysis results of ``text``,
+        which is similar to the following::
 
             {
-                'DominangLanguage': result of detect_dominant_language(),
+                'DominantLanguage': result of detect_dominant_language(),
                 'Entities': result of detect_entities(),
                 'KeyPhrases': result of detect_key_phrases(),
                 'Sentiment': result of detect_sentiment(),
-                'SyntaxToken': result of detect_syntax()
+                'SyntaxTokens': result of detect_syntax()
+            }
+
+    :raises BatchItemError: if ``text`` is empty or whitespace only.
+    :see also:
+        * :py:func:`detect_dominant_language()`
+        * :py:func:`detect_entities()`
+        * :py:func:`detect_key_phrases()`
+        * :py:func:`detect_sentiment()`
+        * :py:func:`detect_syntax()`
+    """
+    global LOGGER
+    tracer.trace('input: %s', text)
+    if is_empty_text(text):
+        raise BatchItemError('EmptyText', 'no text to be analyzed')
+    if get_byte_length(text) > MAX_CHUNK_BYTES:
+        return analyze_long_text(text, spans)
+    LOGGER.info('detecting dominant language')
+    dominant_language = detect_dominant_language(text)
+    tracer.trace(
+        'Language=%s (Score=%f)',
+        dominant_language['LanguageCode'],
+        dominant_language['Score'])
+    language_code = dominant_language['LanguageCode']
+        # subsequent analyses depend on the detected language
+    LOGGER.info('detecting entities, key phrases, sentiment and syntax')
+    executor = get_detector_executor()
+    futures = [
+        executor.submit(detect, text, language_code) for detect in (
+            detect_entities,
+            detect_key_phrases,
+            detect_sentiment,
+            detect_syntax)
+    ]
+    entities, key_phrases, sentiment, syntax_tokens = [
+        future.result() for future in futures
+    ]
+    trace_analysis(entities, key_phrases, sentiment, syntax_tokens)
+    return {
+        'DominantLanguage': dominant_language,
+        'Entities': entities,
+        'KeyPhrases': key_phrases,
+        'Sentiment': sentiment,
+        'SyntaxTokens': syntax_tokens
+    }
+
+
+class DominantLanguage(object):
+    """
+    Dominant language of a text.
+
+    :see also: :py:func:`detect_dominant_language`
+    """
+    __slots__ = ('language_code', 'score')
+
+    def __init__(self, language_code, score):
+        self.language_code = sys.intern(language_code)
+        self.score = score
+
+    @classmethod
+    def from_response(cls, response):
+        """
+        Creates an instance from an element of ``Languages`` of
+        a DetectDominantLanguage response.
+        """
+        return cls(response['LanguageCode'], response['Score'])
+
+    def to_dict(self):
+        return {
+            'LanguageCode': self.language_code,
+            'Score': self.score
+        }
+
+
+class Entity(object):
+    """
+    Entity in a text.
+
+    :see also: :py:func:`detect_entities`
+    """
+    __slots__ = ('score', 'type', 'text', 'begin_offset', 'end_offset')
+
+    def __init__(self, score, type, text, begin_offset, end_offset):
+        self.score = score
+        self.type = sys.intern(type)
+        self.text = text
+        self.begin_offset = begin_offset
+        self.end_offset = end_offset
+
+    @classmethod
+    def from_response(cls, response):
+        """
+        Creates an instance from an element of ``Entities`` of
+        a DetectEntities response.
+        """
+        return cls(
+            response['Score'],
+            response['Type'],
+            response['Text'],
+            response['BeginOffset'],
+            response['EndOffset'])
+
+    def to_dict(self):
+        return {
+            'Score': self.score,
+            'Type': self.type,
+            'Text': self.text,
+            'BeginOffset': self.begin_offset,
+            'EndOffset': self.end_offset
+        }
+
+
+class KeyPhrase(object):
+    """
+    Key phrase in a text.
+
+    :see also: :py:func:`detect_key_phrases`
+    """
+    __slots__ = ('score', 'text', 'begin_offset', 'end_offset')
+
+    def __init__(self, score, text, begin_offset, end_offset):
+        self.score = score
+        self.text = text
+        self.begin_offset = begin_offset
+        self.end_offset = end_offset
+
+    @classmethod
+    def from_response(cls, response):
+        """
+        Creates an instance from an element of ``KeyPhrases`` of
+        a DetectKeyPhrases response.
+        """
+        return cls(
+            response['Score'],
+            response['Text'],
+            response['BeginOffset'],
+            response['EndOffset'])
+
+    def to_dict(self):
+        return {
+            'Score': self.score,
+            'Text': self.text,
+            'BeginOffset': self.begin_offset,
+            'EndOffset': self.end_offset
+        }
+
+
+class Sentiment(object):
+    """
+    Sentiment of a text.
+
+    ``ResponseMetadata`` of a response is not kept.
+
+    :see also: :py:func:`detect_sentiment`
+    """
+    __slots__ = ('sentiment', 'positive', 'negative', 'neutral', 'mixed')
+
+    def __init__(self, sentiment, positive, negative, neutral, mixed):
+        self.sentiment = sys.intern(sentiment)
+        self.positive = positive
+        self.negative = negative
+        self.neutral = neutral
+        self.mixed = mixed
+
+    @classmethod
+    def from_response(cls, response):
+        """
+        Creates an instance from a DetectSentiment response.
+        """
+        scores = response['SentimentScore']
+        return cls(
+            response['Sentiment'],
+            scores['Positive'],
+            scores['Negative'],
+            scores['Neutral'],
+            scores['Mixed'])
+
+    def to_dict(self):
+        return {
+            'Sentiment': self.sentiment,
+            'SentimentScore': {
+                'Positive': self.positive,
+                'Negative': self.negative,
+                'Neutral': self.neutral,
+                'Mixed': self.mixed
+            }
+        }
+
+
+class SyntaxToken(object):
+    """
+    Syntax token in a text.
+
+    :see also: :py:func:`detect_syntax`
+    """
+    __slots__ = (
+        'token_id', 'text', 'begin_offset', 'end_offset', 'tag', 'score')
+
+    def __init__(self, token_id, text, begin_offset, end_offset, tag, score):
+        self.token_id = token_id
+        self.text = text
+        self.begin_offset = begin_offset
+        self.end_offset = end_offset
+        self.tag = sys.intern(tag)
+        self.score = score
+
+    @classmethod
+    def from_response(cls, response):
+        """
+        Creates an instance from an element of ``SyntaxTokens`` of
+        a DetectSyntax response.
+        """
+        part_of_speech = response['PartOfSpeech']
+        return cls(
+            response['TokenId'],
+            response['Text'],
+            response['BeginOffset'],
+            response['EndOffset'],
+            part_of_speech['Tag'],
+            part_of_speech['Score'])
+
+    def to_dict(self):
+        return {
+            'TokenId': self.token_id,
+            'Text': self.text,
+            'BeginOffset': self.begin_offset,
+            'EndOffset': self.end_offset,
+            'PartOfSpeech': {
+                'Tag': self.tag,
+                'Score': self.score
+            }
+        }
+
+
+class Analysis(object):
+    """
+    Analysis result of a text.
+
+    Holds results in slotted objects instead of nested dicts to save
+    memory.
+    """
+    __slots__ = (
+        'dominant_language',
+        'entities',
+        'key_phrases',
+        'sentiment',
+        'syntax_tokens')
+
+    def __init__(
+            self,
+            dominant_language,
+            entities,
+            key_phrases,
+            sentiment,
+            syntax_tokens):
+        self.dominant_language = dominant_language
+        self.entities = entities
+        self.key_phrases = key_phrases
+        self.sentiment = sentiment
+        self.syntax_tokens = syntax_tokens
+
+    @classmethod
+    def from_dict(cls, analysis):
+        """
+        Creates an instance from a result of :py:func:`analyze_text`.
+        """
+        return cls(
+            DominantLanguage.from_response(analysis['DominantLanguage']),
+            [Entity.from_response(e) for e in analysis['Entities']],
+            [KeyPhrase.from_response(p) for p in analysis['KeyPhrases']],
+            Sentiment.from_response(analysis['Sentiment']),
+            [SyntaxToken.from_response(t) for t in analysis['SyntaxTokens']])
+
+    def to_dict(self):
+        """
+        Converts this result into the form of :py:func:`analyze_text`.
+        """
+        return {
+            'DominantLanguage': self.dominant_language.to_dict(),
+            'Entities': [e.to_dict() for e in self.entities],
+            'KeyPhrases': [p.to_dict() for p in self.key_phrases],
+            'Sentiment': self.sentiment.to_dict(),
+            'SyntaxTokens': [t.to_dict() for t in self.syntax_tokens]
+        }
+
+
+def to_serializable(obj):
+    """
+    Converts a result object into a dict.
+
+    Given to encoders as a hook for objects they cannot serialize, so that
+    each object is converted only while it is being encoded.
+
+    :raises TypeError: if ``obj`` is not a result object.
+    """
+    if isinstance(obj, (
+            Analysis,
+            DominantLanguage,
+            Entity,
+            KeyPhrase,
+            Sentiment,
+            SyntaxToken)):
+        return obj.to_dict()
+    raise TypeError('%r is not serializable' % obj)
+
+
+def as_dict(analysis):
+    """
+    Returns a given analysis result as a dict.
+
+    :type analysis: Analysis or dict
+    :param analysis: analysis result.
+    :rtype: dict
+    :return: ``analysis`` if it is a dict, otherwise ``analysis.to_dict()``.
+    """
+    if isinstance(analysis, Analysis):
+        return analysis.to_dict()
+    return analysis
+
+
+# columns of per-item detection results in the columnar representation
+# each column is a tuple of the path to a value in an item and the kind of
+# the column
+# - "number": array of values
+# - "category": dictionary-encoded values
+# - "text": array of texts, omitted if the source text is given
+# - "id": array of IDs, omitted if IDs are sequential from 1
+COLUMNAR_FIELDS = {
+    'Entities': (
+        (('Score',), 'number'),
+        (('Type',), 'category'),
+        (('Text',), 'text'),
+        (('BeginOffset',), 'number'),
+        (('EndOffset',), 'number')
+    ),
+    'KeyPhrases': (
+        (('Score',), 'number'),
+        (('Text',), 'text'),
+        (('BeginOffset',), 'number'),
+        (('EndOffset',), 'number')
+    ),
+    'SyntaxTokens': (
+        (('TokenId',), 'id'),
+        (('Text',), 'text'),
+        (('BeginOffset',), 'number'),
+        (('EndOffset',), 'number'),
+        (('PartOfSpeech', 'Tag'), 'category'),
+        (('PartOfSpeech', 'Score'), 'number')
+    )
+}
+
+# version of the columnar representation
+COLUMNAR_VERSION = 1
+
+
+def has_columnar_shape(item, columns):
+    """
+    Returns whether a given item consists exactly of given columns.
+    """
+    shape = {}
+    for (path, _) in columns:
+        shape.setdefault(path[0], set())
+        if len(path) > 1:
+            shape[path[0]].add(path[1])
+    if set(item.keys()) != set(shape.keys()):
+        return False
+    for (name, children) in shape.items():
+        if children and (
+                not isinstance(item[name], dict) or
+                set(item[name].keys()) != children):
+            return False
+    return True
+
+
+def encode_columns(items, columns, text=None):
+    """
+    Encodes given per-item detection results into columns.
+
+    :type items: list
+    :param items: entities, key phrases or syntax tokens.
+    :type columns: tuple
+    :param columns: columns in :py:data:`COLUMNAR_FIELDS`.
+    :type text: string
+    :param text: source text of ``items``. Optional.
+    :rtype: dict
+    :return: columns of ``items``. ``items`` as they are if any item does not
+        fit in ``columns``.
+    """
+    if not all(has_columnar_shape(item, columns) for item in items):
+        return items
+    encoded = {'Count': len(items)}
+    for (path, kind) in columns:
+        values = []
+        for item in items:
+            value = item
+            for name in path:
+                value = value[name]
+            values.append(value)
+        name = '.'.join(path)
+        if kind == 'category':
+            dictionary = []
+            codes = {}
+            for value in values:
+                if value not in codes:
+                    codes[value] = len(dictionary)
+                    dictionary.append(value)
+            encoded[name] = {
+                'Dictionary': dictionary,
+                'Codes': [codes[value] for value in values]
+            }
+        elif kind == 'text' and text is not None and all(
+                text[item['BeginOffset']:item['EndOffset']] == value
+                for (item, value) in zip(items, values)):
+            continue
+        elif kind == 'id' and values == list(range(1, len(values) + 1)):
+            continue
+        else:
+            encoded[name] = values
+    return encoded
+
+
+def decode_columns(encoded, columns, text=None):
+    """
+    Decodes columns encoded by :py:func:`encode_columns`.
+
+    :type encoded: dict
+    :param encoded: columns of per-item detection results.
+    :type columns: tuple
+    :param columns: columns in :py:data:`COLUMNAR_FIELDS`.
+    :type text: string
+    :param text: source text. Required if texts are omitted.
+    :rtype: list
+    :return: entities, key phrases or syntax tokens.
+    :raises ValueError: if texts are omitted but ``text`` is not given.
+    """
+    if isinstance(encoded, list):
+        return encoded
+    count = encoded['Count']
+    items = [{} for _ in range(count)]
+    for (path, kind) in columns:
+        name = '.'.join(path)
+        if name in encoded:
+            values = encoded[name]
+            if kind == 'category':
+                dictionary = values['Dictionary']
+                values = [dictionary[code] for code in values['Codes']]
+        elif kind == 'text':
+            if text is None:
+                raise ValueError('source text is necessary to decode %s' % name)
+            values = [
+                text[begin:end] for (begin, end) in zip(
+                    encoded['BeginOffset'], encoded['EndOffset'])
+            ]
+        elif kind == 'id':
+            values = list(range(1, count + 1))
+        for (item, value) in zip(items, values):
+            for parent in path[:-1]:
+                item = item.setdefault(parent, {})
+            item[path[-1]] = value
+    return items
+
+
+def encode_columnar(analysis, text=None):
+    """
+    Converts a given analysis result into the columnar representation.
+
+    Entities, key phrases and syntax tokens are converted into parallel
+    arrays of offsets and scores, and dictionary-encoded types and tags.
+    Texts of them are omitted if ``text`` is given.
+
+    :type analysis: dict
+    :param analysis: analysis result returned by :py:func:`analyze_text`.
+    :type text: string
+    :param text: source text of ``analysis``. Optional.
+    :rtype: dict
+    :return: columnar representation of ``analysis``.
+        :py:func:`decode_columnar` restores ``analysis``.
+    """
+    columnar = {'ColumnarVersion': COLUMNAR_VERSION}
+    for (field, value) in analysis.items():
+        if field in COLUMNAR_FIELDS:
+            value = encode_columns(value, COLUMNAR_FIELDS[field], text)
+        columnar[field] = value
+    return columnar
+
+
+def decode_columnar(columnar, text=None):
+    """
+    Restores an analysis result from the columnar representation.
+
+    :type columnar: dict
+    :param columnar: result of :py:func:`encode_columnar`.
+    :type text: string
+    :param text: source text. Required if ``columnar`` was encoded with
+        the source text.
+    :rtype: dict
+    :return: analysis result equal to the one given to
+        :py:func:`encode_columnar`.
+    """
+    analysis = {}
+    for (field, value) in columnar.items():
+        if field == 'ColumnarVersion':
+            continue
+        if field in COLUMNAR_FIELDS:
+            value = decode_columns(value, COLUMNAR_FIELDS[field], text)
+        analysis[field] = value
+    return analysis
+
+
+# detections included in an analysis result
+# a part of cache keys so that cached results are invalidated when
+# the detections change
+DETECTOR_SET = 'DominantLanguage,Entities,KeyPhrases,Sentiment,SyntaxTokens'
+
+
+def get_cache_key(text):
+    """
+    Returns the cache key of a given text.
+
+    :type text: string
+    :param text: text to be analyzed.
+    :rtype: string
+    :return: SHA-256 hex digest of ``text`` and :py:data:`DETECTOR_SET`.
+    """
+    digest = hashlib.sha256(DETECTOR_SET.encode(encoding='utf-8'))
+    digest.update(b'\0')
+    digest.update(text.encode(encoding='utf-8'))
+    return digest.hexdigest()
+
+
+class FileCacheStore(object):
+    """
+    Persistent store of JSON objects in a local directory.
+
+    Each object is saved as a JSON file named after its key.
+    Useful under ``/tmp`` which survives warm invocations.
+    Stores cached analysis results and checkpoints.
+
+    :type directory: string
+    :param directory: path to the directory where objects are saved.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_path(self, key):
+        return os.path.join(self.directory, '%s.json' % key)
+
+    def get(self, key):
+        """
+        Returns the analysis result associated with a given key.
+
+        :rtype: dict
+        :return: cached analysis result. ``None`` if ``key`` is not cached.
+        """
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                return json.loads(f.read().decode(encoding='utf-8'))
+        except (IOError, OSError):
+            return None
+
+    def put(self, key, analysis):
+        """
+        Associates a given analysis result with a given key.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # writes to a temporary file and renames it
+        # so that no reader sees a partial file
+        path = self.get_path(key)
+        temp_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(temp_path, 'wb') as f:
+            f.write(json.dumps(analysis).encode(encoding='utf-8'))
+        os.rename(temp_path, path)
+
+    def list_keys(self):
+        """
+        Returns the keys of all the saved objects.
+
+        :rtype: list
+        :return: keys in no particular order.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except (IOError, OSError):
+            return []
+        return [
+            name[:-len('.json')] for name in names if name.endswith('.json')
+        ]
+
+    def delete(self, key):
+        """
+        Deletes the object associated with a given key if any.
+        """
+        try:
+            os.remove(self.get_path(key))
+        except (IOError, OSError):
+            pass
+
+
+class S3CacheStore(object):
+    """
+    Persistent store of JSON objects under an S3 prefix.
+
+    Each object is saved as an S3 object named after its key.
+    Stores cached analysis results and checkpoints.
+    The function needs ``s3:GetObject`` and ``s3:PutObject`` permissions
+    on the prefix.
+    Without ``s3:ListBucket`` permission, S3 reports a missing object as
+    403 instead of 404, so 403 is also treated as a missing object.
+
+    :type bucket: string
+    :param bucket: name of the bucket where objects are saved.
+    :type prefix: string
+    :param prefix: folder where objects are saved.
+    """
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+
+    def get_key(self, key):
+        return '%s/%s.json' % (self.prefix, key)
+
+    def get(self, key):
+        """
+        Returns the analysis result associated with a given key.
+
+        :rtype: dict
+        :return: cached analysis result. ``None`` if ``key`` is not cached.
+        """
+        try:
+            obj = get_s3().get_object(
+                Bucket=self.bucket, Key=self.get_key(key))
+        except Exception as e:
+            # 403 instead of 404 without s3:ListBucket permission
+            if get_error_code(e) in ('NoSuchKey', '404', 'AccessDenied', '403'):
+                return None
+            raise
+        body = obj['Body']
+        try:
+            return json.loads(body.read().decode(encoding='utf-8'))
+        finally:
+            body.close()
+
+    def put(self, key, analysis):
+        """
+        Associates a given analysis result with a given key.
+        """
+        get_s3().put_object(
+            Bucket=self.bucket,
+            Key=self.get_key(key),
+            Body=json.dumps(analysis).encode(encoding='utf-8'))
+
+    def list_keys(self):
+        """
+        Returns the keys of all the saved objects.
+
+        Needs ``s3:ListBucket`` permission on the bucket.
+
+        :rtype: list
+        :return: keys in no particular order.
+        """
+        prefix = '%s/' % self.prefix
+        params = {'Bucket': self.bucket, 'Prefix': prefix}
+        keys = []
+        while True:
+            response = get_s3().list_objects_v2(**params)
+            for content in response.get('Contents', []):
+                name = content['Key'][len(prefix):]
+                if '/' not in name and name.endswith('.json'):
+                    keys.append(name[:-len('.json')])
+            if not response.get('IsTruncated'):
+                return keys
+            params['ContinuationToken'] = response['NextContinuationToken']
+
+    def delete(self, key):
+        """
+        Deletes the object associated with a given key if any.
+
+        Needs ``s3:DeleteObject`` permission on the prefix.
+        """
+        get_s3().delete_object(Bucket=self.bucket, Key=self.get_key(key))
+
+
+def create_cache_store(location):
+    """
+    Creates a persistent store at a given location.
+
+    :type location: string
+    :param location: S3 prefix like "s3://my-bucket/cache" or path to
+        a local directory.
+    :rtype: object
+    :return: :py:class:`S3CacheStore` or :py:class:`FileCacheStore`.
+        ``None`` if ``location`` is empty.
+    """
+    if not location:
+        return None
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        return S3CacheStore(bucket, prefix)
+    return FileCacheStore(location)
+
+
+# bytes counted for a result in the in-memory layer of the analysis cache
+# in addition to its JSON, which approximate the key and the dict slot
+ANALYSIS_CACHE_ENTRY_OVERHEAD = 256
+
+
+class AnalysisCache(object):
+    """
+    Cache of analysis results keyed by :py:func:`get_cache_key`.
+
+    Consists of an in-memory LRU layer and an optional persistent layer.
+    Results found only in the persistent layer are copied into the
+    in-memory layer.
+    The in-memory layer keeps results as compact JSON of the columnar
+    representation to save memory.
+    Neither the number of results nor their total size in bytes, counting
+    :py:data:`ANALYSIS_CACHE_ENTRY_OVERHEAD` per result, exceeds its limit;
+    the least recently used results are evicted to make room, and a result
+    larger than ``budget_bytes`` is not kept in memory.
+    Responses of detectors are cached separately by :py:class:`DetectorCache`
+    under its own budget.
+
+    :type capacity: int
+    :param capacity: maximum number of results in the in-memory layer.
+    :type budget_bytes: int
+    :param budget_bytes: maximum total size of results in bytes in the
+        in-memory layer.
+    :type store: object
+    :param store: persistent layer that has ``get(key)`` and
+        ``put(key, analysis)`` methods. Optional.
+    """
+    def __init__(self, capacity, budget_bytes, store=None):
+        self.capacity = capacity
+        self.budget_bytes = budget_bytes
+        self.store = store
+        # maps a key to compact JSON of the columnar representation
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns the analysis result associated with a given key.
+
+        :rtype: dict
+        :return: cached analysis result. ``None`` if ``key`` is not cached.
+        """
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        if data is not None:
+            return decode_columnar(json.loads(data.decode(encoding='utf-8')))
+        analysis = None
+        if self.store is not None:
+            try:
+                analysis = self.store.get(key)
+            except Exception as e:
+                LOGGER.warning('failed to read cache %s: %s', key, e)
+                analysis = None
+        with self.lock:
+            if analysis is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self.put_memory(key, analysis)
+        return analysis
+
+    def put(self, key, analysis):
+        """
+        Associates a given analysis result with a given key in both layers.
+        """
+        self.put_memory(key, analysis)
+        if self.store is not None:
+            try:
+                self.store.put(key, analysis)
+            except Exception as e:
+                LOGGER.warning('failed to write cache %s: %s', key, e)
+
+    def put_memory(self, key, analysis):
+        if self.capacity <= 0 or self.budget_bytes <= 0:
+            return
+        data = encode_compact_json(encode_columnar(analysis))
+        if len(data) + ANALYSIS_CACHE_ENTRY_OVERHEAD > self.budget_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = data
+            self.size += len(data) + ANALYSIS_CACHE_ENTRY_OVERHEAD
+            while (len(self.entries) > self.capacity or
+                   self.size > self.budget_bytes):
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        # the lock must be held
+        data = self.entries.pop(key)
+        self.size -= len(data) + ANALYSIS_CACHE_ENTRY_OVERHEAD
+
+
+analysis_cache = AnalysisCache(
+    CACHE_SIZE,
+    CACHE_BYTES,
+    create_cache_store(CACHE_LOCATION))
+
+# analyses in progress
+# maps a cache key to a Future of the analysis result so that duplicate
+# texts analyzed at the same time are analyzed only once
+pending_analyses = {}
+pending_analyses_lock = threading.Lock()
+
+
+def analyze_text_cached(text, spans=None):
+    """
+    Analyzes a given text unless its result is cached.
+
+    If the same text is being analyzed by another thread, waits for and
+    shares its result.
+
+    :type text: string
+    :param text: text to be analyzed
+    :type spans: list
+    :param spans: passed to :py:func:`analyze_text`. Optional.
+    :rtype: Analysis
+    :return: analysis results of ``text``.
+    """
+    key = get_cache_key(text)
+    analysis = analysis_cache.get(key)
+    if analysis is not None:
+        LOGGER.info('cache hit: %s', key)
+        return Analysis.from_dict(analysis)
+    with pending_analyses_lock:
+        future = pending_analyses.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            pending_analyses[key] = future
+    if not owner:
+        LOGGER.info('waiting for the same text: %s', key)
+        return future.result()
+    try:
+        analysis = analyze_text(text, spans)
+        analysis_cache.put(key, analysis)
+        analysis = Analysis.from_dict(analysis)
+        future.set_result(analysis)
+        return analysis
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with pending_analyses_lock:
+            del pending_analyses[key]
+
+
+def analyze_texts_cached(texts):
+    """
+    Analyzes given texts with :py:func:`analyze_texts` except for cached
+    ones.
+
+    Duplicate texts are analyzed only once.
+
+    :type texts: list
+    :param texts: texts to be analyzed.
+    :rtype: list
+    :return: list of ``(analysis, error)`` tuples in the same order as
+        ``texts``, where ``analysis`` is an :py:class:`Analysis`.
+    """
+    keys = [get_cache_key(text) for text in texts]
+    outcomes = {}
+    missing = OrderedDict()
+    for (key, text) in zip(keys, texts):
+        if key in outcomes or key in missing:
+            continue
+        analysis = analysis_cache.get(key)
+        if analysis is not None:
+            outcomes[key] = (Analysis.from_dict(analysis), None)
+        else:
+            missing[key] = text
+    LOGGER.info(
+        '%d distinct texts, %d to be analyzed', len(outcomes) + len(missing),
+        len(missing))
+    if missing:
+        analyses = analyze_texts(list(missing.values()))
+        for (key, (analysis, error)) in zip(missing.keys(), analyses):
+            if error is None:
+                analysis_cache.put(key, analysis)
+                analysis = Analysis.from_dict(analysis)
+            outcomes[key] = (analysis, error)
+    return [outcomes[key] for key in keys]
+
+
+def iter_body(body, piece_bytes=READ_PIECE_BYTES):
+    """
+    Reads a given body stream in pieces.
+
+    ``body`` is closed when the stream is exhausted.
+
+    :type body: botocore.response.StreamingBody
+    :param body: body stream of an S3 object.
+    :type piece_bytes: int
+    :param piece_bytes: maximum size of a piece in bytes.
+    :rtype: generator
+    :return: generator of ``bytes`` pieces.
+    """
+    try:
+        while True:
+            piece = body.read(piece_bytes)
+            if not piece:
+                break
+            yield piece
+    finally:
+        body.close()
+
+
+def read_range(bucket, key, etag, start, end):
+    """
+    Reads a given byte range of an S3 object.
+
+    :type bucket: string
+    :param bucket: bucket of the object.
+    :type key: string
+    :param key: key of the object.
+    :type etag: string
+    :param etag: ETag that the object must match so that all the ranges
+        are read from the same version of the object.
+    :type start: int
+    :param start: first byte position to read.
+    :type end: int
+    :param end: last byte position to read (inclusive).
+    :rtype: bytes
+    :return: bytes in the range.
+    """
+    obj = stage_metrics.measure(
+        'GetObject',
+        get_s3().get_object,
+        Bucket=bucket,
+        Key=key,
+        Range='bytes=%d-%d' % (start, end),
+        IfMatch=etag)
+    return b''.join(iter_body(obj['Body']))
+
+
+def iter_object(bucket, key, part_bytes=None, max_workers=None):
+    """
+    Reads an S3 object in pieces.
+
+    The first part of ``part_bytes`` is read with a ranged GET, which also
+    tells the size of the object.
+    If the object is larger than ``part_bytes``, the remaining parts are
+    read with at most ``max_workers`` ranged GETs in parallel and yielded
+    in order.
+    Pieces are yielded as soon as they arrive, so that a consumer can start
+    processing before the whole object is downloaded.
+
+    :type bucket: string
+    :param bucket: bucket of the object.
+    :type key: string
+    :param key: key of the object.
+    :type part_bytes: int
+    :param part_bytes: size of a part in bytes.
+        ``COMPREHEND_S3_READ_PART_BYTES`` if omitted.
+    :type max_workers: int
+    :param max_workers: maximum number of parts read concurrently.
+        ``COMPREHEND_S3_READ_WORKERS`` if omitted.
+    :rtype: generator
+    :return: generator of ``bytes`` pieces.
+    """
+    s3 = get_s3()
+    part_bytes = part_bytes or READ_PART_BYTES
+    max_workers = max_workers or READ_WORKERS
+    try:
+        obj = stage_metrics.measure(
+            'GetObject',
+            s3.get_object,
+            Bucket=bucket,
+            Key=key,
+            Range='bytes=0-%d' % (part_bytes - 1))
+    except Exception as e:
+        if get_error_code(e) != 'InvalidRange':
+            raise
+        # an empty object does not satisfy any range
+        obj = stage_metrics.measure(
+            'GetObject', s3.get_object, Bucket=bucket, Key=key)
+    content_range = obj.get('ContentRange')
+    if content_range:
+        # "bytes 0-{part_bytes - 1}/{size}"
+        size = int(content_range.rpartition('/')[2])
+    else:
+        size = obj.get('ContentLength', 0)
+    # time to wait for the body is measured apart from the GET request
+    pieces = stage_metrics.measure_iter(
+        'ReadBody',
+        iter_object_body(bucket, key, obj, size, part_bytes, max_workers))
+    for piece in pieces:
+        yield piece
+
+
+def iter_object_body(bucket, key, obj, size, part_bytes, max_workers):
+    """
+    Reads the body of an S3 object whose first part is already requested.
+
+    The remaining parts are requested with ranged GETs before the first
+    part is read, and are read while it is being read.
+
+    :type bucket: string
+    :param bucket: bucket of the object.
+    :type key: string
+    :param key: key of the object.
+    :type obj: dict
+    :param obj: response to the GET request of the first part.
+    :type size: int
+    :param size: size of the object in bytes.
+    :type part_bytes: int
+    :param part_bytes: size of a part in bytes.
+    :type max_workers: int
+    :param max_workers: maximum number of parts read concurrently.
+    :rtype: generator
+    :return: generator of ``bytes`` pieces.
+    :see also: :py:func:`iter_object`
+    """
+    if size <= part_bytes:
+        for piece in iter_body(obj['Body']):
+            yield piece
+        return
+    LOGGER.info(
+        'reading remaining %d bytes in parallel: s3://%s/%s',
+        size - part_bytes, bucket, key)
+    ranges = iter([
+        (start, min(start + part_bytes, size) - 1)
+        for start in range(part_bytes, size, part_bytes)
+    ])
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def submit_next():
+            for (start, end) in ranges:
+                futures.append(executor.submit(
+                    read_range, bucket, key, obj.get('ETag'), start, end))
+                return
+        # keeps at most max_workers parts in flight
+        # so that memory does not grow with the size of the object
+        # the first window is requested before the first part is read
+        futures = []
+        for _ in range(max_workers):
+            submit_next()
+        for piece in iter_body(obj['Body']):
+            yield piece
+        while futures:
+            data = futures.pop(0).result()
+            submit_next()
+            yield data
+
+
+def decode_pieces(pieces):
+    """
+    Decodes given pieces of UTF-8 bytes incrementally.
+
+    A character split across pieces is correctly decoded.
+    The time spent decoding is measured as the stage "Decode".
+
+    :type pieces: iterable
+    :param pieces: ``bytes`` pieces.
+    :rtype: generator
+    :return: generator of decoded ``string`` pieces.
+    :raises UnicodeDecodeError: if ``pieces`` are not valid UTF-8.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    elapsed = 0.0
+    try:
+        for piece in pieces:
+            started = time.perf_counter()
+            text = decoder.decode(piece)
+            elapsed += time.perf_counter() - started
+            if text:
+                yield text
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+    finally:
+        stage_metrics.add_duration('Decode', elapsed)
+
+
+def iter_record_text(record):
+    """
+    Reads the text in a given S3 object in pieces.
+
+    :type record: dict
+    :param record: S3 object to be read
+    :rtype: generator
+    :return: generator of decoded ``string`` pieces.
+    :see also: :py:func:`iter_object`
+    """
+    global LOGGER
+    bucket = record['s3']['bucket']['name']
+    key = record['s3']['object']['key']
+    LOGGER.info('obtaining: s3://%s/%s', bucket, key)
+    location = 's3://%s/%s' % (bucket, key)
+    return decode_pieces(stage_metrics.count_iter(
+        location, 'BytesIn', iter_object(bucket, key)))
+
+
+def read_record(record):
+    """
+    Reads the text in a given S3 object.
+
+    :type record: dict
+    :param record: S3 object to be read
+    :rtype: string
+    :return: text in ``record``.
+    """
+    return ''.join(iter_record_text(record))
+
+
+def analyze_record(record):
+    """
+    Analyzes Amazon Comprehend to a given S3 object.
+
+    The text is split into chunks while the object is being read, and only
+    the spans of the chunks are kept.
+    The decoded pieces are released as soon as they are joined, so that
+    a single copy of the text is kept during analysis.
+
+    :type record: dict
+    :param record: S3 object to be analyzed
+    :rtype: Analysis
+    :return: analysis results of ``record``.
+    """
+    pieces = []
+    def collect():
+        for piece in iter_record_text(record):
+            pieces.append(piece)
+            yield piece
+    spans = get_chunk_spans(split_text_stream(collect()))
+    text = ''.join(pieces)
+    del pieces[:]
+    return analyze_text_cached(text, spans)
+
+
+def analyze_records(records):
+    """
+    Analyzes given S3 objects with BatchDetect* APIs of Amazon Comprehend.
+
+    Objects are read concurrently and then analyzed by
+    :py:func:`analyze_texts_cached`.
+
+    :type records: list
+    :param records: S3 objects to be analyzed
+    :rtype: list
+    :return: list of ``(analysis, error)`` tuples in the same order as
+        ``records``, where ``analysis`` is an :py:class:`Analysis`.
+    """
+    outcomes = map_records(read_record, records)
+    indices = [i for (i, (_, error)) in enumerate(outcomes) if error is None]
+    if indices:
+        analyses = analyze_texts_cached([outcomes[i][0] for i in indices])
+        for (i, outcome) in zip(indices, analyses):
+            outcomes[i] = outcome
+    return outcomes
+
+
+def encode_json(analysis):
+    """
+    Encodes a given analysis result into indented JSON.
+    """
+    return json.dumps(
+        analysis, indent=2, default=to_serializable).encode(encoding='utf-8')
+
+
+def encode_compact_json(analysis):
+    """
+    Encodes a given analysis result into JSON without whitespaces.
+    """
+    return json.dumps(
+        analysis,
+        separators=(',', ':'),
+        ensure_ascii=False,
+        default=to_serializable).encode(encoding='utf-8')
+
+
+def encode_json_gzip(analysis):
+    """
+    Encodes a given analysis result into compact JSON compressed with gzip.
+    """
+    return gzip.compress(encode_compact_json(analysis))
+
+
+def encode_columnar_json(analysis):
+    """
+    Encodes a given analysis result into compact JSON of the columnar
+    representation.
+
+    :see also: :py:func:`encode_columnar`
+    """
+    return encode_compact_json(encode_columnar(as_dict(analysis)))
+
+
+def encode_json_zstd(analysis):
+    """
+    Encodes a given analysis result into compact JSON compressed with
+    Zstandard.
+    """
+    import zstandard
+    return zstandard.ZstdCompressor().compress(encode_compact_json(analysis))
+
+
+def encode_msgpack(analysis):
+    """
+    Encodes a given analysis result into MessagePack.
+    """
+    import msgpack
+    return msgpack.packb(
+        analysis, use_bin_type=True, default=to_serializable)
+
+
+def encode_cbor(analysis):
+    """
+    Encodes a given analysis result into CBOR.
+    """
+    import cbor2
+    return cbor2.dumps(as_dict(analysis))
+
+
+# output formats
+# each value is a tuple of the extension, Content-Type, Content-Encoding and
+# a function that encodes an analysis result
+OUTPUT_FORMATS = {
+    'json': ('.json', 'application/json', None, encode_json),
+    'compact-json': ('.json', 'application/json', None, encode_compact_json),
+    'json-gzip': ('.json.gz', 'application/json', 'gzip', encode_json_gzip),
+    'columnar-json': (
+        '.columnar.json', 'application/json', None, encode_columnar_json),
+    'json-zstd': ('.json.zst', 'application/json', 'zstd', encode_json_zstd),
+    'msgpack': ('.msgpack', 'application/msgpack', None, encode_msgpack),
+    'cbor': ('.cbor', 'application/cbor', None, encode_cbor)
+}
+
+
+# date at the beginning of an event time; e.g., "2019-01-04T10:19:11.000Z"
+EVENT_DATE_PATTERN = re.compile(r'^(\d{4})-(\d{2})-(\d{2})')
+
+
+def get_output_key(input_key, event_time=None):
+    """
+    Returns the key of the output object of a given input object.
+
+    The key is made by ``COMPREHEND_S3_OUTPUT_LAYOUT`` from ``input_key``
+    and ``event_time`` alone, so no request is needed.
+    The extension is ".jsonl" if the input object is JSON Lines, otherwise
+    the one of ``COMPREHEND_S3_OUTPUT_FORMAT``.
+
+    :type input_key: string
+    :param input_key: key of the input object.
+    :type event_time: string
+    :param event_time: ``eventTime`` of the S3 event in ISO 8601, which
+        determines the date partitions of the "date" layout.
+        The current date in UTC if omitted.
+    :rtype: string
+    :return: key of the output object in ``COMPREHEND_S3_OUTPUT_FOLDER``.
+    """
+    if is_jsonl_key(input_key):
+        extension = '.jsonl'
+    else:
+        extension = OUTPUT_FORMATS[OUTPUT_FORMAT][0]
+    if OUTPUT_LAYOUT == 'flat':
+        path = os.path.basename(input_key)
+    elif INPUT_FOLDER and input_key.startswith(INPUT_FOLDER + '/'):
+        path = input_key[len(INPUT_FOLDER) + 1:]
+    else:
+        path = input_key
+    path = os.path.splitext(path)[0] + extension
+    if OUTPUT_LAYOUT == 'sharded':
+        shard = hashlib.sha256(input_key.encode('utf-8')).hexdigest()
+        path = '%s/%s' % (shard[:OUTPUT_SHARD_DIGITS], path)
+    elif OUTPUT_LAYOUT == 'date':
+        match = event_time and EVENT_DATE_PATTERN.match(event_time)
+        if match:
+            year, month, day = match.groups()
+        else:
+            year, month, day = time.strftime(
+                '%Y-%m-%d', time.gmtime()).split('-')
+        path = 'year=%s/month=%s/day=%s/%s' % (year, month, day, path)
+    return '%s/%s' % (OUTPUT_FOLDER, path)
+
+
+def get_output_location(input_bucket, input_key, event_time=None):
+    """
+    Returns the location where the analysis result of a given input object
+    is saved.
+
+    :type input_bucket: string
+    :param input_bucket: bucket of the input object
+    :type input_key: string
+    :param input_key: key of the input object
+    :type event_time: string
+    :param event_time: ``eventTime`` of the S3 event. Optional.
+    :rtype: tuple
+    :return: ``(bucket, key)`` of the output object.
+    :see also: :py:func:`get_output_key`, :py:func:`save_analysis`
+    """
+    output_bucket = OUTPUT_BUCKET or input_bucket
+    return (output_bucket, get_output_key(input_key, event_time))
+
+
+# metadata keys of an output object that identify the source object
+SOURCE_ETAG_METADATA = 'source-etag'
+SOURCE_VERSION_ID_METADATA = 'source-version-id'
+
+
+def save_analysis(
+        input_bucket,
+        input_key,
+        analysis,
+        source_etag=None,
+        source_version_id=None,
+        event_time=None):
+    """
+    Saves a given analysis results.
+
+    ``analysis`` is encoded in the format specified by the environment
+    variable ``COMPREHEND_S3_OUTPUT_FORMAT`` (indented JSON by default) and
+    saved in the location satisfying all of the following conditions,
+
+    * Bucket is ``input_bucket`` unless the environment variable
+      ``COMPREHEND_S3_OUTPUT_BUCKET`` is specified
+    * Object folder is "comprehend" unless the environment variable
+      ``COMPREHEND_S3_OUTPUT_FOLDER`` is specified
+    * Object key in the folder is given by :py:func:`get_output_key`
+      according to ``COMPREHEND_S3_OUTPUT_LAYOUT``; e.g., the name of
+      ``input_key`` whose extension is replaced with the one of the format
+      like ".json"
+
+    The ETag and version ID of the input object are saved in the metadata
+    "source-etag" and "source-version-id" of the output object if given.
+
+    :type input_bucket: string
+    :param input_bucket: bucket of the input object
+    :type input_key: string
+    :param input_key: key of the input object
+    :type analysis: Analysis
+    :param analysis: analysis results returned by :py:func:`analyze_record`.
+        A dict in the form of :py:func:`analyze_text` is also accepted.
+    :type source_etag: string
+    :param source_etag: ETag of the input object. Optional.
+    :type source_version_id: string
+    :param source_version_id: version ID of the input object. Optional.
+    :type event_time: string
+    :param event_time: ``eventTime`` of the S3 event. Optional.
+    :rtype: string
+    :return: location of the saved object like "s3://bucket/key".
+    """
+    _, content_type, content_encoding, encode = OUTPUT_FORMATS[OUTPUT_FORMAT]
+    output_bucket, output_key = get_output_location(
+        input_bucket, input_key, event_time)
+    LOGGER.info('saving: s3://%s/%s', output_bucket, output_key)
+    body = stage_metrics.measure('Serialize', encode, analysis)
+    stage_metrics.add_size(
+        's3://%s/%s' % (input_bucket, input_key), 'BytesOut', len(body))
+    params = {
+        'Bucket': output_bucket,
+        'Key': output_key,
+        'Body': body,
+        'ContentType': content_type
+    }
+    if content_encoding is not None:
+        params['ContentEncoding'] = content_encoding
+    metadata = {}
+    if source_etag:
+        metadata[SOURCE_ETAG_METADATA] = source_etag.strip('"')
+    if source_version_id:
+        metadata[SOURCE_VERSION_ID_METADATA] = source_version_id
+    if metadata:
+        params['Metadata'] = metadata
+    stage_metrics.measure('PutObject', get_s3().put_object, **params)
+    return 's3://%s/%s' % (output_bucket, output_key)
+
+
+def map_records(func, records, max_workers=None):
+    """
+    Applies a given function to each of given records.
+
+    Records are processed by a pool of at most ``max_workers`` threads.
+    An exception raised from ``func`` for one record does not cancel
+    the other records.
+
+    :type func: function
+    :param func: function that takes a record
+    :type records: list
+    :param records: records to be processed
+    :type max_workers: int
+    :param max_workers: maximum number of records processed concurrently.
+        ``COMPREHEND_S3_MAX_WORKERS`` if omitted.
+    :rtype: list
+    :return: list of ``(result, error)`` tuples in the same order as
+        ``records``, where ``error`` is the exception raised from ``func``
+        or ``None`` if ``func`` succeeded.
+    """
+    def apply(record):
+        try:
+            return (func(record), None)
+        except Exception as e:
+            return (None, e)
+    max_workers = min(max_workers or MAX_WORKERS, len(records))
+    if max_workers <= 1:
+        return [apply(record) for record in records]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(apply, records))
+
+
+# error codes of Amazon Comprehend and S3 that retrying never resolves
+PERMANENT_ERROR_CODES = (
+    'TextSizeLimitExceededException',
+    'UnsupportedLanguageException',
+    'InvalidRequestException',
+    'ValidationException',
+    'NoSuchKey',
+    'EmptyText',
+    'TEXT_SIZE_LIMIT_EXCEEDED',
+    'UNSUPPORTED_LANGUAGE',
+    'INVALID_REQUEST'
+)
+
+
+class CheckpointedFailure(Exception):
+    """
+    Failure of a record recorded in a checkpoint by a previous attempt.
+    """
+    pass
+
+
+def is_permanent_error(error):
+    """
+    Returns whether a given error of a record persists on retry.
+
+    :type error: Exception
+    :param error: error raised while a record was processed.
+    :rtype: bool
+    :return: ``True`` if ``error`` is an invalid UTF-8 text, an empty or
+        too large text, an invalid request, an unsupported language,
+        a missing object or a failure already checkpointed.
+    """
+    if isinstance(error, (UnicodeDecodeError, CheckpointedFailure)):
+        return True
+    if isinstance(error, BatchItemError):
+        return error.error_code in PERMANENT_ERROR_CODES
+    if get_error_code(error) in PERMANENT_ERROR_CODES:
+        return True
+    try:
+        from botocore.exceptions import ParamValidationError
+    except ImportError:
+        return False
+    # parameters rejected by botocore before a request; e.g., an empty text
+    return isinstance(error, ParamValidationError)
+
+
+checkpoint_store = create_cache_store(CHECKPOINT_LOCATION)
+
+
+def get_record_id(record):
+    """
+    Returns the ID of a given record that is the same on retry.
+
+    :type record: dict
+    :param record: S3 object in an event.
+    :rtype: string
+    :return: SHA-256 hex digest of the bucket, key and version of
+        ``record``. The version is the first one available of
+        ``versionId``, ``sequencer`` and ``eTag``.
+    """
+    obj = record['s3']['object']
+    version = obj.get('versionId') or obj.get('sequencer') or obj.get('eTag') or ''
+    digest = hashlib.sha256()
+    for part in (record['s3']['bucket']['name'], obj['key'], version):
+        digest.update(part.encode(encoding='utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def load_checkpoint(record):
+    """
+    Loads the checkpoint of a given record.
+
+    :type record: dict
+    :param record: S3 object in an event.
+    :rtype: dict
+    :return: checkpoint saved by :py:func:`save_checkpoint`.
+        ``None`` if ``record`` has no checkpoint or checkpoints are
+        disabled.
+    """
+    if checkpoint_store is None:
+        return None
+    try:
+        return checkpoint_store.get(get_record_id(record))
+    except Exception as e:
+        LOGGER.warning('failed to load checkpoint: %s', e)
+        return None
+
+
+def save_checkpoint(record, location=None, error=None):
+    """
+    Saves the outcome of a given record as a checkpoint.
+
+    A checkpoint is a small JSON object similar to the following::
+
+        {
+            'Status': 'Succeeded' or 'Failed',
+            'Output': location of the saved analysis,
+            'Error': 'string'
+        }
+
+    Errors are logged and ignored because a missing checkpoint only makes
+    a retry process the record again.
+
+    :type record: dict
+    :param record: processed S3 object.
+    :type location: string
+    :param location: location of the saved analysis result.
+    :type error: Exception
+    :param error: permanent error of ``record``.
+    """
+    if checkpoint_store is None:
+        return
+    if error is None:
+        checkpoint = {'Status': 'Succeeded', 'Output': location}
+    else:
+        checkpoint = {'Status': 'Failed', 'Error': str(error)}
+    try:
+        checkpoint_store.put(get_record_id(record), checkpoint)
+    except Exception as e:
+        LOGGER.warning('failed to save checkpoint: %s', e)
+
+
+def checkpoint_outcome(record, process):
+    """
+    Runs a given function on a given record and checkpoints its outcome.
+
+    A failure is checkpointed only if it is permanent; i.e., a transient
+    failure is processed again on retry.
+
+    :type record: dict
+    :param record: S3 object to be processed.
+    :type process: function
+    :param process: function that takes no argument and returns
+        ``(analysis, location)``.
+    :rtype: tuple
+    :return: result of ``process``.
+    """
+    try:
+        result = process()
+    except Exception as e:
+        if is_permanent_error(e):
+            save_checkpoint(record, error=e)
+        raise
+    save_checkpoint(record, location=result[1])
+    return result
+
+
+def get_checkpointed_outcome(checkpoint):
+    """
+    Converts a checkpoint into an outcome of a record.
+
+    :type checkpoint: dict
+    :param checkpoint: checkpoint saved by :py:func:`save_checkpoint`.
+    :rtype: tuple
+    :return: ``((None, location), None)`` if the record succeeded,
+        ``(None, CheckpointedFailure)`` if the record failed.
+    """
+    if checkpoint.get('Status') == 'Succeeded':
+        return ((None, checkpoint.get('Output')), None)
+    return (None, CheckpointedFailure(checkpoint.get('Error')))
+
+
+def save_record(record, analysis):
+    """
+    Saves the analysis result of a given record.
+
+    :type record: dict
+    :param record: analyzed S3 object
+    :type analysis: Analysis
+    :param analysis: analysis results of ``record``
+    :rtype: string
+    :return: location of the saved object.
+    :see also: :py:func:`save_analysis`
+    """
+    return save_analysis(
+        input_bucket=record['s3']['bucket']['name'],
+        input_key=record['s3']['object']['key'],
+        analysis=analysis,
+        source_etag=record['s3']['object'].get('eTag'),
+        source_version_id=record['s3']['object'].get('versionId'),
+        event_time=record.get('eventTime'))
+
+
+def check_up_to_date(record):
+    """
+    Checks if the analysis result of a given record is already saved.
+
+    The metadata of the output object is obtained with a HEAD request and
+    compared with the ETag and version ID of ``record``.
+    No input object is read.
+
+    :type record: dict
+    :param record: S3 object in an event.
+    :rtype: string
+    :return: location of the output object if it is up to date.
+        ``None`` if it is missing or outdated, or if ``record`` has no ETag.
+    """
+    obj = record['s3']['object']
+    etag = (obj.get('eTag') or '').strip('"')
+    if not etag:
+        return None
+    output_bucket, output_key = get_output_location(
+        record['s3']['bucket']['name'], obj['key'], record.get('eventTime'))
+    try:
+        metadata = stage_metrics.measure(
+            'HeadObject',
+            get_s3().head_object,
+            Bucket=output_bucket,
+            Key=output_key).get('Metadata', {})
+    except Exception as e:
+        # 403 instead of 404 without s3:ListBucket permission
+        LOGGER.debug('no output: s3://%s/%s: %s', output_bucket, output_key, e)
+        return None
+    if metadata.get(SOURCE_ETAG_METADATA) != etag:
+        return None
+    version_id = obj.get('versionId')
+    if version_id and metadata.get(SOURCE_VERSION_ID_METADATA) != version_id:
+        return None
+    return 's3://%s/%s' % (output_bucket, output_key)
+
+
+def collapse_duplicate_records(records):
+    """
+    Collapses records of the same object in an event.
+
+    For each bucket and key, only the record with the latest ``sequencer``
+    (or the last one if there is no ``sequencer``) is kept.
+
+    :type records: list
+    :param records: records in an event.
+    :rtype: list
+    :return: records without duplicates in the original order.
+    """
+    # sequencers are hexadecimal strings of variable length, compared
+    # lexicographically after the shorter ones are right-padded with zeros
+    width = max([
+        len(record['s3']['object'].get('sequencer', '')) for record in records
+    ] or [0])
+    latest = {}
+    for (i, record) in enumerate(records):
+        location = (record['s3']['bucket']['name'], record['s3']['object']['key'])
+        sequencer = record['s3']['object'].get('sequencer', '')
+        order = (sequencer.upper().ljust(width, '0'), i)
+        if location not in latest or latest[location][0] < order:
+            latest[location] = (order, i)
+    kept = sorted(i for (_, i) in latest.values())
+    if len(kept) < len(records):
+        LOGGER.info('collapsed %d duplicate records', len(records) - len(kept))
+    return [records[i] for i in kept]
+
+
+def is_jsonl_key(key):
+    """
+    Returns whether a given key is of a JSON Lines object.
+
+    :type key: string
+    :param key: key of an S3 object.
+    :rtype: bool
+    :return: whether the extension of ``key`` is in ``JSONL_EXTENSIONS``.
+    """
+    return os.path.splitext(key)[1].lower() in JSONL_EXTENSIONS
+
+
+def is_jsonl_record(record):
+    """
+    Returns whether a given record is of a JSON Lines object.
+    """
+    return is_jsonl_key(record['s3']['object']['key'])
+
+
+def iter_lines(pieces):
+    """
+    Splits given pieces of a text into lines incrementally.
+
+    A line may span pieces.
+    Line terminators ("\\n" or "\\r\\n") are removed.
+
+    :type pieces: iterable
+    :param pieces: ``string`` pieces of a text.
+    :rtype: generator
+    :return: generator of lines.
+    """
+    buffer = []
+    for piece in pieces:
+        start = 0
+        while True:
+            end = piece.find('\n', start)
+            if end < 0:
+                buffer.append(piece[start:])
+                break
+            buffer.append(piece[start:end])
+            yield ''.join(buffer).rstrip('\r')
+            buffer = []
+            start = end + 1
+    line = ''.join(buffer).rstrip('\r')
+    if line:
+        yield line
+
+
+def parse_jsonl_document(line):
+    """
+    Parses a given line of JSON Lines as a document.
+
+    :type line: string
+    :param line: line of JSON Lines.
+    :rtype: string
+    :return: text of the document. ``line`` is either a JSON string or
+        a JSON object that has the text in ``COMPREHEND_S3_JSONL_TEXT_FIELD``.
+    :raises ValueError: if ``line`` is not a document, or the text is empty
+        or whitespace only.
+    """
+    document = json.loads(line)
+    if isinstance(document, dict):
+        document = document.get(JSONL_TEXT_FIELD)
+    if not isinstance(document, str):
+        raise ValueError('no "%s" string field' % JSONL_TEXT_FIELD)
+    if is_empty_text(document):
+        raise ValueError('empty "%s" string field' % JSONL_TEXT_FIELD)
+    return document
+
+
+def iter_jsonl_batches(lines, size=BATCH_SIZE):
+    """
+    Groups documents in given JSON Lines into batches.
+
+    Blank lines are skipped.
+
+    :type lines: iterable
+    :param lines: lines of JSON Lines.
+    :type size: int
+    :param size: maximum number of documents in a batch.
+    :rtype: generator
+    :return: generator of lists of ``(line_number, text, error)`` tuples,
+        where ``error`` is the ``ValueError`` raised while parsing the line
+        or ``None``. Line numbers start from 1.
+    """
+    batch = []
+    for (line_number, line) in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            batch.append((line_number, parse_jsonl_document(line), None))
+        except ValueError as e:
+            batch.append((line_number, None, e))
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def analyze_jsonl_batch(batch):
+    """
+    Analyzes a given batch of JSON Lines documents.
+
+    :type batch: list
+    :param batch: batch given by :py:func:`iter_jsonl_batches`.
+    :rtype: list
+    :return: list of per-line results in the same order as ``batch``, each
+        of which is ``{'Line': line_number, 'Analysis': analysis}`` or
+        ``{'Line': line_number, 'Error': message}``.
+    """
+    texts = [text for (_, text, error) in batch if error is None]
+    outcomes = iter(texts and analyze_texts_cached(texts) or [])
+    results = []
+    for (line_number, _, error) in batch:
+        analysis = None
+        if error is None:
+            analysis, error = next(outcomes)
+        if error is None:
+            results.append({'Line': line_number, 'Analysis': analysis})
+        else:
+            results.append({'Line': line_number, 'Error': str(error)})
+    return results
+
+
+class JsonlUploader(object):
+    """
+    Uploads lines of JSON to an S3 object in a streaming manner.
+
+    Lines are buffered and uploaded in parts of ``JSONL_PART_BYTES`` with a
+    multipart upload, so that memory is bounded however many lines are
+    written.
+    An output smaller than a part is uploaded with a single PUT request.
+
+    :type bucket: string
+    :param bucket: bucket of the output object.
+    :type key: string
+    :param key: key of the output object.
+    :type metadata: dict
+    :param metadata: user metadata of the output object.
+    :type location: string
+    :param location: location of the input object for metrics.
+    :type content_type: string
+    :param content_type: content type of the output object.
+        "application/x-ndjson" by default.
+    """
+    def __init__(
+            self,
+            bucket,
+            key,
+            metadata,
+            location,
+            content_type='application/x-ndjson'):
+        self.bucket = bucket
+        self.key = key
+        self.metadata = metadata
+        self.location = location
+        self.content_type = content_type
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.upload_id = None
+        self.parts = []
+
+    def write(self, line):
+        """
+        Writes a given object as a line of JSON.
+
+        :param line: object to be written.
+        """
+        data = json.dumps(
+            line,
+            separators=(',', ':'),
+            ensure_ascii=False,
+            default=to_serializable).encode('utf-8') + b'\n'
+        self.write_data(data)
+
+    def write_data(self, data):
+        """
+        Writes given bytes as they are.
+
+        :type data: bytes
+        :param data: bytes to be written.
+        """
+        self.buffer.append(data)
+        self.buffer_bytes += len(data)
+        if self.buffer_bytes >= JSONL_PART_BYTES:
+            self.upload_part()
+
+    def upload_part(self):
+        """
+        Uploads the buffered lines as a part.
+        """
+        s3 = get_s3()
+        if self.upload_id is None:
+            self.upload_id = s3.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                ContentType=self.content_type,
+                Metadata=self.metadata)['UploadId']
+        body = b''.join(self.buffer)
+        self.buffer = []
+        self.buffer_bytes = 0
+        part_number = len(self.parts) + 1
+        response = stage_metrics.measure(
+            'UploadPart',
+            s3.upload_part,
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body)
+        stage_metrics.add_size(self.location, 'BytesOut', len(body))
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+    def close(self):
+        """
+        Uploads the remaining lines and completes the output object.
+
+        :rtype: string
+        :return: location of the output object like "s3://bucket/key".
+        """
+        if self.upload_id is None:
+            body = b''.join(self.buffer)
+            self.buffer = []
+            params = {
+                'Bucket': self.bucket,
+                'Key': self.key,
+                'Body': body,
+                'ContentType': self.content_type
             }
+            if self.metadata:
+                params['Metadata'] = self.metadata
+            stage_metrics.measure('PutObject', get_s3().put_object, **params)
+            stage_metrics.add_size(self.location, 'BytesOut', len(body))
+        else:
+            if self.buffer:
+                self.upload_part()
+            get_s3().complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts})
+        return 's3://%s/%s' % (self.bucket, self.key)
 
-    :see also:
-        * :py:func:`detect_dominant_language()`
-        * :py:func:`detect_entities()`
-        * :py:func:`detect_key_phrases()`
-        * :py:func:`detect_sentiment()`
-        * :py:func:`detect_syntax()`
+    def abort(self):
+        """
+        Aborts the multipart upload if it is started.
+        """
+        if self.upload_id is None:
+            return
+        try:
+            get_s3().abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            LOGGER.warning(
+                'failed to abort upload to s3://%s/%s: %s',
+                self.bucket, self.key, e)
+
+
+def analyze_jsonl_record(record):
+    """
+    Analyzes each line of a given JSON Lines object and saves the results.
+
+    Lines are read as a stream and analyzed in batches of
+    :py:data:`BATCH_SIZE` documents with BatchDetect* APIs.
+    Up to ``COMPREHEND_S3_MAX_WORKERS`` batches are analyzed concurrently.
+    Per-line results are written in the order of lines to a JSON Lines
+    object at the location given by :py:func:`get_output_location`.
+    A line that is not a document or that Amazon Comprehend rejects has an
+    error in its result instead of failing the whole object.
+
+    :type record: dict
+    :param record: JSON Lines object to be analyzed.
+    :rtype: tuple
+    :return: ``(counts, location)`` where ``counts`` is a dict of the
+        numbers of lines ``{'Documents': n, 'FailedDocuments': n}`` and
+        ``location`` is that of the output object.
     """
-    global LOGGER
-    global s3
     bucket = record['s3']['bucket']['name']
     key = record['s3']['object']['key']
-    LOGGER.info('obtaining: s3://%s/%s', bucket, key)
-    obj = s3.get_object(Bucket=bucket, Key=key)
+    output_bucket, output_key = get_output_location(
+        bucket, key, record.get('eventTime'))
+    metadata = {}
+    if record['s3']['object'].get('eTag'):
+        metadata[SOURCE_ETAG_METADATA] = record['s3']['object']['eTag'].strip('"')
+    if record['s3']['object'].get('versionId'):
+        metadata[SOURCE_VERSION_ID_METADATA] = record['s3']['object']['versionId']
+    uploader = JsonlUploader(
+        output_bucket, output_key, metadata, 's3://%s/%s' % (bucket, key))
+    counts = {'Documents': 0, 'FailedDocuments': 0}
+    def write(results):
+        for result in results:
+            counts['Documents'] += 1
+            if 'Error' in result:
+                counts['FailedDocuments'] += 1
+            uploader.write(result)
+    try:
+        batches = iter_jsonl_batches(iter_lines(iter_record_text(record)))
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # keeps at most MAX_WORKERS batches in flight
+            # so that memory does not grow with the number of lines
+            futures = []
+            for batch in batches:
+                futures.append(executor.submit(analyze_jsonl_batch, batch))
+                if len(futures) >= MAX_WORKERS:
+                    write(futures.pop(0).result())
+            for future in futures:
+                write(future.result())
+        LOGGER.info(
+            'analyzed %d documents (%d failed): s3://%s/%s',
+            counts['Documents'], counts['FailedDocuments'], bucket, key)
+        return (counts, uploader.close())
+    except Exception:
+        uploader.abort()
+        raise
+
+
+# asynchronous job APIs of Amazon Comprehend for fields of an analysis
+# result; e.g., "entities" for StartEntitiesDetectionJob and
+# DescribeEntitiesDetectionJob
+# syntax has no asynchronous job
+ASYNC_JOB_APIS = OrderedDict([
+    ('Entities', 'entities'),
+    ('KeyPhrases', 'key_phrases'),
+    ('Sentiment', 'sentiment')
+])
+
+# statuses of an asynchronous job that never completes
+ASYNC_JOB_FAILED_STATUSES = ('FAILED', 'STOP_REQUESTED', 'STOPPED')
+
+# line breaks in a chunk, which are replaced with spaces in an input file
+# of asynchronous jobs because each line is a document
+ASYNC_LINE_BREAK_PATTERN = re.compile(r'[\r\n]')
+
+# pending asynchronous jobs keyed by record IDs
+async_job_store = create_cache_store(
+    ASYNC_LOCATION and '%s/jobs' % ASYNC_LOCATION)
+
+
+def is_async_record(record):
+    """
+    Returns whether a given record is analyzed by asynchronous jobs.
+
+    ``True`` if ``COMPREHEND_S3_ASYNC_THRESHOLD_BYTES``,
+    ``COMPREHEND_S3_ASYNC_ROLE_ARN`` and ``COMPREHEND_S3_ASYNC_LOCATION``
+    are specified and the object is larger than the threshold, or
+    :py:data:`scheduler` estimates that the object cannot be analyzed in
+    a whole invocation.
+    A JSON Lines object is never analyzed by asynchronous jobs.
+
+    :type record: dict
+    :param record: S3 object in an event.
+    :rtype: bool
+    """
+    if ASYNC_THRESHOLD_BYTES <= 0 or not ASYNC_ROLE_ARN or not ASYNC_LOCATION:
+        return False
+    if is_jsonl_record(record):
+        return False
+    size = record['s3']['object'].get('size', 0)
+    return size > ASYNC_THRESHOLD_BYTES or scheduler.is_oversized(size)
+
+
+def get_async_job_location(record_id, name):
+    """
+    Returns the location of a file of asynchronous jobs of a given record.
+
+    :type record_id: string
+    :param record_id: ID of the record given by :py:func:`get_record_id`.
+    :type name: string
+    :param name: name of the file; e.g., "input.txt".
+    :rtype: tuple
+    :return: ``(bucket, key)`` under ``COMPREHEND_S3_ASYNC_LOCATION``.
+    """
+    bucket, _, prefix = ASYNC_LOCATION[len('s3://'):].partition('/')
+    if prefix:
+        return (bucket, '%s/%s/%s' % (prefix, record_id, name))
+    return (bucket, '%s/%s' % (record_id, name))
+
+
+def start_async_jobs(record):
+    """
+    Starts asynchronous jobs of Amazon Comprehend to analyze a given S3
+    object.
+
+    The text is split into chunks while the object is being read, and the
+    chunks are written one per line to the input file of the jobs under
+    ``COMPREHEND_S3_ASYNC_LOCATION``.
+    The dominant language is detected in the first chunk.
+    Jobs of entities, key phrases and sentiment are started and saved as
+    pending with the offsets of the chunks, so that
+    :py:func:`poll_async_jobs` can merge the results of the chunks when the
+    jobs finish.
+    If jobs of the same version of the object are already pending, they
+    are reused.
+    Requests are idempotent, so a retry never starts duplicate jobs.
+
+    :type record: dict
+    :param record: S3 object to be analyzed.
+    :rtype: tuple
+    :return: ``(jobs, location)`` where ``jobs`` is a dict
+        ``{'AsyncJobs': {field: job ID}}`` and ``location`` is that of the
+        analysis result saved when the jobs finish.
+    :raises BatchItemError: if the object has no text.
+    """
+    bucket = record['s3']['bucket']['name']
+    key = record['s3']['object']['key']
+    output_bucket, output_key = get_output_location(
+        bucket, key, record.get('eventTime'))
+    location = 's3://%s/%s' % (output_bucket, output_key)
+    record_id = get_record_id(record)
+    pending = async_job_store.get(record_id)
+    if pending is not None:
+        LOGGER.info('jobs already pending: s3://%s/%s', bucket, key)
+        return ({'AsyncJobs': pending['Jobs']}, location)
+    input_bucket, input_key = get_async_job_location(record_id, 'input.txt')
+    uploader = JsonlUploader(
+        input_bucket,
+        input_key,
+        {},
+        's3://%s/%s' % (bucket, key),
+        content_type='text/plain')
+    offsets = []
+    weights = []
+    language = None
+    try:
+        for (offset, chunk) in split_text_stream(iter_record_text(record)):
+            if language is None:
+                language = detect_dominant_language(chunk)
+            offsets.append(offset)
+            weights.append(len(chunk))
+            # replaces line breaks with spaces to keep offsets in the chunk
+            uploader.write_data(
+                (ASYNC_LINE_BREAK_PATTERN.sub(' ', chunk) + '\n').encode('utf-8'))
+        if language is None:
+            raise BatchItemError('EmptyText', 'no text to be analyzed')
+        input_uri = uploader.close()
+    except Exception:
+        uploader.abort()
+        raise
+    LOGGER.info(
+        'starting jobs of %d chunks: s3://%s/%s', len(offsets), bucket, key)
+    output_bucket, output_prefix = get_async_job_location(record_id, 'output')
+    jobs = OrderedDict()
+    for (field, api) in ASYNC_JOB_APIS.items():
+        response = call_comprehend(
+            'start_%s_detection_job' % api,
+            InputDataConfig={
+                'S3Uri': input_uri,
+                'InputFormat': 'ONE_DOC_PER_LINE'
+            },
+            OutputDataConfig={
+                'S3Uri': 's3://%s/%s/%s/' % (output_bucket, output_prefix, field)
+            },
+            DataAccessRoleArn=ASYNC_ROLE_ARN,
+            JobName='comprehend-s3-%s-%s' % (field, record_id),
+            LanguageCode=language['LanguageCode'],
+            ClientRequestToken=hashlib.sha256(
+                ('%s\0%s' % (record_id, field)).encode('utf-8')).hexdigest())
+        jobs[field] = response['JobId']
+    async_job_store.put(record_id, {
+        'Input': {
+            'Bucket': bucket,
+            'Key': key,
+            'ETag': record['s3']['object'].get('eTag'),
+            'VersionId': record['s3']['object'].get('versionId'),
+            'EventTime': record.get('eventTime')
+        },
+        'Jobs': jobs,
+        'DominantLanguage': language,
+        'Offsets': offsets,
+        'Weights': weights,
+        'StartedAt': time.time()
+    })
+    return ({'AsyncJobs': jobs}, location)
+
+
+def describe_async_job(field, job_id):
+    """
+    Describes an asynchronous job.
+
+    :type field: string
+    :param field: field of the job in :py:data:`ASYNC_JOB_APIS`.
+    :type job_id: string
+    :param job_id: ID of the job.
+    :rtype: dict
+    :return: properties of the job, which have ``JobStatus`` and
+        ``OutputDataConfig`` among others.
+    """
+    response = call_comprehend(
+        'describe_%s_detection_job' % ASYNC_JOB_APIS[field], JobId=job_id)
+    return response['%sDetectionJobProperties' % field]
+
+
+def iter_async_output(s3_uri):
+    """
+    Reads the results in the output archive of an asynchronous job.
+
+    The archive is extracted as a stream.
+
+    :type s3_uri: string
+    :param s3_uri: S3 URI of the archive given in ``OutputDataConfig`` of
+        the job.
+    :rtype: generator
+    :return: generator of result dicts, each of which has the ``Line`` of
+        the input file and either results or ``ErrorCode``.
+    """
+    bucket, _, key = s3_uri[len('s3://'):].partition('/')
+    obj = stage_metrics.measure(
+        'GetObject', get_s3().get_object, Bucket=bucket, Key=key)
     body = obj['Body']
-    text = body.read().decode(encoding='utf-8')
     try:
-        LOGGER.debug('input: %s' % text)
-        LOGGER.info('detecting dominant language')
-        dominant_language = detect_dominant_language(text)
-        LOGGER.debug(
-            'Language=%s (Score=%f)',
-            dominant_language['LanguageCode'],
-            dominant_language['Score'])
-        language_code = dominant_language['LanguageCode']
-            # subsequent analyses depend on the detected language
-        LOGGER.info('detecting entities')
-        entities = detect_entities(text, language_code)
-        for entity in entities:
-            LOGGER.debug('[%s] %s', entity['Type'], entity['Text'])
-        LOGGER.info('detecting key phrases')
-        key_phrases = detect_key_phrases(text, language_code)
-        for phrase in key_phrases:
-            LOGGER.debug(
-                'Key Phrase=%s (Score=%f)', phrase['Text'], phrase['Score'])
-        LOGGER.info('detecting sentiment')
-        sentiment = detect_sentiment(text, language_code)
-        LOGGER.debug(
-            'Sentiment=%s (Score=%f)',
-            sentiment['Sentiment'],
-            sentiment['SentimentScore'][sentiment['Sentiment'].capitalize()])
-        LOGGER.info('detecting syntax')
-        syntax_tokens = detect_syntax(text, language_code)
-        for token in syntax_tokens:
-            LOGGER.debug(
-                '[%s] %s (Score=%f)',
-                token['PartOfSpeech']['Tag'],
-                token['Text'],
-                token['PartOfSpeech']['Score'])
-        return {
-            'DominantLanguage': dominant_language,
-            'Entities': entities,
-            'KeyPhrases': key_phrases,
-            'Sentiment': sentiment,
-            'SyntaxTokens': syntax_tokens
-        }
+        with tarfile.open(fileobj=body, mode='r|gz') as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                for line in archive.extractfile(member):
+                    line = line.strip()
+                    if line:
+                        yield json.loads(line.decode('utf-8'))
     finally:
-        body.close()  # is this really necessary?
+        body.close()
 
 
-def save_analysis(input_bucket, input_key, analysis):
+def collect_async_analysis(pending, output_uris):
     """
-    Saves a given analysis results.
+    Merges the results of finished asynchronous jobs into the analysis
+    result of the whole object.
 
-    ``analysis`` is converted into a JSON object and saved in the location
-    satisfying all of the following conditions,
+    The results of the chunks are merged by
+    :py:func:`merge_chunk_analyses`.
+    ``SyntaxTokens`` is empty because syntax has no asynchronous job.
 
-    * Bucket is ``input_bucket`` unless the environment variable
-      ``COMPREHEND_S3_OUTPUT_BUCKET`` is specified
-    * Object folder is "comprehend" unless the environment variable
-      ``COMPREHEND_S3_OUTPUT_FOLDER`` is specified
-    * Object name is same as ``input_key`` except the extension is replaced
-      with ".json"
+    :type pending: dict
+    :param pending: pending jobs saved by :py:func:`start_async_jobs`.
+    :type output_uris: dict
+    :param output_uris: maps a field to the S3 URI of the output archive of
+        its job.
+    :rtype: dict
+    :return: analysis results of the object.
+        See :py:func:`analyze_text` for details.
+    :raises BatchItemError: if analysis of any chunk fails.
+    """
+    analyses = [
+        {'DominantLanguage': pending['DominantLanguage'], 'SyntaxTokens': []}
+        for _ in pending['Offsets']
+    ]
+    for (field, s3_uri) in output_uris.items():
+        for result in iter_async_output(s3_uri):
+            if 'ErrorCode' in result:
+                raise BatchItemError(
+                    result['ErrorCode'], result.get('ErrorMessage'))
+            if field == 'Sentiment':
+                analyses[result['Line']][field] = {
+                    'Sentiment': result['Sentiment'],
+                    'SentimentScore': result['SentimentScore']
+                }
+            else:
+                analyses[result['Line']][field] = result[field]
+    for (i, analysis) in enumerate(analyses):
+        for field in output_uris:
+            if field not in analysis:
+                raise BatchItemError(
+                    'MissingResult', 'no %s of chunk %d' % (field, i))
+    return merge_chunk_analyses(
+        pending['Offsets'], pending['Weights'], analyses)
 
-    :type input_bucket: string
-    :param input_bucket: bucket of the input object
-    :type input_key: string
-    :param input_key: key of the input object
-    :type analysis: dict
-    :param analysis: analysis results returned by :py:func:`analyze_record`
+
+def finish_async_jobs(record_id):
     """
-    output_bucket = OUTPUT_BUCKET or input_bucket
-    output_name = os.path.splitext(os.path.basename(input_key))[0]
-    output_key = '%s/%s.json' % (OUTPUT_FOLDER, output_name)
-    LOGGER.info('saving: s3://%s/%s', output_bucket, output_key)
-    s3.put_object(
-        Bucket=output_bucket,
-        Key=output_key,
-        Body=json.dumps(analysis, indent=2).encode(encoding='utf-8'))
+    Saves the analysis result of a record whose asynchronous jobs finished.
+
+    The pending jobs are removed if they completed or failed.
+
+    :type record_id: string
+    :param record_id: ID of the record whose jobs are pending.
+    :rtype: string
+    :return: "Completed", "InProgress" or "Failed".
+        ``None`` if the jobs are no longer pending.
+    """
+    pending = async_job_store.get(record_id)
+    if pending is None:
+        return None
+    source = pending['Input']
+    properties = OrderedDict(
+        (field, describe_async_job(field, job_id))
+        for (field, job_id) in pending['Jobs'].items())
+    failures = [
+        '%s %s: %s' % (field, p['JobStatus'], p.get('Message'))
+        for (field, p) in properties.items()
+        if p['JobStatus'] in ASYNC_JOB_FAILED_STATUSES
+    ]
+    if not failures:
+        if any(p['JobStatus'] != 'COMPLETED' for p in properties.values()):
+            return 'InProgress'
+        try:
+            analysis = collect_async_analysis(pending, OrderedDict(
+                (field, p['OutputDataConfig']['S3Uri'])
+                for (field, p) in properties.items()))
+        except BatchItemError as e:
+            failures.append(str(e))
+    if failures:
+        LOGGER.error(
+            'jobs failed: s3://%s/%s: %s',
+            source['Bucket'],
+            source['Key'],
+            '; '.join(failures))
+        async_job_store.delete(record_id)
+        return 'Failed'
+    save_analysis(
+        source['Bucket'],
+        source['Key'],
+        analysis,
+        source.get('ETag'),
+        source.get('VersionId'),
+        source.get('EventTime'))
+    async_job_store.delete(record_id)
+    return 'Completed'
+
+
+def poll_async_jobs():
+    """
+    Checks all the pending asynchronous jobs and saves the analysis results
+    of objects whose jobs finished.
+
+    Up to ``COMPREHEND_S3_MAX_WORKERS`` records are checked concurrently.
+    A record that fails with an error is kept pending and checked again
+    by the next poll.
+
+    :rtype: dict
+    :return: numbers of records like the following::
+
+            {
+                'Completed': 1,
+                'InProgress': 2,
+                'Failed': 0,
+                'Errors': 0
+            }
+    """
+    counts = OrderedDict(
+        (status, 0)
+        for status in ('Completed', 'InProgress', 'Failed', 'Errors'))
+    if async_job_store is None:
+        return counts
+    record_ids = async_job_store.list_keys()
+    outcomes = map_records(finish_async_jobs, record_ids)
+    for (record_id, (status, error)) in zip(record_ids, outcomes):
+        if error is not None:
+            LOGGER.error('failed to check jobs of %s: %s', record_id, error)
+            counts['Errors'] += 1
+        elif status is not None:
+            counts[status] += 1
+    return counts
+
+
+# prior estimate of seconds to process a record regardless of its size
+RECORD_BASE_SECONDS = 0.5
+
+# prior estimate of seconds to process a byte of a record
+RECORD_SECONDS_PER_BYTE = 0.00002
+
+# weight of an observed duration in the estimates of costs of records
+RECORD_COST_ALPHA = 0.2
+
+
+class DeferredRecordError(Exception):
+    """
+    Error of a record that was not started because it could not finish
+    before the deadline of the invocation.
+    """
+    pass
+
+
+class RecordScheduler(object):
+    """
+    Decides which records are started before the deadline of an invocation.
+
+    The cost of records is estimated as ``count * base_seconds +
+    seconds_per_byte * size``, and both terms are corrected toward the
+    durations observed during warm invocations.
+    Records are started only if their estimated cost fits in the remaining
+    time of the invocation minus ``margin_seconds``.
+    The first record of an invocation is not started either if it does not
+    fit, because a new invocation has more time for it.
+    A record that does not fit even in the time of a whole invocation is
+    "oversized" (see :py:meth:`is_oversized`); it should be handed to
+    asynchronous jobs before it is admitted, and is otherwise started as
+    the first record of an invocation anyway so that it is not deferred
+    forever, at the risk of the timeout.
+    Records are not limited in an invocation started without a Lambda
+    context.
+
+    :type base_seconds: float
+    :param base_seconds: prior estimate of seconds to process a record
+        regardless of its size.
+    :type seconds_per_byte: float
+    :param seconds_per_byte: prior estimate of seconds to process a byte.
+    :type margin_seconds: float
+    :param margin_seconds: seconds kept before the deadline.
+    """
+    def __init__(self, base_seconds, seconds_per_byte, margin_seconds):
+        self.base_seconds = base_seconds
+        self.seconds_per_byte = seconds_per_byte
+        self.margin_seconds = margin_seconds
+        self.lock = threading.Lock()
+        # get_remaining_time_in_millis of the Lambda context
+        self.get_remaining_millis = None
+        # seconds available to records when the invocation started
+        self.budget_seconds = None
+        self.started = 0
+
+    def start(self, context):
+        """
+        Starts an invocation.
+
+        :type context: LambdaContext
+        :param context: Lambda context of the invocation. ``None`` if the
+            invocation has no deadline.
+        """
+        with self.lock:
+            self.get_remaining_millis = getattr(
+                context, 'get_remaining_time_in_millis', None)
+            self.budget_seconds = self.get_remaining_millis and (
+                self.get_remaining_millis() / 1000.0 - self.margin_seconds)
+            self.started = 0
+
+    def is_oversized(self, size):
+        """
+        Returns whether a record cannot finish in a whole invocation.
+
+        :type size: int
+        :param size: size of the record in bytes.
+        :rtype: bool
+        :return: ``True`` if the estimated cost of the record exceeds the
+            time that the current invocation had when it started.
+            ``False`` if the invocation has no deadline.
+        """
+        with self.lock:
+            if self.budget_seconds is None:
+                return False
+            cost = self.base_seconds + self.seconds_per_byte * size
+            return cost > self.budget_seconds
+
+    def estimate(self, size, count=1):
+        """
+        Estimates seconds to process records.
+
+        :type size: int
+        :param size: total size of the records in bytes.
+        :type count: int
+        :param count: number of the records.
+        :rtype: float
+        :return: estimated seconds.
+        """
+        with self.lock:
+            return count * self.base_seconds + self.seconds_per_byte * size
+
+    def observe(self, size, seconds, count=1):
+        """
+        Corrects the estimates toward an observed duration of records.
+
+        The error of the estimate is split between the terms in proportion
+        to their shares of the estimate.
+
+        :type size: int
+        :param size: total size of the records in bytes.
+        :type seconds: float
+        :param seconds: observed duration of the records.
+        :type count: int
+        :param count: number of the records.
+        """
+        with self.lock:
+            base = count * self.base_seconds
+            estimate = base + self.seconds_per_byte * size
+            error = RECORD_COST_ALPHA * (seconds - estimate)
+            base_share = estimate > 0 and base / estimate or 1.0
+            self.base_seconds = max(
+                self.base_seconds + error * base_share / count, 0.0)
+            if size > 0:
+                self.seconds_per_byte = max(
+                    self.seconds_per_byte + error * (1.0 - base_share) / size,
+                    0.0)
+
+    def admit(self, sizes):
+        """
+        Starts as many of given records as can finish before the deadline.
+
+        The records are assumed to be processed together.
+
+        :type sizes: list
+        :param sizes: sizes of the records in bytes in order.
+        :rtype: int
+        :return: number of the leading records that may be started.
+            The others should be deferred.
+        """
+        with self.lock:
+            if self.get_remaining_millis is None:
+                count = len(sizes)
+            else:
+                limit = (
+                    self.get_remaining_millis() / 1000.0 - self.margin_seconds)
+                count = 0
+                total = 0
+                for size in sizes:
+                    total += size
+                    cost = (
+                        (count + 1) * self.base_seconds +
+                        self.seconds_per_byte * total)
+                    # an oversized first record never fits in a new
+                    # invocation either
+                    oversized = (
+                        self.started + count == 0 and
+                        cost > self.budget_seconds)
+                    if cost > limit and not oversized:
+                        break
+                    if cost > limit:
+                        LOGGER.warning(
+                            'starting an oversized record estimated at '
+                            '%.1fs with %.1fs left',
+                            cost,
+                            limit)
+                    count += 1
+            self.started += count
+            return count
+
+    def is_over(self):
+        """
+        Returns whether no more records should be started.
+
+        :rtype: bool
+        :return: ``True`` if a record was started and the remaining time is
+            within the margin.
+        """
+        with self.lock:
+            if self.get_remaining_millis is None or self.started == 0:
+                return False
+            remaining = self.get_remaining_millis() / 1000.0
+            return remaining <= self.margin_seconds
+
+
+# schedules records against the deadline of each invocation
+scheduler = RecordScheduler(
+    RECORD_BASE_SECONDS, RECORD_SECONDS_PER_BYTE, DEADLINE_MARGIN_MS / 1000.0)
+
+
+def get_record_size(record):
+    """
+    Returns the size of a given record used to estimate its cost.
+
+    :type record: dict
+    :param record: S3 object in an event.
+    :rtype: int
+    :return: ``size`` of the object in the event. 0 if the size is unknown
+        or the object is handed to asynchronous jobs, which do not analyze
+        it in the invocation.
+    """
+    if is_async_record(record):
+        return 0
+    return record['s3']['object'].get('size', 0)
+
+
+def continue_records(records, context):
+    """
+    Hands given records to a new invocation of this function.
+
+    The function is invoked asynchronously with an event that has only
+    ``records`` if ``COMPREHEND_S3_CONTINUATION`` is "invoke".
+    The function needs ``lambda:InvokeFunction`` on itself.
+
+    :type records: list
+    :param records: S3 objects that were not started.
+    :type context: LambdaContext
+    :param context: Lambda context of the current invocation.
+    :rtype: bool
+    :return: whether ``records`` were handed over. ``False`` if the
+        continuation is "retry", there is no context or the invocation
+        failed.
+    """
+    if CONTINUATION != 'invoke' or context is None:
+        return False
+    payload = json.dumps({'Records': records}).encode('utf-8')
+    try:
+        stage_metrics.measure(
+            'Invoke',
+            get_client('lambda').invoke,
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=payload)
+    except Exception as e:
+        LOGGER.error('failed to continue %d records: %s', len(records), e)
+        return False
+    LOGGER.info('continued %d records in a new invocation', len(records))
+    return True
+
+
+def process_record(record):
+    """
+    Analyzes a given S3 object and saves its analysis result.
+
+    A JSON Lines object is processed by :py:func:`analyze_jsonl_record`.
+    An object larger than ``COMPREHEND_S3_ASYNC_THRESHOLD_BYTES`` is
+    handed to asynchronous jobs by :py:func:`start_async_jobs`, and its
+    analysis result is saved later by :py:func:`poll_async_jobs`.
+    The outcome is checkpointed by :py:func:`checkpoint_outcome`.
+    The whole duration is measured as the stage "ProcessRecord".
+    The record is not started if :py:data:`scheduler` estimates that it
+    cannot finish before the deadline.
+
+    :type record: dict
+    :param record: S3 object to be analyzed
+    :rtype: tuple
+    :return: ``(analysis, location)`` where ``analysis`` is the result of
+        :py:func:`analyze_record` and ``location`` is that of the saved
+        object.
+        ``analysis`` is ``None`` if ``COMPREHEND_S3_RETURN_MODE`` is
+        "summary" so that it is released immediately.
+        ``analysis`` is the numbers of lines for a JSON Lines object, and
+        the IDs of the started jobs for an object analyzed asynchronously.
+    :raises DeferredRecordError: if the record is not started.
+    """
+    size = get_record_size(record)
+    if scheduler.admit([size]) == 0:
+        raise DeferredRecordError('not started before the deadline')
+    def process():
+        if is_jsonl_record(record):
+            return analyze_jsonl_record(record)
+        if is_async_record(record):
+            return start_async_jobs(record)
+        analysis = analyze_record(record)
+        location = save_record(record, analysis)
+        if RETURN_MODE == 'summary':
+            analysis = None
+        return (analysis, location)
+    started = time.time()
+    result = stage_metrics.measure(
+        'ProcessRecord', checkpoint_outcome, record, process)
+    if not is_async_record(record):
+        scheduler.observe(size, time.time() - started)
+    return result
+
+
+def process_records(records):
+    """
+    Analyzes given S3 objects with BatchDetect* APIs and saves their
+    analysis results.
+
+    Analysis results are saved concurrently.
+    Outcomes are checkpointed by :py:func:`checkpoint_outcome`.
+    If the records cannot be analyzed together, each record is analyzed
+    alone so that an error fails only its own record.
+
+    :type records: list
+    :param records: S3 objects to be analyzed
+    :rtype: list
+    :return: list of ``((analysis, location), error)`` tuples in the same
+        order as ``records``.
+    :see also: :py:func:`analyze_records`
+    """
+    try:
+        outcomes = analyze_records(records)
+    except Exception as e:
+        if len(records) == 1:
+            outcomes = [(None, e)]
+        else:
+            LOGGER.warning(
+                'failed to analyze %d records together, analyzing them one '
+                'by one: %s',
+                len(records),
+                e)
+            outcomes = [analyze_record_alone(record) for record in records]
+    def save(i):
+        analysis, error = outcomes[i]
+        if error is not None:
+            raise error
+        location = save_record(records[i], analysis)
+        # releases the analysis result as soon as it is saved
+        outcomes[i] = (None, None)
+        if RETURN_MODE == 'summary':
+            analysis = None
+        return (analysis, location)
+    return map_records(
+        lambda i: checkpoint_outcome(records[i], lambda: save(i)),
+        list(range(len(records))))
+
+
+def analyze_record_alone(record):
+    """
+    Analyzes a given S3 object by :py:func:`analyze_records` alone.
+
+    :rtype: tuple
+    :return: ``(analysis, error)`` of ``record``.
+    """
+    try:
+        return analyze_records([record])[0]
+    except Exception as e:
+        return (None, e)
+
+
+def summarize(records, outcomes, skipped=()):
+    """
+    Summarizes outcomes of given records.
+
+    :type records: list
+    :param records: processed S3 objects
+    :type outcomes: list
+    :param outcomes: list of ``((analysis, location), error)`` tuples
+        corresponding to ``records``.
+    :type skipped: set
+    :param skipped: indices of records skipped because of their checkpoints
+        or up-to-date outputs.
+    :rtype: dict
+    :return: summary similar to the following::
 
+            {
+                'Succeeded': 1,
+                'Failed': 1,
+                'Records': [
+                    {
+                        'Input': 's3://my-bucket/inbox/a.txt',
+                        'Status': 'Succeeded',
+                        'Output': 's3://my-bucket/comprehend/a.json'
+                    },
+                    {
+                        'Input': 's3://my-bucket/inbox/b.txt',
+                        'Status': 'Failed',
+                        'Error': 'string',
+                        'Retryable': False,
+                        'Skipped': True
+                    },
+                    {
+                        'Input': 's3://my-bucket/inbox/c.txt',
+                        'Status': 'Deferred'
+                    }
+                ],
+                'Deferred': 1
+            }
+
+        ``Skipped`` appears only for records in ``skipped``.
+        A record is "Deferred" if it was handed to a new invocation by
+        :py:func:`continue_records`.
+    """
+    summaries = []
+    for (i, (record, (result, error))) in enumerate(zip(records, outcomes)):
+        summary = {
+            'Input': 's3://%s/%s' % (
+                record['s3']['bucket']['name'], record['s3']['object']['key'])
+        }
+        if error is None:
+            summary['Status'] = 'Succeeded'
+            summary['Output'] = result[1]
+        elif isinstance(error, DeferredRecordError):
+            summary['Status'] = 'Deferred'
+        else:
+            summary['Status'] = 'Failed'
+            summary['Error'] = str(error)
+            summary['Retryable'] = not is_permanent_error(error)
+        if i in skipped:
+            summary['Skipped'] = True
+        summaries.append(summary)
+    failed = len([summary for summary in summaries if 'Error' in summary])
+    deferred = len([
+        summary for summary in summaries if summary['Status'] == 'Deferred'
+    ])
+    return {
+        'Succeeded': len(summaries) - failed - deferred,
+        'Failed': failed,
+        'Deferred': deferred,
+        'Records': summaries
+    }
 
-def main(event):
+
+def main(event, context=None):
     """
     Applies Amazon Comprehend to given S3 objects.
 
+    Records are analyzed concurrently by up to ``COMPREHEND_S3_MAX_WORKERS``
+    threads, and each analysis result is saved as soon as it is ready.
+    Records are analyzed together by :py:func:`analyze_records` instead if
+    ``COMPREHEND_S3_ANALYSIS_MODE`` is "batch".
+
+    Duplicate records of the same object are collapsed.
+    If ``COMPREHEND_S3_SKIP_UP_TO_DATE`` is "true", records whose
+    analysis results are already saved from the same version are skipped
+    by :py:func:`check_up_to_date`.
+
+    A failure of a record does not affect the other records.
+    If ``COMPREHEND_S3_CHECKPOINT_LOCATION`` is specified, the outcome of
+    each record is checkpointed, and records that already succeeded or
+    permanently failed in a previous attempt of the same event are skipped.
+    After all the records are processed, the first transient error is
+    raised so that Lambda retries the event.
+    Permanent errors are only logged.
+
+    Records that cannot finish before the deadline of ``context`` are not
+    started, and are handed to a new invocation by
+    :py:func:`continue_records` after the other records are saved.
+    If they are not handed over, they are transient errors.
+
+    Metrics of stages are emitted by :py:meth:`StageMetrics.emit` unless
+    ``COMPREHEND_S3_METRICS`` is "false".
+    Payloads and results are traced in a fraction
+    ``COMPREHEND_S3_TRACE_SAMPLE_RATE`` of invocations.
+
     :type event: dict
     :param event: should be an S3 PUT event
+    :type context: LambdaContext
+    :param context: Lambda context of the invocation. Records are not
+        limited by a deadline if omitted.
+    :rtype: list or dict
+    :return: list of analysis results of the records without duplicates,
+        where each element is the result of :py:func:`analyze_record`
+        converted into a dict, or ``None`` if the record failed, was
+        skipped or deferred.
+        The result of :py:func:`summarize` if ``COMPREHEND_S3_RETURN_MODE``
+        is "summary".
+    """
+    tracer.sample()
+    scheduler.start(context)
+    records = collapse_duplicate_records(event['Records'])
+    outcomes, skipped = run_records(records, ANALYSIS_MODE)
+    deferred = [
+        record for (record, (_, record_error)) in zip(records, outcomes)
+        if isinstance(record_error, DeferredRecordError)
+    ]
+    continued = deferred and continue_records(deferred, context)
+    error = None
+    for (_, record_error) in outcomes:
+        if continued and isinstance(record_error, DeferredRecordError):
+            continue
+        if record_error is not None and not is_permanent_error(record_error):
+            error = error or record_error
+    log_invocation_stats()
+    if error is not None:
+        raise error
+    if RETURN_MODE == 'summary':
+        return summarize(records, outcomes, skipped)
+    return [
+        result is not None and as_dict(result[0]) or None
+        for (result, _) in outcomes
+    ]
+
+
+def run_records(records, analysis_mode):
+    """
+    Processes given records without duplicates.
+
+    Records checkpointed in a previous attempt and, if
+    ``COMPREHEND_S3_SKIP_UP_TO_DATE`` is "true", records whose analysis
+    results are up to date are skipped.
+    The other records are processed by :py:func:`process_records` if
+    ``analysis_mode`` is "batch", otherwise by :py:func:`process_record`.
+    Records that :py:data:`scheduler` does not start fail with
+    :py:class:`DeferredRecordError`.
+    Errors are logged as permanent or retryable.
+
+    :type records: list
+    :param records: S3 objects to be processed.
+    :type analysis_mode: string
+    :param analysis_mode: "single" or "batch".
+    :rtype: tuple
+    :return: ``(outcomes, skipped)`` where ``outcomes`` is a list of
+        ``((analysis, location), error)`` tuples in the same order as
+        ``records`` and ``skipped`` is a set of indices of skipped records.
+    """
+    outcomes = [None] * len(records)
+    skipped = set()
+    checkpoints = map_records(load_checkpoint, records)
+    for (i, (checkpoint, _)) in enumerate(checkpoints):
+        if checkpoint is not None:
+            LOGGER.info(
+                'skipping checkpointed s3://%s/%s: %s',
+                records[i]['s3']['bucket']['name'],
+                records[i]['s3']['object']['key'],
+                checkpoint.get('Status'))
+            outcomes[i] = get_checkpointed_outcome(checkpoint)
+            skipped.add(i)
+    if SKIP_UP_TO_DATE:
+        unchecked = [i for i in range(len(records)) if i not in skipped]
+        locations = map_records(
+            check_up_to_date, [records[i] for i in unchecked])
+        for (i, (location, _)) in zip(unchecked, locations):
+            if location is not None:
+                LOGGER.info('skipping up-to-date %s', location)
+                outcomes[i] = ((None, location), None)
+                skipped.add(i)
+    pending = [i for i in range(len(records)) if i not in skipped]
+    pending_records = [records[i] for i in pending]
+    if not pending_records:
+        pending_outcomes = []
+    elif analysis_mode == 'batch':
+        # JSON Lines objects are analyzed in batches by themselves
+        # and large objects are handed to asynchronous jobs
+        jsonl = [
+            i for (i, record) in enumerate(pending_records)
+            if is_jsonl_record(record) or is_async_record(record)
+        ]
+        documents = [i for i in range(len(pending_records)) if i not in jsonl]
+        pending_outcomes = [None] * len(pending_records)
+        sizes = [get_record_size(pending_records[i]) for i in documents]
+        admitted = scheduler.admit(sizes)
+        if admitted:
+            started = time.time()
+            document_outcomes = process_records(
+                [pending_records[i] for i in documents[:admitted]])
+            scheduler.observe(
+                sum(sizes[:admitted]), time.time() - started, admitted)
+            for (i, outcome) in zip(documents, document_outcomes):
+                pending_outcomes[i] = outcome
+        for i in documents[admitted:]:
+            pending_outcomes[i] = (
+                None, DeferredRecordError('not started before the deadline'))
+        if jsonl:
+            jsonl_outcomes = map_records(
+                process_record, [pending_records[i] for i in jsonl])
+            for (i, outcome) in zip(jsonl, jsonl_outcomes):
+                pending_outcomes[i] = outcome
+    else:
+        pending_outcomes = map_records(process_record, pending_records)
+    deferred = 0
+    for (i, outcome) in zip(pending, pending_outcomes):
+        outcomes[i] = outcome
+        record_error = outcome[1]
+        if record_error is None:
+            continue
+        if isinstance(record_error, DeferredRecordError):
+            deferred += 1
+            continue
+        LOGGER.error(
+            'failed to process s3://%s/%s (%s): %s',
+            records[i]['s3']['bucket']['name'],
+            records[i]['s3']['object']['key'],
+            is_permanent_error(record_error) and 'permanent' or 'retryable',
+            record_error)
+    if deferred:
+        LOGGER.warning('deferred %d records to meet the deadline', deferred)
+        stage_metrics.add_count('Schedule', 'DeferredRecords', deferred)
+    return (outcomes, skipped)
+
+
+def log_invocation_stats():
+    """
+    Logs statistics of the caches and rate limiters, and emits metrics of
+    stages.
+    """
+    LOGGER.info(
+        'analysis cache: hits=%d, misses=%d, entries=%d, bytes=%d/%d',
+        analysis_cache.hits,
+        analysis_cache.misses,
+        len(analysis_cache.entries),
+        analysis_cache.size,
+        analysis_cache.budget_bytes)
+    LOGGER.info(
+        'detector cache: entries=%d, bytes=%d/%d',
+        len(detector_cache.entries),
+        detector_cache.size,
+        detector_cache.budget_bytes)
+    for (api_name, stats) in sorted(detector_cache.get_stats().items()):
+        LOGGER.info(
+            'detector cache %s: hits=%d, misses=%d, hit rate=%.3f',
+            api_name,
+            stats['Hits'],
+            stats['Misses'],
+            stats['HitRate'])
+    for (api_name, stats) in sorted(get_rate_limiter_stats().items()):
+        LOGGER.info(
+            'rate limiter %s: rate=%.2f, requests=%d, throttles=%d, wait=%.3fs',
+            api_name,
+            stats['Rate'],
+            stats['Requests'],
+            stats['Throttles'],
+            stats['WaitSeconds'])
+    stage_metrics.emit()
+
+
+def parse_sqs_message(message):
+    """
+    Extracts S3 records from a given SQS message.
+
+    The body of ``message`` is an S3 event notification, which may be
+    wrapped in an SNS notification.
+    The test event sent when a notification is configured has no records.
+
+    :type message: dict
+    :param message: SQS message in an SQS event.
     :rtype: list
-    :return: list of analysis results, where each element is the result of
-        :py:func:`analyze_record`.
+    :return: S3 records in ``message``.
+    :raises ValueError: if the body of ``message`` is not JSON.
+    """
+    body = json.loads(message['body'])
+    if body.get('Type') == 'Notification' and 'Message' in body:
+        body = json.loads(body['Message'])
+    return body.get('Records', [])
+
+
+def gather_sqs_records(messages):
+    """
+    Gathers S3 records across given SQS messages.
+
+    Duplicate records of the same object are collapsed by
+    :py:func:`collapse_duplicate_records`.
+    A malformed message is logged and dropped because retrying it never
+    succeeds.
+
+    :type messages: list
+    :param messages: SQS messages in an SQS event.
+    :rtype: tuple
+    :return: ``(records, message_ids)`` where ``records`` is a list of
+        S3 records without duplicates and ``message_ids[i]`` is a list of
+        IDs of the messages that have the object of ``records[i]``.
+    """
+    records = []
+    owners = {}
+    for message in messages:
+        try:
+            message_records = parse_sqs_message(message)
+        except ValueError as e:
+            LOGGER.error(
+                'dropping malformed message %s: %s', message['messageId'], e)
+            continue
+        for record in message_records:
+            location = (
+                record['s3']['bucket']['name'], record['s3']['object']['key'])
+            owners.setdefault(location, []).append(message['messageId'])
+            records.append(record)
+    records = collapse_duplicate_records(records)
+    message_ids = [
+        owners[(record['s3']['bucket']['name'], record['s3']['object']['key'])]
+        for record in records
+    ]
+    return (records, message_ids)
+
+
+def sqs_main(event, context=None):
+    """
+    Applies Amazon Comprehend to S3 objects notified through an SQS queue.
+
+    S3 records are gathered across all the messages in ``event`` and
+    processed in micro-batches of ``COMPREHEND_S3_MICRO_BATCH_SIZE``
+    records with BatchDetect* APIs of Amazon Comprehend.
+    How many messages are delivered at once is configured by the batch size
+    and batching window of the event source mapping.
+
+    Messages that have a record failed with a transient error are reported
+    as failures so that only they are delivered again.
+    Permanent errors are only logged.
+    If a micro-batch fails as a whole, its records are processed one by one
+    so that only the messages of the records that fail by themselves are
+    reported.
+    Records that cannot finish before the deadline of ``context`` are not
+    started, and their messages are reported as failures as well.
+
+    :type event: dict
+    :param event: SQS event whose messages are S3 event notifications.
+    :type context: LambdaContext
+    :param context: Lambda context of the invocation. Records are not
+        limited by a deadline if omitted.
+    :rtype: dict
+    :return: partial batch response like the following::
+
+            {
+                'batchItemFailures': [
+                    {
+                        'itemIdentifier': 'ID of a failed message'
+                    }
+                ]
+            }
+    """
+    tracer.sample()
+    scheduler.start(context)
+    records, message_ids = gather_sqs_records(event['Records'])
+    LOGGER.info(
+        'gathered %d records from %d messages',
+        len(records),
+        len(event['Records']))
+    failed_ids = set()
+    for start in range(0, len(records), MICRO_BATCH_SIZE):
+        if scheduler.is_over():
+            LOGGER.warning(
+                'deferred %d records to meet the deadline',
+                len(records) - start)
+            for ids in message_ids[start:]:
+                failed_ids.update(ids)
+            break
+        batch = records[start:start + MICRO_BATCH_SIZE]
+        try:
+            outcomes, _ = run_records(batch, 'batch')
+        except Exception as e:
+            LOGGER.warning(
+                'failed to process a micro-batch of %d records, processing '
+                'them one by one: %s',
+                len(batch),
+                e)
+            outcomes = [run_record_alone(record) for record in batch]
+        for (i, (_, error)) in enumerate(outcomes):
+            if error is not None and not is_permanent_error(error):
+                failed_ids.update(message_ids[start + i])
+    log_invocation_stats()
+    return {
+        'batchItemFailures': [
+            {'itemIdentifier': message['messageId']}
+            for message in event['Records']
+            if message['messageId'] in failed_ids
+        ]
+    }
+
+
+def run_record_alone(record):
+    """
+    Processes a given record by :py:func:`run_records` alone.
+
+    :type record: dict
+    :param record: S3 object to be processed.
+    :rtype: tuple
+    :return: ``((analysis, location), error)`` of ``record``.
     """
-    # analyzes each record
-    analyses = [analyze_record(record) for record in event['Records']]
-    # saves analysis results
-    for (record, analysis) in zip(event['Records'], analyses):
-        bucket = record['s3']['bucket']['name']
-        key = record['s3']['object']['key']
-        save_analysis(input_bucket=bucket, input_key=key, analysis=analysis)
-    return analyses
+    try:
+        return run_records([record], 'batch')[0][0]
+    except Exception as e:
+        LOGGER.error(
+            'failed to process s3://%s/%s: %s',
+            record['s3']['bucket']['name'],
+            record['s3']['object']['key'],
+            e)
+        return (None, e)
 
 
 def lambda_handler(event, context):
@@ -321,18 +5469,94 @@ def lambda_handler(event, context):
     Entry function of the Lambda function.
 
     Wraps :py:func:`main` to catch and log any exception raised from it.
+    A keep-warm ping is handled by :py:func:`warm_up` instead.
 
     :type event: dict
-    :param event: should be an S3 PUT event
-    :rtype: list
-    :return: result of :py:func:`main`
+    :param event: should be an S3 PUT event or a warm-up event
+        (see :py:func:`is_warm_up_event`).
+    :rtype: list or dict
+    :return: result of :py:func:`main`, or :py:func:`warm_up` for a warm-up
+        event.
     """
     global LOGGER
     try:
         LOGGER.info('request ID: %s', context.aws_request_id)
-        return main(event)
+        if is_warm_up_event(event):
+            return warm_up(event)
+        return main(event, context)
+    except Exception as e:
+        # prints the stack trace of the exception
+        LOGGER.error(e)
+        traceback.print_exc()
+        raise e
+
+
+def sqs_handler(event, context):
+    """
+    Entry function of the Lambda function triggered by an SQS queue.
+
+    Wraps :py:func:`sqs_main` to catch and log any exception raised from it.
+    The event source mapping must enable ``ReportBatchItemFailures``.
+
+    :type event: dict
+    :param event: SQS event whose messages are S3 event notifications.
+    :rtype: dict
+    :return: result of :py:func:`sqs_main`
+    """
+    try:
+        LOGGER.info('request ID: %s', context.aws_request_id)
+        return sqs_main(event, context)
+    except Exception as e:
+        # prints the stack trace of the exception
+        LOGGER.error(e)
+        traceback.print_exc()
+        raise e
+
+
+def async_jobs_main(event):
+    """
+    Saves analysis results of objects whose asynchronous jobs finished.
+
+    :type event: dict
+    :param event: scheduled event, which is ignored.
+    :rtype: dict
+    :return: result of :py:func:`poll_async_jobs`.
+    """
+    counts = poll_async_jobs()
+    LOGGER.info(
+        'asynchronous jobs: completed=%d, in progress=%d, failed=%d, '
+        'errors=%d',
+        counts['Completed'],
+        counts['InProgress'],
+        counts['Failed'],
+        counts['Errors'])
+    log_invocation_stats()
+    return counts
+
+
+def async_jobs_handler(event, context):
+    """
+    Entry function of the Lambda function that checks asynchronous jobs.
+
+    Wraps :py:func:`async_jobs_main` to catch and log any exception raised
+    from it.
+    Should be invoked periodically by a schedule.
+
+    :type event: dict
+    :param event: scheduled event.
+    :rtype: dict
+    :return: result of :py:func:`async_jobs_main`
+    """
+    try:
+        LOGGER.info('request ID: %s', context.aws_request_id)
+        return async_jobs_main(event)
     except Exception as e:
         # prints the stack trace of the exception
         LOGGER.error(e)
         traceback.print_exc()
         raise e
+
+
+if PREWARM:
+    # creates clients while the Lambda runtime is initializing
+    threading.Thread(target=prewarm_clients, daemon=True).start()
@@ -0,0 +1,62 @@
+"""
+Imports ``lambda_function_4`` against the local stand-ins in
+``benchmarks/stubs`` for the tests.
+
+Settings are read when the Lambda function is imported, so every test
+module imports it through this module with the same settings.
+Tests replace module-level objects of the function instead of changing
+the settings.
+"""
+import os
+import sys
+
+
+SAM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SAM_DIR, 'benchmarks'))
+sys.path.insert(0, os.path.join(SAM_DIR, 'src'))
+
+os.environ.update({
+    'COMPREHEND_S3_LOGGING_LEVEL': 'CRITICAL',
+    'COMPREHEND_S3_METRICS': 'false',
+    'COMPREHEND_S3_MICRO_BATCH_SIZE': '2',
+    'COMPREHEND_S3_MAX_ATTEMPTS': '1',
+    'COMPREHEND_S3_CACHE_SIZE': '0',
+    'COMPREHEND_S3_DETECTOR_CACHE_BYTES': '0',
+    'COMPREHEND_S3_SKIP_UP_TO_DATE': 'false'
+})
+
+import stubs  # noqa: E402
+stubs.install()
+import lambda_function_4  # noqa: E402
+
+
+# bucket of input and output objects
+BUCKET = 'learn-aws-lambda-comprehend-s3-bucket'
+
+# original stand-in of API calls
+RESPOND = stubs.respond
+
+
+def raise_if_any(operation_name, params, predicate, code):
+    """
+    Raises an error of a given code if a text in a Detect* or BatchDetect*
+    request satisfies a given predicate.
+    """
+    if 'Detect' not in operation_name:
+        return
+    texts = params.get('TextList') or [params.get('Text', '')]
+    if any(predicate(text) for text in texts):
+        stubs.raise_client_error(operation_name, code, 'rejected by a test')
+
+
+def reject_empty_texts(operation_name, params):
+    """
+    Answers like :py:func:`stubs.respond` but rejects a request that has an
+    empty or whitespace-only text as Amazon Comprehend does.
+    """
+    raise_if_any(
+        operation_name,
+        params,
+        lambda text: not text.strip(),
+        'ValidationException')
+    return RESPOND(operation_name, params)
@@ -0,0 +1,72 @@
+"""
+Tests of ``analyze_texts`` with BatchDetect* APIs against the local
+stand-ins in ``benchmarks/stubs``.
+
+Usage (in the ``sam`` directory)::
+
+    python -m pytest tests
+"""
+import unittest
+
+from support import (
+    RESPOND, lambda_function_4, raise_if_any, reject_empty_texts, stubs)
+
+
+def make_texts(count):
+    return ['Text number %d is about Amazon Comprehend.' % i for i in range(count)]
+
+
+class AnalyzeTextsTest(unittest.TestCase):
+    def tearDown(self):
+        stubs.respond = RESPOND
+
+    def assertAnalyzed(self, outcome):
+        analysis, error = outcome
+        self.assertIsNone(error)
+        for field in ('DominantLanguage', 'Entities', 'KeyPhrases',
+                      'Sentiment', 'SyntaxTokens'):
+            self.assertIn(field, analysis)
+
+    def test_rejected_text_fails_alone(self):
+        # Amazon Comprehend rejects a whole request with an empty text
+        stubs.respond = reject_empty_texts
+        texts = make_texts(3)
+        texts.insert(1, '')
+        outcomes = lambda_function_4.analyze_texts(texts)
+        self.assertEqual(len(outcomes), 4)
+        self.assertIsNone(outcomes[1][0])
+        self.assertIsNotNone(outcomes[1][1])
+        for i in (0, 2, 3):
+            self.assertAnalyzed(outcomes[i])
+
+    def test_throttled_request_fails_only_its_texts(self):
+        # the second BatchDetectEntities request has the marked text
+        marked = lambda_function_4.BATCH_SIZE + 1
+        texts = make_texts(lambda_function_4.BATCH_SIZE + 5)
+        texts[marked] = 'throttled ' + texts[marked]
+        requests = []
+        def respond(operation_name, params):
+            requests.append(operation_name)
+            if operation_name == 'BatchDetectEntities':
+                raise_if_any(
+                    operation_name,
+                    params,
+                    lambda text: text.startswith('throttled'),
+                    'ThrottlingException')
+            return RESPOND(operation_name, params)
+        stubs.respond = respond
+        outcomes = lambda_function_4.analyze_texts(texts)
+        for (i, outcome) in enumerate(outcomes):
+            if i < lambda_function_4.BATCH_SIZE:
+                self.assertAnalyzed(outcome)
+            else:
+                self.assertIsNone(outcome[0])
+                self.assertEqual(
+                    lambda_function_4.get_error_code(outcome[1]),
+                    'ThrottlingException')
+        # throttled texts are not requested one by one
+        self.assertEqual(requests.count('BatchDetectEntities'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
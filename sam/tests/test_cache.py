@@ -0,0 +1,225 @@
+"""
+Tests of the caches of detector responses and analysis results.
+
+Usage (in the ``sam`` directory)::
+
+    python -m pytest tests
+"""
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from support import RESPOND, lambda_function_4, stubs
+
+
+RESPONSE = {'Entities': [{'Text': 'Amazon', 'Type': 'ORGANIZATION'}]}
+
+# size of RESPONSE counted by DetectorCache
+RESPONSE_BYTES = (
+    len(json.dumps(RESPONSE, separators=(',', ':'))) +
+    lambda_function_4.DETECTOR_CACHE_ENTRY_OVERHEAD)
+
+
+class DetectorCacheTest(unittest.TestCase):
+    def make_cache(self, entries, ttl=60.0):
+        return lambda_function_4.DetectorCache(entries * RESPONSE_BYTES, ttl)
+
+    def test_hits_and_misses(self):
+        cache = self.make_cache(2)
+        self.assertIsNone(cache.get('DetectEntities', 'a', 'en'))
+        cache.put('DetectEntities', 'a', 'en', RESPONSE)
+        self.assertEqual(cache.get('DetectEntities', 'a', 'en'), RESPONSE)
+        # the language and the API are parts of the key
+        self.assertIsNone(cache.get('DetectEntities', 'a', 'fr'))
+        self.assertIsNone(cache.get('DetectKeyPhrases', 'a', 'en'))
+        stats = cache.get_stats()
+        self.assertEqual(stats['DetectEntities']['Hits'], 1)
+        self.assertEqual(stats['DetectEntities']['Misses'], 2)
+
+    def test_entry_expires_after_ttl(self):
+        cache = self.make_cache(2, ttl=10.0)
+        with mock.patch.object(lambda_function_4.time, 'time', return_value=100.0):
+            cache.put('DetectEntities', 'a', 'en', RESPONSE)
+        with mock.patch.object(lambda_function_4.time, 'time', return_value=109.0):
+            self.assertEqual(cache.get('DetectEntities', 'a', 'en'), RESPONSE)
+        with mock.patch.object(lambda_function_4.time, 'time', return_value=110.0):
+            self.assertIsNone(cache.get('DetectEntities', 'a', 'en'))
+        self.assertEqual(cache.size, 0)
+        self.assertEqual(len(cache.entries), 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = self.make_cache(2)
+        cache.put('DetectEntities', 'a', 'en', RESPONSE)
+        cache.put('DetectEntities', 'b', 'en', RESPONSE)
+        cache.get('DetectEntities', 'a', 'en')
+        cache.put('DetectEntities', 'c', 'en', RESPONSE)
+        self.assertLessEqual(cache.size, cache.budget_bytes)
+        self.assertIsNotNone(cache.get('DetectEntities', 'a', 'en'))
+        self.assertIsNone(cache.get('DetectEntities', 'b', 'en'))
+        self.assertIsNotNone(cache.get('DetectEntities', 'c', 'en'))
+
+    def test_size_never_exceeds_budget(self):
+        cache = lambda_function_4.DetectorCache(10000, 60.0)
+        for i in range(100):
+            response = {'Entities': ['x' * (i * 37 % 500)]}
+            cache.put('DetectEntities', str(i), 'en', response)
+            self.assertLessEqual(cache.size, cache.budget_bytes)
+
+    def test_response_larger_than_budget_is_not_cached(self):
+        cache = lambda_function_4.DetectorCache(RESPONSE_BYTES - 1, 60.0)
+        cache.put('DetectEntities', 'a', 'en', RESPONSE)
+        self.assertEqual(cache.size, 0)
+        self.assertIsNone(cache.get('DetectEntities', 'a', 'en'))
+
+    def test_memoize_calls_detector_once(self):
+        cache = self.make_cache(2)
+        detect = mock.Mock(return_value=RESPONSE)
+        for _ in range(3):
+            self.assertEqual(
+                cache.memoize('DetectEntities', 'a', 'en', detect), RESPONSE)
+        self.assertEqual(detect.call_count, 1)
+
+
+def make_analysis(length):
+    return {
+        'DominantLanguage': {'LanguageCode': 'en', 'Score': 0.99},
+        'Entities': [],
+        'KeyPhrases': [
+            {
+                'Text': 'x' * length,
+                'Score': 0.9,
+                'BeginOffset': 0,
+                'EndOffset': length
+            }
+        ],
+        'Sentiment': {
+            'Sentiment': 'NEUTRAL',
+            'SentimentScore': {
+                'Positive': 0.1,
+                'Negative': 0.1,
+                'Neutral': 0.7,
+                'Mixed': 0.1
+            }
+        },
+        'SyntaxTokens': []
+    }
+
+
+class DictStore(object):
+    def __init__(self):
+        self.objects = {}
+
+    def get(self, key):
+        return self.objects.get(key)
+
+    def put(self, key, analysis):
+        self.objects[key] = analysis
+
+
+class AnalysisCacheByteBudgetTest(unittest.TestCase):
+    def test_size_never_exceeds_budget(self):
+        cache = lambda_function_4.AnalysisCache(100, 4000)
+        for i in range(50):
+            cache.put(str(i), make_analysis(i * 53 % 1500))
+            self.assertLessEqual(cache.size, cache.budget_bytes)
+        self.assertLess(len(cache.entries), 50)
+
+    def test_result_round_trips_through_memory(self):
+        cache = lambda_function_4.AnalysisCache(10, 10000)
+        analysis = make_analysis(10)
+        cache.put('a', analysis)
+        self.assertEqual(cache.get('a'), analysis)
+        self.assertEqual(cache.hits, 1)
+
+    def test_count_limit_still_applies(self):
+        cache = lambda_function_4.AnalysisCache(2, 10 ** 6)
+        for key in ('a', 'b', 'c'):
+            cache.put(key, make_analysis(10))
+        self.assertEqual(list(cache.entries), ['b', 'c'])
+
+    def test_large_result_is_kept_only_in_store(self):
+        store = DictStore()
+        cache = lambda_function_4.AnalysisCache(10, 500, store)
+        analysis = make_analysis(1000)
+        cache.put('a', analysis)
+        self.assertEqual(cache.size, 0)
+        self.assertEqual(store.objects['a'], analysis)
+        self.assertEqual(cache.get('a'), analysis)
+
+
+class AnalysisCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_key_depends_on_text(self):
+        self.assertEqual(
+            lambda_function_4.get_cache_key('a'),
+            lambda_function_4.get_cache_key('a'))
+        self.assertNotEqual(
+            lambda_function_4.get_cache_key('a'),
+            lambda_function_4.get_cache_key('b'))
+
+    def test_least_recently_used_result_is_evicted(self):
+        cache = lambda_function_4.AnalysisCache(2, 10 ** 6)
+        cache.put('a', make_analysis(10))
+        cache.put('b', make_analysis(10))
+        cache.get('a')
+        cache.put('c', make_analysis(10))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_result_survives_in_persistent_layer(self):
+        analysis = make_analysis(10)
+        store = lambda_function_4.FileCacheStore(self.directory)
+        lambda_function_4.AnalysisCache(10, 10000, store).put('a', analysis)
+        # a new cache, like one of a cold start, has an empty memory
+        cache = lambda_function_4.AnalysisCache(
+            10, 10000, lambda_function_4.FileCacheStore(self.directory))
+        self.assertEqual(cache.get('a'), analysis)
+        self.assertIn('a', cache.entries)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+class AnalyzeTextsCachedTest(unittest.TestCase):
+    def setUp(self):
+        self.text_lists = []
+        def respond_and_record(operation_name, params):
+            if operation_name == 'BatchDetectSentiment':
+                self.text_lists.append(list(params['TextList']))
+            return RESPOND(operation_name, params)
+        stubs.respond = respond_and_record
+        patcher = mock.patch.object(
+            lambda_function_4,
+            'analysis_cache',
+            lambda_function_4.AnalysisCache(10, 10 ** 6))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        stubs.respond = RESPOND
+
+    def test_duplicates_are_analyzed_once(self):
+        outcomes = lambda_function_4.analyze_texts_cached(['a.', 'b.', 'a.'])
+        self.assertEqual(self.text_lists, [['a.', 'b.']])
+        self.assertEqual([error for (_, error) in outcomes], [None] * 3)
+        self.assertEqual(
+            lambda_function_4.as_dict(outcomes[0][0]),
+            lambda_function_4.as_dict(outcomes[2][0]))
+
+    def test_cached_texts_are_not_analyzed(self):
+        lambda_function_4.analyze_texts_cached(['a.'])
+        self.text_lists = []
+        outcomes = lambda_function_4.analyze_texts_cached(['b.', 'a.'])
+        self.assertEqual(self.text_lists, [['b.']])
+        self.assertEqual([error for (_, error) in outcomes], [None] * 2)
+        self.assertEqual(lambda_function_4.analysis_cache.hits, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""
+Tests of per-record failure isolation and checkpointed retries of ``main``
+against the local stand-ins in ``benchmarks/stubs``.
+
+Usage (in the ``sam`` directory)::
+
+    python -m pytest tests
+"""
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from support import (
+    BUCKET, RESPOND, lambda_function_4, raise_if_any, reject_empty_texts,
+    stubs)
+
+
+KEYS = ['inbox/doc0.txt', 'inbox/empty.txt', 'inbox/doc2.txt']
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        stubs.configure(document_bytes=2000)
+        stubs.OBJECTS.clear()
+        stubs.OBJECTS[(BUCKET, 'inbox/empty.txt')] = b' \n'
+        stubs.REQUEST_COUNTS.clear()
+        stubs.respond = reject_empty_texts
+        self.directory = tempfile.mkdtemp()
+        self.patches = [
+            mock.patch.object(
+                lambda_function_4,
+                'checkpoint_store',
+                lambda_function_4.FileCacheStore(self.directory)),
+            mock.patch.object(lambda_function_4, 'RETURN_MODE', 'summary')
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        stubs.respond = RESPOND
+        shutil.rmtree(self.directory)
+
+    def run_main(self, analysis_mode):
+        with mock.patch.object(
+                lambda_function_4, 'ANALYSIS_MODE', analysis_mode):
+            return lambda_function_4.main(stubs.make_event(KEYS, bucket=BUCKET))
+
+    def assertEmptyTextFailedAlone(self, summary):
+        statuses = [record['Status'] for record in summary['Records']]
+        self.assertEqual(statuses, ['Succeeded', 'Failed', 'Succeeded'])
+        self.assertFalse(summary['Records'][1]['Retryable'])
+        self.assertIn('EmptyText', summary['Records'][1]['Error'])
+        for name in ('doc0', 'doc2'):
+            self.assertIn((BUCKET, 'comprehend/%s.json' % name), stubs.OBJECTS)
+
+    def test_empty_text_fails_alone_in_batch_mode(self):
+        self.assertEmptyTextFailedAlone(self.run_main('batch'))
+
+    def test_empty_text_fails_alone_in_single_mode(self):
+        self.assertEmptyTextFailedAlone(self.run_main('single'))
+
+    def test_retry_skips_checkpointed_records(self):
+        self.run_main('batch')
+        stubs.REQUEST_COUNTS.clear()
+        summary = self.run_main('batch')
+        self.assertEqual(
+            [record.get('Skipped') for record in summary['Records']],
+            [True, True, True])
+        self.assertEqual(summary['Records'][1]['Status'], 'Failed')
+        self.assertEqual(stubs.REQUEST_COUNTS['GetObject'], 0)
+
+    def test_retry_resumes_only_transient_failures(self):
+        def respond(operation_name, params):
+            raise_if_any(
+                operation_name,
+                params,
+                lambda text: text.startswith('inbox/doc2.txt'),
+                'ThrottlingException')
+            return reject_empty_texts(operation_name, params)
+        stubs.respond = respond
+        with self.assertRaises(Exception) as raised:
+            self.run_main('single')
+        self.assertEqual(
+            lambda_function_4.get_error_code(raised.exception),
+            'ThrottlingException')
+        self.assertNotIn((BUCKET, 'comprehend/doc2.json'), stubs.OBJECTS)
+        # Lambda retries the event
+        stubs.respond = reject_empty_texts
+        stubs.REQUEST_COUNTS.clear()
+        summary = self.run_main('single')
+        self.assertEqual(
+            [record.get('Skipped') for record in summary['Records']],
+            [True, True, None])
+        self.assertEqual(summary['Succeeded'], 2)
+        self.assertIn((BUCKET, 'comprehend/doc2.json'), stubs.OBJECTS)
+        self.assertEqual(stubs.REQUEST_COUNTS['GetObject'], 1)
+
+    def test_validation_errors_are_permanent(self):
+        for code in ('ValidationException', 'TextSizeLimitExceededException'):
+            with self.assertRaises(Exception) as raised:
+                stubs.raise_client_error('DetectEntities', code, 'invalid')
+            self.assertTrue(
+                lambda_function_4.is_permanent_error(raised.exception))
+        self.assertFalse(lambda_function_4.is_permanent_error(
+            lambda_function_4.BatchItemError('ThrottlingException', 'slow')))
+
+
+if __name__ == '__main__':
+    unittest.main()
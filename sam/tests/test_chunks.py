@@ -0,0 +1,178 @@
+"""
+Tests of splitting texts into chunks and merging results of the chunks
+against the local stand-ins in ``benchmarks/stubs``.
+
+Usage (in the ``sam`` directory)::
+
+    python -m pytest tests
+"""
+import unittest
+from unittest import mock
+
+from support import BUCKET, RESPOND, lambda_function_4, stubs
+
+
+# word detected as an entity wherever it appears
+ENTITY_WORD = 'Seattle'
+
+
+def respond_with_entity_word(operation_name, params):
+    """
+    Detects :py:data:`ENTITY_WORD` as entities at their positions in
+    texts, and otherwise answers like :py:func:`stubs.respond`.
+    """
+    def find_entities(text):
+        entities = []
+        begin = text.find(ENTITY_WORD)
+        while begin >= 0:
+            end = begin + len(ENTITY_WORD)
+            entities.append({
+                'Text': ENTITY_WORD,
+                'Type': 'LOCATION',
+                'Score': 0.99,
+                'BeginOffset': begin,
+                'EndOffset': end
+            })
+            begin = text.find(ENTITY_WORD, end)
+        return {'Entities': entities}
+    if operation_name == 'BatchDetectEntities':
+        results = []
+        for (i, text) in enumerate(params['TextList']):
+            result = find_entities(text)
+            result['Index'] = i
+            results.append(result)
+        return {'ResultList': results, 'ErrorList': []}
+    if operation_name == 'DetectEntities':
+        return find_entities(params['Text'])
+    return RESPOND(operation_name, params)
+
+
+class SplitTextTest(unittest.TestCase):
+    def assertChunksOf(self, text, chunks, max_bytes):
+        for (offset, chunk) in chunks:
+            self.assertEqual(text[offset:offset + len(chunk)], chunk)
+            self.assertLessEqual(len(chunk.encode('utf-8')), max_bytes)
+        # chunks are in order and leave out only whitespaces
+        end = 0
+        for (offset, chunk) in chunks:
+            self.assertGreaterEqual(offset, end)
+            self.assertFalse(text[end:offset].strip())
+            end = offset + len(chunk)
+        self.assertFalse(text[end:].strip())
+
+    def test_small_text_is_a_single_chunk(self):
+        self.assertEqual(
+            lambda_function_4.split_text('Hello.', 100), [(0, 'Hello.')])
+
+    def test_blank_text_has_no_chunks(self):
+        self.assertEqual(lambda_function_4.split_text(' \n\n ', 2), [])
+
+    def test_paragraphs_are_split_first(self):
+        text = 'First paragraph.\n\nSecond paragraph.'
+        chunks = lambda_function_4.split_text(text, 20)
+        self.assertChunksOf(text, chunks, 20)
+        self.assertEqual(
+            [chunk.strip() for (_, chunk) in chunks],
+            ['First paragraph.', 'Second paragraph.'])
+
+    def test_long_sentences_and_words_are_split(self):
+        text = ('One sentence here. Another one there.\n\n' +
+                'x' * 50 + ' tail words.\n\n')
+        for max_bytes in (4, 7, 16, 30):
+            self.assertChunksOf(
+                text, lambda_function_4.split_text(text, max_bytes),
+                max_bytes)
+
+    def test_multibyte_characters_are_counted_in_bytes(self):
+        text = '\u3042' * 10 + '\u3002' + '\u3044' * 10
+        chunks = lambda_function_4.split_text(text, 9)
+        self.assertChunksOf(text, chunks, 9)
+        self.assertEqual(''.join(chunk for (_, chunk) in chunks), text)
+
+    def test_character_larger_than_max_bytes_is_a_chunk(self):
+        text = 'a\U0001F600b'
+        self.assertEqual(
+            lambda_function_4.split_text(text, 2),
+            [(0, 'a'), (1, '\U0001F600'), (2, 'b')])
+
+    def test_stream_matches_text(self):
+        text = stubs.make_document('inbox/stream.txt').decode('utf-8')
+        pieces = [text[i:i + 100] for i in range(0, len(text), 100)]
+        chunks = list(lambda_function_4.split_text_stream(pieces, 50))
+        self.assertChunksOf(text, chunks, 50)
+
+
+class MergeChunkAnalysesTest(unittest.TestCase):
+    def setUp(self):
+        stubs.configure(document_bytes=30000)
+        stubs.OBJECTS.clear()
+        stubs.respond = respond_with_entity_word
+
+    def tearDown(self):
+        stubs.respond = RESPOND
+
+    def test_offsets_are_shifted(self):
+        analysis = {
+            'DominantLanguage': {'LanguageCode': 'en', 'Score': 1.0},
+            'Entities': [{'BeginOffset': 1, 'EndOffset': 3}],
+            'KeyPhrases': [{'BeginOffset': 0, 'EndOffset': 2}],
+            'Sentiment': {
+                'Sentiment': 'NEUTRAL',
+                'SentimentScore': {'Neutral': 1.0}
+            },
+            'SyntaxTokens': [
+                {'TokenId': 1, 'BeginOffset': 0, 'EndOffset': 1}
+            ]
+        }
+        merged = lambda_function_4.merge_chunk_analyses(
+            [0, 10], [10, 5], [analysis, analysis])
+        self.assertEqual(
+            merged['Entities'],
+            [{'BeginOffset': 1, 'EndOffset': 3},
+             {'BeginOffset': 11, 'EndOffset': 13}])
+        self.assertEqual(
+            merged['KeyPhrases'],
+            [{'BeginOffset': 0, 'EndOffset': 2},
+             {'BeginOffset': 10, 'EndOffset': 12}])
+        self.assertEqual(
+            [(t['TokenId'], t['BeginOffset']) for t in merged['SyntaxTokens']],
+            [(1, 0), (2, 10)])
+        # chunk results are left as they are
+        self.assertEqual(analysis['Entities'][0]['BeginOffset'], 1)
+
+    def test_entities_point_into_long_text(self):
+        # paragraphs differ so that unshifted offsets would be wrong
+        text = ''.join(
+            '-' * i + ('%s is rainy. ' % ENTITY_WORD) * 40 + '\n\n'
+            for i in range(30))
+        self.assertGreater(
+            len(text.encode('utf-8')), lambda_function_4.MAX_CHUNK_BYTES)
+        analysis = lambda_function_4.analyze_text(text)
+        self.assertEqual(len(analysis['Entities']), 40 * 30)
+        for entity in analysis['Entities']:
+            self.assertEqual(
+                text[entity['BeginOffset']:entity['EndOffset']], ENTITY_WORD)
+
+
+class AnalyzeRecordTest(unittest.TestCase):
+    def setUp(self):
+        stubs.configure(document_bytes=30000)
+        stubs.OBJECTS.clear()
+
+    def test_streamed_record_matches_whole_text(self):
+        record = stubs.make_event(['inbox/long.txt'], bucket=BUCKET)['Records'][0]
+        text = stubs.make_document('inbox/long.txt').decode('utf-8')
+        expected = lambda_function_4.analyze_text(text)
+        # small parts make the object read in ranges
+        with mock.patch.object(lambda_function_4, 'READ_PART_BYTES', 4096):
+            analysis = lambda_function_4.analyze_record(record)
+        self.assertEqual(lambda_function_4.as_dict(analysis), expected)
+
+    def test_spans_are_released_chunks(self):
+        chunks = [(0, 'abc '), (4, 'de')]
+        self.assertEqual(
+            lambda_function_4.get_chunk_spans(iter(chunks)), [(0, 4), (4, 6)])
+
+
+if __name__ == '__main__':
+    unittest.main()
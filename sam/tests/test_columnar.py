@@ -0,0 +1,127 @@
+"""
+Tests of the columnar representation of analysis results.
+
+Usage (in the ``sam`` directory)::
+
+    python -m pytest tests
+"""
+import json
+import unittest
+
+from support import lambda_function_4, stubs
+
+
+# source text of ANALYSIS
+TEXT = 'Alice met Bob in Paris.'
+
+# analysis result of TEXT whose texts are the source text
+ANALYSIS = {
+    'DominantLanguage': {'LanguageCode': 'en', 'Score': 0.99},
+    'Entities': [
+        {
+            'Score': 0.9,
+            'Type': 'PERSON',
+            'Text': 'Alice',
+            'BeginOffset': 0,
+            'EndOffset': 5
+        },
+        {
+            'Score': 0.8,
+            'Type': 'PERSON',
+            'Text': 'Bob',
+            'BeginOffset': 10,
+            'EndOffset': 13
+        },
+        {
+            'Score': 0.7,
+            'Type': 'LOCATION',
+            'Text': 'Paris',
+            'BeginOffset': 17,
+            'EndOffset': 22
+        }
+    ],
+    'KeyPhrases': [
+        {'Score': 0.6, 'Text': 'Bob', 'BeginOffset': 10, 'EndOffset': 13}
+    ],
+    'Sentiment': {
+        'Sentiment': 'NEUTRAL',
+        'SentimentScore': {
+            'Positive': 0.1,
+            'Negative': 0.0,
+            'Neutral': 0.9,
+            'Mixed': 0.0
+        }
+    },
+    'SyntaxTokens': [
+        {
+            'TokenId': 1,
+            'Text': 'Alice',
+            'BeginOffset': 0,
+            'EndOffset': 5,
+            'PartOfSpeech': {'Tag': 'PROPN', 'Score': 0.9}
+        },
+        {
+            'TokenId': 2,
+            'Text': 'met',
+            'BeginOffset': 6,
+            'EndOffset': 9,
+            'PartOfSpeech': {'Tag': 'VERB', 'Score': 0.8}
+        }
+    ]
+}
+
+
+class ColumnarTest(unittest.TestCase):
+    def test_round_trip(self):
+        columnar = lambda_function_4.encode_columnar(ANALYSIS)
+        self.assertEqual(
+            columnar['ColumnarVersion'], lambda_function_4.COLUMNAR_VERSION)
+        self.assertEqual(columnar['Entities']['Count'], 3)
+        self.assertEqual(
+            columnar['Entities']['Type'],
+            {'Dictionary': ['PERSON', 'LOCATION'], 'Codes': [0, 0, 1]})
+        self.assertNotIn('TokenId', columnar['SyntaxTokens'])
+        self.assertEqual(lambda_function_4.decode_columnar(columnar), ANALYSIS)
+
+    def test_round_trip_with_text(self):
+        columnar = lambda_function_4.encode_columnar(ANALYSIS, TEXT)
+        for field in ('Entities', 'KeyPhrases', 'SyntaxTokens'):
+            self.assertNotIn('Text', columnar[field])
+        self.assertEqual(
+            lambda_function_4.decode_columnar(columnar, TEXT), ANALYSIS)
+        with self.assertRaises(ValueError):
+            lambda_function_4.decode_columnar(columnar)
+
+    def test_texts_not_in_source_are_kept(self):
+        analysis = dict(ANALYSIS)
+        analysis['KeyPhrases'] = [
+            {'Score': 0.6, 'Text': 'Carol', 'BeginOffset': 10, 'EndOffset': 13}
+        ]
+        columnar = lambda_function_4.encode_columnar(analysis, TEXT)
+        self.assertEqual(columnar['KeyPhrases']['Text'], ['Carol'])
+        self.assertEqual(
+            lambda_function_4.decode_columnar(columnar, TEXT), analysis)
+
+    def test_irregular_items_are_kept(self):
+        analysis = dict(ANALYSIS)
+        analysis['SyntaxTokens'] = [
+            dict(ANALYSIS['SyntaxTokens'][1], TokenId=5)
+        ]
+        analysis['Entities'] = [dict(ANALYSIS['Entities'][0], Extra=1)]
+        columnar = lambda_function_4.encode_columnar(analysis)
+        self.assertEqual(columnar['SyntaxTokens']['TokenId'], [5])
+        self.assertEqual(columnar['Entities'], analysis['Entities'])
+        self.assertEqual(lambda_function_4.decode_columnar(columnar), analysis)
+
+    def test_analysis_round_trip_through_json(self):
+        stubs.configure(document_bytes=2000)
+        text = stubs.make_document('inbox/doc.txt').decode('utf-8')
+        analysis = lambda_function_4.analyze_text(text)
+        encoded = lambda_function_4.encode_columnar_json(analysis)
+        self.assertEqual(
+            lambda_function_4.decode_columnar(json.loads(encoded)),
+            json.loads(json.dumps(lambda_function_4.as_dict(analysis))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+"""
+Tests of JSON Lines objects against the local stand-ins in
+``benchmarks/stubs``.
+
+Usage (in the ``sam`` directory)::
+
+    python -m pytest tests
+"""
+import json
+import unittest
+from unittest import mock
+
+from support import BUCKET, RESPOND, lambda_function_4, reject_empty_texts, stubs
+
+
+LINES = [
+    '{"text": "Amazon Comprehend finds insights in text."}',
+    '{"text": ""}',
+    '',
+    '"A line may be a JSON string."',
+    '{"body": "no text field"}',
+    '{not json',
+    '{"text": " \\t "}',
+    '{"text": "The last document."}'
+]
+
+
+class JsonlTest(unittest.TestCase):
+    def setUp(self):
+        stubs.OBJECTS.clear()
+        stubs.respond = reject_empty_texts
+
+    def tearDown(self):
+        stubs.respond = RESPOND
+
+    def put_object(self, key, lines):
+        stubs.OBJECTS[(BUCKET, key)] = '\n'.join(lines).encode('utf-8')
+
+    def read_results(self, key):
+        data = stubs.OBJECTS[(BUCKET, key)].decode('utf-8')
+        return [json.loads(line) for line in data.splitlines()]
+
+    def test_parse_jsonl_document(self):
+        parse = lambda_function_4.parse_jsonl_document
+        self.assertEqual(parse('"text"'), 'text')
+        self.assertEqual(parse('{"text": "text"}'), 'text')
+        for line in ('{"text": ""}', '" "', '{"text": 1}', '[]', '{"x": "y"}'):
+            with self.assertRaises(ValueError):
+                parse(line)
+
+    def test_bad_lines_fail_alone(self):
+        self.put_object('inbox/docs.jsonl', LINES)
+        with mock.patch.object(lambda_function_4, 'RETURN_MODE', 'summary'):
+            summary = lambda_function_4.main(
+                stubs.make_event(['inbox/docs.jsonl'], bucket=BUCKET))
+        self.assertEqual(summary['Succeeded'], 1)
+        results = self.read_results('comprehend/docs.jsonl')
+        self.assertEqual(
+            [result['Line'] for result in results], [1, 2, 4, 5, 6, 7, 8])
+        self.assertEqual(
+            [result['Line'] for result in results if 'Analysis' in result],
+            [1, 4, 8])
+        self.assertIn('empty', results[1]['Error'])
+        self.assertIn('empty', results[5]['Error'])
+
+    def test_ndjson_extension(self):
+        self.assertTrue(lambda_function_4.is_jsonl_key('inbox/docs.ndjson'))
+        self.assertTrue(lambda_function_4.is_jsonl_key('inbox/docs.JSONL'))
+        self.assertFalse(lambda_function_4.is_jsonl_key('inbox/docs.json'))
+
+
+if __name__ == '__main__':
+    unittest.main()
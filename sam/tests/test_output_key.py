@@ -0,0 +1,92 @@
+"""
+Tests of the keys of output objects in every output layout.
+
+Usage (in the ``sam`` directory)::
+
+    python -m pytest tests
+"""
+import hashlib
+import time
+import unittest
+from unittest import mock
+
+from support import lambda_function_4
+
+
+EVENT_TIME = '2019-01-04T10:19:11.000Z'
+
+
+class GetOutputKeyTest(unittest.TestCase):
+    def get_output_key(
+            self, layout, input_key, event_time=EVENT_TIME,
+            output_format='json'):
+        with mock.patch.multiple(
+                lambda_function_4,
+                OUTPUT_LAYOUT=layout,
+                OUTPUT_FORMAT=output_format,
+                OUTPUT_FOLDER='comprehend',
+                INPUT_FOLDER='inbox',
+                OUTPUT_SHARD_DIGITS=2):
+            return lambda_function_4.get_output_key(input_key, event_time)
+
+    def test_flat(self):
+        self.assertEqual(
+            self.get_output_key('flat', 'inbox/a/report.txt'),
+            'comprehend/report.json')
+        self.assertEqual(
+            self.get_output_key('flat', 'other/report.txt'),
+            'comprehend/report.json')
+
+    def test_relative(self):
+        self.assertEqual(
+            self.get_output_key('relative', 'inbox/a/report.txt'),
+            'comprehend/a/report.json')
+        # the whole key outside the input folder
+        self.assertEqual(
+            self.get_output_key('relative', 'other/report.txt'),
+            'comprehend/other/report.json')
+        self.assertEqual(
+            self.get_output_key('relative', 'inboxes/report.txt'),
+            'comprehend/inboxes/report.json')
+
+    def test_sharded(self):
+        input_key = 'inbox/a/report.txt'
+        shard = hashlib.sha256(input_key.encode('utf-8')).hexdigest()[:2]
+        self.assertEqual(
+            self.get_output_key('sharded', input_key),
+            'comprehend/%s/a/report.json' % shard)
+
+    def test_date(self):
+        self.assertEqual(
+            self.get_output_key('date', 'inbox/a/report.txt'),
+            'comprehend/year=2019/month=01/day=04/a/report.json')
+
+    def test_date_without_event_time(self):
+        with mock.patch.object(
+                lambda_function_4.time,
+                'gmtime',
+                return_value=time.gmtime(0)):
+            self.assertEqual(
+                self.get_output_key('date', 'inbox/report.txt', None),
+                'comprehend/year=1970/month=01/day=01/report.json')
+
+    def test_every_layout_is_covered(self):
+        self.assertEqual(
+            set(lambda_function_4.OUTPUT_LAYOUTS),
+            set(['flat', 'relative', 'sharded', 'date']))
+
+    def test_jsonl_keeps_its_extension(self):
+        for layout in lambda_function_4.OUTPUT_LAYOUTS:
+            self.assertTrue(
+                self.get_output_key(layout, 'inbox/lines.jsonl').endswith(
+                    '/lines.jsonl'))
+
+    def test_extension_follows_output_format(self):
+        self.assertEqual(
+            self.get_output_key(
+                'relative', 'inbox/report.txt', output_format='json-gzip'),
+            'comprehend/report.json.gz')
+
+
+if __name__ == '__main__':
+    unittest.main()
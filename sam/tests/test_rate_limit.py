@@ -0,0 +1,152 @@
+"""
+Tests of the rate limiters and retries of Amazon Comprehend requests
+against the local stand-ins in ``benchmarks/stubs``.
+
+Usage (in the ``sam`` directory)::
+
+    python -m pytest tests
+"""
+import unittest
+from unittest import mock
+
+from support import RESPOND, lambda_function_4, stubs
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.limiter = lambda_function_4.RateLimiter(100.0)
+
+    def test_throttle_halves_rate(self):
+        self.limiter.on_throttle()
+        self.assertEqual(self.limiter.rate, 50.0)
+        self.assertLessEqual(self.limiter.tokens, 0.0)
+        self.limiter.on_throttle()
+        self.assertEqual(self.limiter.rate, 25.0)
+        self.assertEqual(self.limiter.get_stats()['Throttles'], 2)
+
+    def test_rate_never_falls_below_minimum(self):
+        for _ in range(20):
+            self.limiter.on_throttle()
+        self.assertEqual(self.limiter.rate, 5.0)
+
+    def test_success_restores_rate_additively(self):
+        self.limiter.on_throttle()
+        self.limiter.on_success()
+        self.assertEqual(self.limiter.rate, 55.0)
+        for _ in range(20):
+            self.limiter.on_success()
+        self.assertEqual(self.limiter.rate, 100.0)
+
+    def test_acquire_waits_for_tokens(self):
+        for _ in range(100):
+            self.assertEqual(self.limiter.acquire(), 0.0)
+        self.assertGreater(self.limiter.acquire(), 0.0)
+        stats = self.limiter.get_stats()
+        self.assertEqual(stats['Requests'], 101)
+        self.assertGreater(stats['WaitSeconds'], 0.0)
+
+
+class ErrorClassificationTest(unittest.TestCase):
+    def make_error(self, code):
+        try:
+            stubs.raise_client_error('DetectSentiment', code, 'message')
+        except Exception as e:
+            return e
+
+    def test_throttling_errors(self):
+        for code in lambda_function_4.THROTTLING_ERROR_CODES:
+            error = self.make_error(code)
+            self.assertIn(
+                lambda_function_4.get_error_code(error),
+                lambda_function_4.THROTTLING_ERROR_CODES)
+            self.assertFalse(lambda_function_4.is_transient_error(error))
+            self.assertFalse(lambda_function_4.is_permanent_error(error))
+
+    def test_transient_errors(self):
+        for code in lambda_function_4.TRANSIENT_ERROR_CODES:
+            error = self.make_error(code)
+            self.assertTrue(lambda_function_4.is_transient_error(error))
+            self.assertFalse(lambda_function_4.is_permanent_error(error))
+
+    def test_permanent_errors(self):
+        for code in ('InvalidRequestException',
+                     'TextSizeLimitExceededException',
+                     'ValidationException',
+                     'NoSuchKey'):
+            error = self.make_error(code)
+            self.assertFalse(lambda_function_4.is_transient_error(error))
+            self.assertTrue(lambda_function_4.is_permanent_error(error))
+        self.assertTrue(lambda_function_4.is_permanent_error(
+            lambda_function_4.BatchItemError('EmptyText', 'no text')))
+        self.assertFalse(lambda_function_4.is_permanent_error(
+            RuntimeError('unknown')))
+
+
+class CallRateLimitedTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.codes = []
+        def respond_with_errors(operation_name, params):
+            self.calls.append(operation_name)
+            if self.codes:
+                stubs.raise_client_error(
+                    operation_name, self.codes.pop(0), 'message')
+            return RESPOND(operation_name, params)
+        stubs.respond = respond_with_errors
+        patcher = mock.patch.multiple(
+            lambda_function_4,
+            MAX_ATTEMPTS=3,
+            BACKOFF_BASE_SECONDS=0.0,
+            rate_limiters={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        stubs.respond = RESPOND
+
+    def call(self):
+        return lambda_function_4.call_rate_limited(
+            'DetectSentiment', 'detect_sentiment',
+            {'Text': 'Hello.', 'LanguageCode': 'en'})
+
+    def get_stats(self):
+        return lambda_function_4.get_rate_limiter_stats()['DetectSentiment']
+
+    def test_throttled_request_is_retried(self):
+        self.codes = ['ThrottlingException', 'ThrottlingException']
+        self.assertIn('Sentiment', self.call())
+        self.assertEqual(len(self.calls), 3)
+        stats = self.get_stats()
+        self.assertEqual(stats['Throttles'], 2)
+        self.assertLess(stats['Rate'], lambda_function_4.RATE_LIMITS['default'])
+
+    def test_transient_error_is_retried_without_lowering_rate(self):
+        self.codes = ['InternalServerException']
+        self.assertIn('Sentiment', self.call())
+        self.assertEqual(len(self.calls), 2)
+        stats = self.get_stats()
+        self.assertEqual(stats['Throttles'], 0)
+        self.assertEqual(
+            stats['Rate'], lambda_function_4.RATE_LIMITS['default'])
+
+    def test_retries_are_limited(self):
+        self.codes = ['ThrottlingException'] * 3
+        with self.assertRaises(Exception) as raised:
+            self.call()
+        self.assertEqual(
+            lambda_function_4.get_error_code(raised.exception),
+            'ThrottlingException')
+        self.assertEqual(len(self.calls), 3)
+
+    def test_invalid_request_is_not_retried(self):
+        self.codes = ['InvalidRequestException']
+        with self.assertRaises(Exception) as raised:
+            self.call()
+        self.assertEqual(
+            lambda_function_4.get_error_code(raised.exception),
+            'InvalidRequestException')
+        self.assertEqual(len(self.calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
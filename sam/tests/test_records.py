@@ -0,0 +1,67 @@
+"""
+Tests of handling records in an S3 event.
+
+Usage (in the ``sam`` directory)::
+
+    python -m pytest tests
+"""
+import unittest
+
+from support import BUCKET, lambda_function_4
+
+
+def make_record(key, sequencer=None, tag=None):
+    obj = {'key': key}
+    if sequencer is not None:
+        obj['sequencer'] = sequencer
+    record = {'s3': {'bucket': {'name': BUCKET}, 'object': obj}}
+    if tag is not None:
+        record['tag'] = tag
+    return record
+
+
+def collapse(records):
+    return [
+        record['tag']
+        for record in lambda_function_4.collapse_duplicate_records(records)
+    ]
+
+
+class CollapseDuplicateRecordsTest(unittest.TestCase):
+    def test_latest_sequencer_is_kept(self):
+        records = [
+            make_record('inbox/a.txt', '0055AED6DCD90281E6', 'new'),
+            make_record('inbox/b.txt', '0055AED6DCD90281E5', 'b'),
+            make_record('inbox/a.txt', '0055AED6DCD90281E5', 'old')
+        ]
+        self.assertEqual(collapse(records), ['new', 'b'])
+
+    def test_shorter_sequencer_is_right_padded(self):
+        # "0056" is compared as "00560000", which is later than "00550000"
+        records = [
+            make_record('inbox/a.txt', '0056', 'short'),
+            make_record('inbox/a.txt', '00550000', 'long')
+        ]
+        self.assertEqual(collapse(records), ['short'])
+        self.assertEqual(collapse(list(reversed(records))), ['short'])
+
+    def test_padded_sequencers_differ_only_in_length(self):
+        # "0055" is the same as "005500" after padding, so the later record
+        # in the event is kept
+        records = [
+            make_record('inbox/a.txt', '005500', 'first'),
+            make_record('inbox/a.txt', '0055', 'second')
+        ]
+        self.assertEqual(collapse(records), ['second'])
+
+    def test_last_record_without_sequencer_is_kept(self):
+        records = [
+            make_record('inbox/a.txt', tag='first'),
+            make_record('inbox/b.txt', tag='b'),
+            make_record('inbox/a.txt', tag='second')
+        ]
+        self.assertEqual(collapse(records), ['b', 'second'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+"""
+Tests of scheduling records against the deadline of an invocation.
+
+Usage (in the ``sam`` directory)::
+
+    python -m pytest tests
+"""
+import unittest
+from unittest import mock
+
+from support import BUCKET, lambda_function_4, stubs
+
+
+class Context(object):
+    """
+    Lambda context whose remaining time is set by a test.
+    """
+    invoked_function_arn = (
+        'arn:aws:lambda:us-east-2:000000000000:function:stub-function')
+
+    def __init__(self, remaining_seconds, later_seconds=None):
+        self.remaining_seconds = remaining_seconds
+        # remaining time after the first call if given
+        self.later_seconds = later_seconds
+
+    def get_remaining_time_in_millis(self):
+        remaining = self.remaining_seconds
+        if self.later_seconds is not None:
+            self.remaining_seconds = self.later_seconds
+        return int(remaining * 1000)
+
+
+def make_scheduler(remaining_seconds):
+    # a record takes 1 second plus 1 second per 1000 bytes
+    scheduler = lambda_function_4.RecordScheduler(1.0, 0.001, 1.0)
+    context = Context(remaining_seconds)
+    scheduler.start(context)
+    return (scheduler, context)
+
+
+class RecordSchedulerTest(unittest.TestCase):
+    def test_records_that_fit_are_admitted(self):
+        scheduler, _ = make_scheduler(7.0)
+        # 2s, 4s, 6s and 8s in total
+        self.assertEqual(scheduler.admit([1000, 1000, 1000, 1000]), 3)
+        self.assertEqual(scheduler.admit([6000]), 0)
+
+    def test_first_record_is_deferred_if_it_does_not_fit_now(self):
+        scheduler, context = make_scheduler(10.0)
+        # time passes before the record is started
+        context.remaining_seconds = 4.0
+        self.assertFalse(scheduler.is_oversized(5000))
+        self.assertEqual(scheduler.admit([5000]), 0)
+        # a smaller record still fits
+        self.assertEqual(scheduler.admit([1000]), 1)
+
+    def test_oversized_first_record_is_started(self):
+        scheduler, _ = make_scheduler(10.0)
+        self.assertTrue(scheduler.is_oversized(20000))
+        self.assertEqual(scheduler.admit([20000, 0]), 1)
+
+    def test_no_deadline_without_context(self):
+        scheduler = lambda_function_4.RecordScheduler(1.0, 0.001, 1.0)
+        scheduler.start(None)
+        self.assertFalse(scheduler.is_oversized(10 ** 9))
+        self.assertEqual(scheduler.admit([10 ** 9, 10 ** 9]), 2)
+
+    def test_oversized_record_is_routed_to_async_jobs(self):
+        scheduler, _ = make_scheduler(10.0)
+        record = stubs.make_event(['inbox/a.txt'], bucket=BUCKET)['Records'][0]
+        record['s3']['object']['size'] = 20000
+        settings = {
+            'ASYNC_THRESHOLD_BYTES': 10 ** 9,
+            'ASYNC_ROLE_ARN': 'arn:aws:iam::000000000000:role/stub',
+            'ASYNC_LOCATION': 's3://%s/comprehend/async' % BUCKET,
+            'scheduler': scheduler
+        }
+        with mock.patch.multiple(lambda_function_4, **settings):
+            self.assertTrue(lambda_function_4.is_async_record(record))
+            record['s3']['object']['size'] = 1000
+            self.assertFalse(lambda_function_4.is_async_record(record))
+        # asynchronous jobs are disabled by default
+        record['s3']['object']['size'] = 20000
+        with mock.patch.object(lambda_function_4, 'scheduler', scheduler):
+            self.assertFalse(lambda_function_4.is_async_record(record))
+
+
+class MainDeadlineTest(unittest.TestCase):
+    def setUp(self):
+        stubs.configure(document_bytes=2000)
+        stubs.OBJECTS.clear()
+        del stubs.INVOCATIONS[:]
+
+    def test_first_record_is_continued_if_it_does_not_fit(self):
+        scheduler = lambda_function_4.RecordScheduler(1.0, 0.001, 1.0)
+        # the invocation has spent most of its time before the record
+        context = Context(10.0, later_seconds=2.5)
+        event = stubs.make_event(['inbox/doc0.txt'], bucket=BUCKET)
+        event['Records'][0]['s3']['object']['size'] = 5000
+        with mock.patch.multiple(
+                lambda_function_4,
+                scheduler=scheduler,
+                CONTINUATION='invoke',
+                RETURN_MODE='summary'):
+            summary = lambda_function_4.main(event, context)
+        self.assertEqual(summary['Deferred'], 1)
+        self.assertNotIn((BUCKET, 'comprehend/doc0.json'), stubs.OBJECTS)
+        self.assertEqual(
+            [invocation['Records'] for invocation in stubs.INVOCATIONS],
+            [event['Records']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+"""
+Tests of ``sqs_handler`` against the local stand-ins in ``benchmarks/stubs``.
+
+S3 event notifications are delivered through ``stubs.StubQueue``, and the
+partial batch responses are checked message by message.
+
+Usage (in the ``sam`` directory)::
+
+    python -m pytest tests
+"""
+import unittest
+from unittest import mock
+
+from support import BUCKET, RESPOND, lambda_function_4, raise_if_any, stubs
+
+
+# documents whose BatchDetect* requests are always throttled
+THROTTLED_PREFIX = 'inbox/throttled-'
+
+
+def respond_with_throttling(operation_name, params):
+    """
+    Throttles BatchDetect* requests that have a throttled document, rejects
+    requests that have an empty text, and otherwise answers like
+    :py:func:`stubs.respond`.
+    """
+    if operation_name.startswith('BatchDetect') and any(
+            THROTTLED_PREFIX in text for text in params['TextList']):
+        stubs.throttle(operation_name)
+    raise_if_any(
+        operation_name,
+        params,
+        lambda text: not text.strip(),
+        'ValidationException')
+    return RESPOND(operation_name, params)
+
+
+class SqsHandlerTest(unittest.TestCase):
+    def setUp(self):
+        # documents begin with their keys
+        stubs.configure(document_bytes=2000)
+        stubs.OBJECTS.clear()
+        stubs.respond = respond_with_throttling
+        self.queue = stubs.StubQueue(batch_size=10)
+
+    def tearDown(self):
+        stubs.respond = RESPOND
+
+    def send(self, keys):
+        for key in keys:
+            self.queue.send(stubs.make_event([key], bucket=BUCKET))
+
+    def invoke(self):
+        event = self.queue.receive(force=True)
+        response = lambda_function_4.sqs_handler(event, stubs.StubContext())
+        return set(
+            failure['itemIdentifier']
+            for failure in response['batchItemFailures'])
+
+    def assertSaved(self, name):
+        self.assertIn((BUCKET, 'comprehend/%s.json' % name), stubs.OBJECTS)
+
+    def test_all_succeed(self):
+        self.send(['inbox/doc0.txt', 'inbox/doc1.txt', 'inbox/doc2.txt'])
+        self.assertEqual(self.invoke(), set())
+        for name in ('doc0', 'doc1', 'doc2'):
+            self.assertSaved(name)
+
+    def test_permanent_error_is_not_reported(self):
+        # outside the inbox, which makes GetObject fail with NoSuchKey
+        self.send(['inbox/doc0.txt', 'missing/doc1.txt', 'inbox/doc2.txt'])
+        self.assertEqual(self.invoke(), set())
+        self.assertSaved('doc0')
+        self.assertSaved('doc2')
+        self.assertNotIn((BUCKET, 'comprehend/doc1.json'), stubs.OBJECTS)
+
+    def test_malformed_message_is_dropped(self):
+        self.send(['inbox/doc0.txt'])
+        self.queue.messages.append({
+            'messageId': 'poison',
+            'receiptHandle': 'poison',
+            'body': '{not json',
+            'eventSource': 'aws:sqs'
+        })
+        self.assertEqual(self.invoke(), set())
+        self.assertSaved('doc0')
+
+    def test_failed_micro_batch_reports_only_its_messages(self):
+        # micro-batches of 2 records: (doc0, doc1), (throttled-2, doc3),
+        # (doc4)
+        self.send([
+            'inbox/doc0.txt',
+            'inbox/doc1.txt',
+            THROTTLED_PREFIX + '2.txt',
+            'inbox/doc3.txt',
+            'inbox/doc4.txt'
+        ])
+        self.assertEqual(
+            self.invoke(), set(['stub-message-3', 'stub-message-4']))
+        for name in ('doc0', 'doc1', 'doc4'):
+            self.assertSaved(name)
+        self.assertNotIn((BUCKET, 'comprehend/doc3.json'), stubs.OBJECTS)
+
+    def test_duplicate_notifications_fail_together(self):
+        self.send([
+            'inbox/doc0.txt',
+            'inbox/doc1.txt',
+            THROTTLED_PREFIX + '2.txt',
+            THROTTLED_PREFIX + '2.txt'
+        ])
+        self.assertEqual(
+            self.invoke(), set(['stub-message-3', 'stub-message-4']))
+
+    def test_empty_object_does_not_fail_its_neighbours(self):
+        stubs.OBJECTS[(BUCKET, 'inbox/empty.txt')] = b''
+        self.send(['inbox/doc0.txt', 'inbox/empty.txt', 'inbox/doc2.txt'])
+        self.assertEqual(self.invoke(), set())
+        self.assertSaved('doc0')
+        self.assertSaved('doc2')
+
+    def test_failed_micro_batch_is_retried_record_by_record(self):
+        process_records = lambda_function_4.process_records
+        def fail_poison(records):
+            if any('poison' in record['s3']['object']['key']
+                   for record in records):
+                raise RuntimeError('poison record')
+            return process_records(records)
+        self.send(['inbox/doc0.txt', 'inbox/poison1.txt', 'inbox/doc2.txt'])
+        with mock.patch.object(
+                lambda_function_4, 'process_records', fail_poison):
+            self.assertEqual(self.invoke(), set(['stub-message-2']))
+        self.assertSaved('doc0')
+        self.assertSaved('doc2')
+
+
+if __name__ == '__main__':
+    unittest.main()
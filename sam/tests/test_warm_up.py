@@ -0,0 +1,79 @@
+"""
+Tests of keep-warm pings given to ``lambda_handler`` against the local
+stand-ins in ``benchmarks/stubs``.
+
+Usage (in the ``sam`` directory)::
+
+    python -m pytest tests
+"""
+import unittest
+from unittest import mock
+
+from support import BUCKET, RESPOND, lambda_function_4, stubs
+
+
+class IsWarmUpEventTest(unittest.TestCase):
+    def test_json_true_is_warm_up(self):
+        self.assertTrue(lambda_function_4.is_warm_up_event({'WarmUp': True}))
+
+    def test_scheduled_event_is_warm_up(self):
+        self.assertTrue(lambda_function_4.is_warm_up_event({
+            'source': 'aws.events',
+            'detail-type': 'Scheduled Event',
+            'detail': {}
+        }))
+
+    def test_other_values_are_not_warm_up(self):
+        for value in (False, 'true', 'false', 1, None, {}):
+            self.assertFalse(
+                lambda_function_4.is_warm_up_event({'WarmUp': value}), value)
+        self.assertFalse(lambda_function_4.is_warm_up_event({}))
+        self.assertFalse(lambda_function_4.is_warm_up_event([]))
+        self.assertFalse(lambda_function_4.is_warm_up_event({
+            'source': 'aws.events',
+            'detail-type': 'Object Created'
+        }))
+
+    def test_records_are_never_warm_up(self):
+        event = stubs.make_event(['inbox/doc0.txt'], bucket=BUCKET)
+        event['WarmUp'] = True
+        self.assertFalse(lambda_function_4.is_warm_up_event(event))
+
+
+class LambdaHandlerWarmUpTest(unittest.TestCase):
+    def setUp(self):
+        self.operations = []
+        def respond_and_record(operation_name, params):
+            self.operations.append(operation_name)
+            return RESPOND(operation_name, params)
+        stubs.respond = respond_and_record
+
+    def tearDown(self):
+        stubs.respond = RESPOND
+
+    def test_warm_up_analyzes_nothing(self):
+        with mock.patch.object(lambda_function_4, 'main') as main:
+            result = lambda_function_4.lambda_handler(
+                {'WarmUp': True, 'Bucket': BUCKET}, stubs.StubContext())
+        main.assert_not_called()
+        self.assertIs(result['WarmUp'], True)
+        self.assertGreater(result['Connections']['s3'], 0)
+        self.assertGreater(result['Connections']['comprehend'], 0)
+        self.assertEqual(
+            set(self.operations),
+            set(['HeadBucket', 'ListEntityRecognizers']))
+
+    def test_string_warm_up_is_not_short_circuited(self):
+        with mock.patch.object(
+                lambda_function_4, 'main', return_value=[]) as main, \
+                mock.patch.object(lambda_function_4, 'warm_up') as warm_up:
+            event = {'WarmUp': 'false'}
+            self.assertEqual(
+                lambda_function_4.lambda_handler(event, stubs.StubContext()),
+                [])
+        warm_up.assert_not_called()
+        main.assert_called_once_with(event, mock.ANY)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 from __future__ import print_function
 import boto3
+import codecs
 import logging
 import traceback
 
@@ -9,6 +10,9 @@ LOGGER.setLevel(logging.INFO)
 
 s3 = boto3.client('s3')
 
+# size of a piece in bytes read from an S3 object at once
+READ_PIECE_BYTES = 64 * 1024
+
 
 # Main Function
 def main(event, context):
@@ -21,9 +25,20 @@ def main(event, context):
         LOGGER.info('obtaining: s3://%s/%s', bucket, key)
         obj = s3.get_object(Bucket=bucket, Key=key)
         body = obj['Body']
-        text = body.read().decode()
-        body.close()  # is this necessary?
-        print('%s' % text)
+        # reads and prints the object piece by piece
+        # instead of buffering the whole object
+        # the incremental decoder takes care of a character split
+        # across pieces
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        try:
+            while True:
+                piece = body.read(READ_PIECE_BYTES)
+                if not piece:
+                    break
+                print(decoder.decode(piece), end='')
+            print(decoder.decode(b'', final=True))
+        finally:
+            body.close()  # is this necessary?
     return {
         'message': 'hello world!'
     }